@@ -0,0 +1,178 @@
+"""
+Indexes a small ISO9660 image built here sector by sector: directory records with and
+without Rock Ridge names, a subdirectory and a couple of files.
+"""
+
+import os
+import pathlib
+import pytest
+import struct
+from typing import Optional
+from utils.iso9660 import (
+    DIRECTORY_RECORD,
+    FLAG_DIRECTORY,
+    SECTOR_SIZE,
+    IsoImage,
+    _iso_name,
+    _rock_ridge_name,
+    open_local,
+)
+
+VMLINUZ = b"kernel " * 1000
+README = b"Read me\n"
+
+
+def _nm(name: bytes, flags: int = 0) -> bytes:
+    """A Rock Ridge NM entry"""
+    return b"NM" + bytes([5 + len(name), 1, flags]) + name
+
+
+def _record(
+    name: bytes, sector: int, size: int, flags: int = 0, su: bytes = b""
+) -> bytes:
+    padding = b"\0" * (1 - len(name) % 2)
+    length = DIRECTORY_RECORD.size + len(name) + len(padding) + len(su)
+    length += length % 2
+    record = DIRECTORY_RECORD.pack(
+        length, 0, sector, size, b"\0" * 7, flags, 0, 0, len(name)
+    )
+    return (record + name + padding + su).ljust(length, b"\0")
+
+
+def _directory(sector: int, parent: int, *records: bytes) -> bytes:
+    own = _record(b"\0", sector, SECTOR_SIZE, FLAG_DIRECTORY, _nm(b"", 0x02))
+    up = _record(b"\1", parent, SECTOR_SIZE, FLAG_DIRECTORY, _nm(b"", 0x04))
+    return b"".join((own, up) + records).ljust(SECTOR_SIZE, b"\0")
+
+
+def _iso(path: str) -> None:
+    root, images, vmlinuz, readme = 18, 19, 20, 24
+    sectors = {
+        16: (b"\1CD001\1\0".ljust(156, b"\0") + _record(b"\0", root, SECTOR_SIZE, 2)),
+        17: b"\xffCD001\1",
+        root: _directory(
+            root,
+            root,
+            _record(b"IMAGES", images, SECTOR_SIZE, FLAG_DIRECTORY, _nm(b"images")),
+            # no Rock Ridge name, the ISO9660 one is used
+            _record(b"README.TXT;1", readme, len(README)),
+        ),
+        images: _directory(
+            images,
+            root,
+            # the name is split over two NM entries (CONTINUE flag on the first one)
+            _record(
+                b"VMLINUZ.;1", vmlinuz, len(VMLINUZ), 0, _nm(b"vml", 1) + _nm(b"inuz")
+            ),
+        ),
+        vmlinuz: VMLINUZ,
+        readme: README,
+    }
+    with open(path, "wb") as f:
+        for sector, data in sorted(sectors.items()):
+            f.seek(sector * SECTOR_SIZE)
+            f.write(data.ljust(SECTOR_SIZE, b"\0"))
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        (b"README.TXT;1", "readme.txt"),
+        (b"VMLINUZ.;1", "vmlinuz"),
+        (b"IMAGES", "images"),
+    ],
+)
+def test_iso_name(name: bytes, expected: str) -> None:
+    assert _iso_name(name) == expected
+
+
+@pytest.mark.parametrize(
+    "system_use, expected",
+    [
+        (_nm(b"initrd.img"), "initrd.img"),
+        (_nm(b"initrd", 1) + _nm(b".img"), "initrd.img"),
+        # other entries (here PX) come before the name
+        (b"PX" + bytes([8, 1]) + b"\0" * 4 + _nm(b"grub.cfg"), "grub.cfg"),
+        # "." and ".."
+        (_nm(b"", 0x02), None),
+        (_nm(b"", 0x04), None),
+        (b"", None),
+        # a broken entry length ends the area
+        (b"NM\x02\x01", None),
+    ],
+)
+def test_rock_ridge_name(system_use: bytes, expected: Optional[str]) -> None:
+    assert _rock_ridge_name(system_use) == expected
+
+
+def test_directory_record_layout() -> None:
+    record = _record(b"IMAGES", 19, SECTOR_SIZE, FLAG_DIRECTORY)
+    assert record[0] == len(record) == 40
+    assert struct.unpack_from("<I", record, 2)[0] == 19
+    assert record[25] == FLAG_DIRECTORY
+    assert record[32] == 6
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("images/vmlinuz", VMLINUZ),
+        ("/images/vmlinuz", VMLINUZ),
+        ("IMAGES/VMLINUZ", VMLINUZ),
+        ("readme.txt", README),
+        ("images", None),
+        ("images/missing", None),
+    ],
+)
+def test_open(tmp_path: pathlib.Path, path: str, expected: Optional[bytes]) -> None:
+    fn = os.path.join(tmp_path, "test.iso")
+    _iso(fn)
+    iso = IsoImage(fn)
+    try:
+        data = iso.open(path)
+        if expected is None:
+            assert data is None
+        else:
+            assert data is not None
+            assert data.size == len(expected)
+            assert data.read(0, data.size + 10) == expected
+            assert data.read(5, 4) == expected[5:9]
+    finally:
+        iso.close()
+
+
+def test_listdir(tmp_path: pathlib.Path) -> None:
+    fn = os.path.join(tmp_path, "test.iso")
+    _iso(fn)
+    iso = IsoImage(fn)
+    assert iso.listdir("") == ["images", "readme.txt"]
+    assert iso.listdir("/IMAGES/") == ["vmlinuz"]
+    with pytest.raises(NotADirectoryError):
+        iso.listdir("readme.txt")
+    iso.close()
+
+
+def test_not_an_iso(tmp_path: pathlib.Path) -> None:
+    fn = os.path.join(tmp_path, "empty.iso")
+    with open(fn, "wb") as f:
+        f.write(b"\0" * SECTOR_SIZE * 18)
+    with pytest.raises(ValueError):
+        IsoImage(fn)
+
+
+def test_open_local_is_closed(tmp_path: pathlib.Path) -> None:
+    fn = os.path.join(tmp_path, "grub.cfg")
+    with open(fn, "wb") as f:
+        f.write(README)
+    fds = len(os.listdir("/proc/self/fd"))
+    # kept around, like by a transfer that's still running
+    opened = []
+    for _ in range(50):
+        data = open_local(fn)
+        assert data is not None
+        with data:
+            assert data.read(0, 100) == README
+        assert data.read(0, 100) == b""
+        opened.append(data)
+    assert len(os.listdir("/proc/self/fd")) == fds
+    assert open_local(os.path.join(tmp_path, "missing")) is None
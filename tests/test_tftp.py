@@ -0,0 +1,147 @@
+"""
+Read requests, option negotiation (blksize, tsize) and whole transfers of the TFTP
+server, played by a client on the loopback interface.
+"""
+
+import os
+import pathlib
+import pytest
+import socket
+import struct
+import threading
+from typing import Optional
+from utils import tftp
+from utils.iso9660 import FileRange, open_local
+
+CONTENT = bytes(range(256)) * 10
+
+
+def _rrq(filename: bytes, mode: bytes = b"octet", *options: bytes) -> bytes:
+    fields = [filename, mode, *options]
+    return struct.pack("!H", tftp.OP_RRQ) + b"".join(f + b"\0" for f in fields)
+
+
+@pytest.mark.parametrize(
+    "packet, expected",
+    [
+        (_rrq(b"grubx64.efi"), ("grubx64.efi", "octet", {})),
+        (_rrq(b"a", b"NETASCII"), ("a", "netascii", {})),
+        (
+            _rrq(b"a", b"octet", b"BLKSIZE", b"1468", b"tsize", b"0"),
+            ("a", "octet", {"blksize": "1468", "tsize": "0"}),
+        ),
+        # an option without a value, it isn't acknowledged (see test_negotiation)
+        (_rrq(b"a", b"octet", b"blksize"), ("a", "octet", {"blksize": ""})),
+        # no mode at all
+        (struct.pack("!H", tftp.OP_RRQ) + b"a", ("a", "", {})),
+    ],
+)
+def test_parse_request(
+    packet: bytes, expected: tuple[str, str, dict[str, str]]
+) -> None:
+    assert tftp._parse_request(packet) == expected
+
+
+class FakeSocket:
+    def __init__(self) -> None:
+        self.sent: list[bytes] = []
+
+    def sendto(self, packet: bytes, client: tuple[str, int]) -> None:
+        self.sent.append(packet)
+
+
+@pytest.mark.parametrize(
+    "packet, code",
+    [
+        (struct.pack("!H", tftp.OP_WRQ) + b"a\0octet\0", tftp.ERROR_ILLEGAL),
+        (struct.pack("!H", tftp.OP_DATA) + b"\0\1", tftp.ERROR_ILLEGAL),
+        (_rrq(b"missing"), tftp.ERROR_NOT_FOUND),
+    ],
+)
+def test_rejected_requests(packet: bytes, code: int) -> None:
+    sock = FakeSocket()
+    tftp._handle(sock, "127.0.0.1", lambda _: None, packet, ("127.0.0.1", 1))  # type: ignore[arg-type]
+    assert len(sock.sent) == 1
+    assert struct.unpack("!HH", sock.sent[0][:4]) == (tftp.OP_ERROR, code)
+
+
+def _download(
+    data: FileRange, options: dict[str, str]
+) -> tuple[Optional[dict[str, str]], list[bytes]]:
+    """Runs a transfer to a client on the loopback, returns the OACK options and blocks"""
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.bind(("127.0.0.1", 0))
+    client.settimeout(5)
+    transfer = tftp._Transfer("127.0.0.1", client.getsockname(), data, options)
+    thread = threading.Thread(target=transfer.run)
+    thread.start()
+    oack = None
+    blocks = []
+    try:
+        while True:
+            packet, server = client.recvfrom(tftp.MAX_BLKSIZE + 4)
+            opcode = struct.unpack("!H", packet[:2])[0]
+            if opcode == tftp.OP_OACK:
+                fields = packet[2:].split(b"\0")[:-1]
+                oack = {
+                    k.decode(): v.decode() for k, v in zip(fields[::2], fields[1::2])
+                }
+                client.sendto(struct.pack("!HH", tftp.OP_ACK, 0), server)
+                continue
+            assert opcode == tftp.OP_DATA
+            block = struct.unpack("!H", packet[2:4])[0]
+            assert block == len(blocks) + 1
+            blocks.append(packet[4:])
+            client.sendto(struct.pack("!HH", tftp.OP_ACK, block), server)
+            if len(packet) - 4 < int((oack or {}).get("blksize", 512)):
+                break
+    finally:
+        thread.join(5)
+        client.close()
+    return oack, blocks
+
+
+@pytest.mark.parametrize(
+    "options, oack, blksize",
+    [
+        ({}, None, tftp.DEFAULT_BLKSIZE),
+        ({"blksize": "1024"}, {"blksize": "1024"}, 1024),
+        ({"blksize": "1"}, {"blksize": str(tftp.MIN_BLKSIZE)}, tftp.MIN_BLKSIZE),
+        ({"blksize": "99999"}, {"blksize": str(tftp.MAX_BLKSIZE)}, tftp.MAX_BLKSIZE),
+        # a value that isn't a number isn't acknowledged
+        ({"blksize": "big"}, None, tftp.DEFAULT_BLKSIZE),
+        ({"blksize": ""}, None, tftp.DEFAULT_BLKSIZE),
+        ({"tsize": "0"}, {"tsize": str(len(CONTENT))}, tftp.DEFAULT_BLKSIZE),
+        (
+            {"blksize": "1280", "tsize": "0"},
+            {"blksize": "1280", "tsize": str(len(CONTENT))},
+            1280,
+        ),
+    ],
+)
+def test_negotiation(
+    tmp_path: pathlib.Path,
+    options: dict[str, str],
+    oack: Optional[dict[str, str]],
+    blksize: int,
+) -> None:
+    fn = os.path.join(tmp_path, "grubx64.efi")
+    with open(fn, "wb") as f:
+        f.write(CONTENT)
+    data = open_local(fn)
+    assert data is not None
+    got_oack, blocks = _download(data, options)
+    assert got_oack == oack
+    assert b"".join(blocks) == CONTENT
+    assert all(len(b) == blksize for b in blocks[:-1])
+    assert len(blocks[-1]) < blksize
+    # the transfer closes the file when it's done
+    assert data.mm is None
+
+
+def test_empty_file(tmp_path: pathlib.Path) -> None:
+    fn = os.path.join(tmp_path, "empty")
+    open(fn, "wb").close()
+    data = open_local(fn)
+    assert data is not None
+    assert _download(data, {"tsize": "0"}) == ({"tsize": "0"}, [b""])
@@ -0,0 +1,169 @@
+"""
+Replays Boot Manager screens of the BF UEFI setup browser through the screen model, drawn
+the way EDK2 draws them: in UTF-8 or, in PC-ANSI mode, with CP437 box characters.
+"""
+
+from typing import Optional
+from utils.uefi_menu import KEY_DOWN, KEY_UP, UefiMenu
+from utils.vt100 import Screen
+
+ESC = b"\x1b"
+
+ENTRIES = [
+    "UEFI Misc Device",
+    "EFI Network (RSHIM IPV4)",
+    "EFI Network 1 (OOB IPV4)",
+    "EFI Shell",
+]
+DEVICE_PATHS = [
+    "Device Path : VenHw(93E34C7E-B50E-11DF-9223-2443DFD72085,00)",
+    "Device Path : MAC(001ACAFFFF01,0x1)/IPv4(0.0.0.0,0x0,DHCP,0.0.0.0,0.0.0.0,0.0.0.0)",
+    "Device Path : MAC(B83FD2A1B2C3,0x1)/IPv4(0.0.0.0,0x0,DHCP,0.0.0.0,0.0.0.0,0.0.0.0)",
+    "Device Path : Fv(5C60F367-A505-419A-859E-2A4FF6CA6FE5)/FvFile(7C04A583)",
+]
+
+# Columns of the frame around the menu, the divider and the help pane, as drawn at 100x31
+LEFT = 1
+DIVIDER = 54
+RIGHT = 100
+HELP_WIDTH = RIGHT - DIVIDER - 3
+
+
+def _at(row: int, col: int) -> bytes:
+    return ESC + f"[{row};{col}H".encode()
+
+
+def _color(fg: int, bg: int) -> bytes:
+    return ESC + f"[{30 + fg};{40 + bg}m".encode()
+
+
+def boot_manager(selected: int, cp437: bool = False) -> bytes:
+    """One full redraw of the Boot Manager with the entry at index selected highlighted"""
+    if cp437:
+        vertical, double, horizontal = b"\xb3", b"\xba", b"\xc4"
+    else:
+        vertical, double, horizontal = (c.encode() for c in "│║─")
+    out = ESC + b"[2J" + _color(1, 7)
+    out += _at(1, 1) + horizontal * RIGHT
+    out += _at(2, 40) + b"Boot Manager"
+    out += _at(3, 1) + horizontal * RIGHT
+    for row in range(4, 27):
+        out += _color(1, 7) + _at(row, LEFT) + double
+        out += _at(row, DIVIDER) + vertical + _at(row, RIGHT) + double
+    out += _color(0, 7) + _at(5, 3) + b"Boot Manager Menu"
+    for i, entry in enumerate(ENTRIES):
+        out += _color(7, 0) if i == selected else _color(1, 7)
+        out += _at(7 + i, 3) + entry.encode()
+    # the help text of the highlighted entry, wrapped to the width of the pane
+    help_text = DEVICE_PATHS[selected]
+    out += _color(1, 7)
+    for i in range(0, len(help_text), HELP_WIDTH):
+        row = 5 + i // HELP_WIDTH
+        out += _at(row, DIVIDER + 2) + help_text[i : i + HELP_WIDTH].encode()
+    out += _color(1, 7) + _at(27, 1) + horizontal * RIGHT
+    out += _at(28, 3) + b"^v=Move Highlight       <Enter>=Select Entry"
+    return out
+
+
+class FakeConsole:
+    """Redraws the Boot Manager whenever the highlight is moved, like the firmware does"""
+
+    def __init__(self, selected: int = 0, cp437: bool = False):
+        self.selected = selected
+        self.cp437 = cp437
+        self.buffer = boot_manager(selected, cp437)
+        self.pending: list[bytes] = []
+        self.sent: list[str] = []
+
+    def read_nonblocking(self, size: int = 1024, timeout: float = 0) -> bytes:
+        return self.pending.pop(0) if self.pending else b""
+
+    def send(self, data: str) -> None:
+        self.sent.append(data)
+        self.selected += data.count(KEY_DOWN) - data.count(KEY_UP)
+        self.selected = max(0, min(len(ENTRIES) - 1, self.selected))
+        # EDK2 sends a redraw in several pieces
+        screen = boot_manager(self.selected, self.cp437)
+        self.pending += [screen[: len(screen) // 2], screen[len(screen) // 2 :]]
+
+
+def _screen(data: bytes) -> Screen:
+    screen = Screen(rows=31, cols=100)
+    screen.feed(data)
+    return screen
+
+
+def _menu(selected: int = 0, cp437: bool = False) -> UefiMenu:
+    return UefiMenu(FakeConsole(selected, cp437))  # type: ignore[arg-type]
+
+
+def test_divider() -> None:
+    assert _screen(boot_manager(0)).divider_column() == DIVIDER - 1
+
+
+def test_divider_cp437() -> None:
+    screen = _screen(boot_manager(0, cp437=True))
+    assert screen.divider_column() == DIVIDER - 1
+    assert "�" not in screen.text()
+    assert screen.line(3).startswith("║")
+
+
+def test_split_cp437_bytes_are_decoded() -> None:
+    data = boot_manager(0, cp437=True)
+    screen = Screen(rows=31, cols=100)
+    # the console hands over whatever it read, wherever that ends
+    for i in range(0, len(data), 7):
+        screen.feed(data[i : i + 7])
+    assert screen.divider_column() == DIVIDER - 1
+
+
+def test_entries_and_selection() -> None:
+    for cp437 in (False, True):
+        menu = _menu(selected=2, cp437=cp437)
+        assert menu.entries() == ENTRIES
+        selection = menu.selection()
+        assert selection is not None
+        assert selection[1] == ENTRIES[2]
+
+
+def test_help_text_is_unwrapped() -> None:
+    for cp437 in (False, True):
+        help_text = _menu(selected=1, cp437=cp437).help_text()
+        assert help_text == DEVICE_PATHS[1]
+
+
+def test_wait_for_help() -> None:
+    for cp437 in (False, True):
+        _menu(cp437=cp437).wait_for_help("Device Path", 1)
+
+
+def test_select() -> None:
+    menu = _menu(selected=0)
+    assert menu.select("EFI Shell") == "EFI Shell"
+    console: FakeConsole = menu.console  # type: ignore[assignment]
+    assert console.sent == [KEY_DOWN * 3]
+
+
+def test_find_by_device_path() -> None:
+    # the pattern pxeboot looks for the tmfifo interface with
+    device_path = "MAC.001ACAFFFF..,0x1.*IPv4.0.0.0.0."
+    for cp437 in (False, True):
+        menu = _menu(selected=3, cp437=cp437)
+        assert menu.find(device_path, "RSHIM.*IPV4") == ENTRIES[1]
+
+
+def test_find_without_entry_pattern() -> None:
+    menu = _menu(selected=0, cp437=True)
+    assert menu.find(r"OOB|B83FD2A1B2C3") == ENTRIES[2]
+
+
+def _selected(menu: UefiMenu) -> Optional[str]:
+    selection = menu.selection()
+    return selection[1] if selection else None
+
+
+def test_no_menu() -> None:
+    menu = UefiMenu(FakeConsole())  # type: ignore[arg-type]
+    menu.screen.reset()
+    assert _selected(menu) is None
+    assert menu.help_text() == ""
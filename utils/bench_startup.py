@@ -0,0 +1,122 @@
+"""
+Startup benchmark of the dpu-tools CLI, run from the top of the repo:
+
+    python -m utils.bench_startup
+
+Every command is run a few times without the daemon and the median wall time is
+reported. It fails if a command takes longer than the budget, if one of the modules
+that should only be imported by the commands needing them is loaded at startup, or if it
+scans for DPUs (lspci and lshw are replaced by stand-ins noting that they were run).
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from logger import logger, setup_logging
+from utils.daemon import NO_DAEMON_ENV
+
+CLI = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dpu-tools"
+)
+
+COMMANDS = [
+    ["--dpu-type", "ipu", "--imc-address", "127.0.0.1", "--help"],
+    ["--dpu-type", "bf", "--help"],
+    ["--help"],
+]
+
+# Only imported once a command needs them
+HEAVY_MODULES = ["paramiko", "requests", "asyncio", "utils.fwutils", "utils.pxeboot"]
+
+# Never run for help, they're slow (lshw) or find DPUs to show help for (lspci)
+SCAN_TOOLS = ["lspci", "lshw"]
+
+
+def fake_scan_tools(directory: str) -> str:
+    """Put stand-ins of SCAN_TOOLS in directory, returns the file they note runs in"""
+    spawned = os.path.join(directory, "spawned")
+    for tool in SCAN_TOOLS:
+        path = os.path.join(directory, tool)
+        with open(path, "w") as f:
+            f.write(f'#!/bin/sh\necho {tool} >> "{spawned}"\n')
+        os.chmod(path, 0o755)
+    return spawned
+
+
+def spawned_tools(spawned: str) -> list[str]:
+    try:
+        with open(spawned) as f:
+            tools = f.read().split()
+        os.remove(spawned)
+        return tools
+    except FileNotFoundError:
+        return []
+
+
+def run_once(argv: list[str], path: str) -> tuple[float, set[str]]:
+    """Wall time of the command and the modules it imported, run with PATH path"""
+    env = dict(os.environ, **{NO_DAEMON_ENV: "1", "PATH": path})
+    start = time.monotonic()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", CLI] + argv,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=env,
+    )
+    elapsed = time.monotonic() - start
+    if result.returncode:
+        raise RuntimeError(f"dpu-tools {' '.join(argv)} failed: {result.stderr}")
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            modules.add(line.split("|")[-1].strip())
+    return elapsed, modules
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the dpu-tools startup")
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=1.0,
+        help="Maximum median time per command in seconds (default: %(default)s)",
+    )
+    args = parser.parse_args()
+    setup_logging(False)
+
+    ok = True
+    tools_dir = tempfile.TemporaryDirectory()
+    spawned = fake_scan_tools(tools_dir.name)
+    path = os.pathsep.join([tools_dir.name, os.environ.get("PATH", "")])
+    for argv in COMMANDS:
+        times = []
+        modules: set[str] = set()
+        for _ in range(args.runs):
+            elapsed, modules = run_once(argv, path)
+            times.append(elapsed)
+        median = statistics.median(times)
+        name = " ".join(argv)
+        logger.info(f"dpu-tools {name}: {median * 1000:.0f}ms (median of {args.runs})")
+        if median > args.budget:
+            logger.error(f"dpu-tools {name} is over the budget of {args.budget}s")
+            ok = False
+        heavy = [m for m in HEAVY_MODULES if m in modules]
+        if heavy:
+            logger.error(f"dpu-tools {name} imported {', '.join(heavy)} at startup")
+            ok = False
+        tools = spawned_tools(spawned)
+        if tools:
+            logger.error(f"dpu-tools {name} ran {', '.join(sorted(set(tools)))}")
+            ok = False
+    tools_dir.cleanup()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Boot timelines taken from the console. A BootProfiler follows the console of a DPU while
+it boots and timestamps every known milestone (UEFI prompt, PXE DHCP, GRUB, kernel, the
+installer, ...) as it shows up. Every boot is saved as a JSON file in PROFILE_DIR,
+labeled with what was booted (e.g. the ISO and firmware version), and compare() shows
+how long each stage took across several of them to spot the one that regressed.
+"""
+
+import dataclasses
+import json
+import os
+import re
+import threading
+import time
+from logger import logger
+from typing import Optional
+from utils.console import ConsoleBase, ConsoleDevice, open_console
+
+PROFILE_DIR = "/var/lib/dpu-tools/boot-profiles"
+
+# How much console output is kept around to match milestones spanning several reads
+WINDOW_SIZE = 4096
+
+# A stage taking this much longer than in the first profile compared is a regression
+REGRESSION_SECONDS = 2.0
+REGRESSION_RATIO = 1.1
+
+
+@dataclasses.dataclass(frozen=True)
+class Milestone:
+    name: str
+    pattern: str
+
+
+PXEBOOT_MILESTONES = [
+    Milestone("uefi_prompt", r"Press.* enter UEFI Menu"),
+    Milestone("pxe_dhcp", r"Station IP address"),
+    Milestone("grub_menu", r"GNU GRUB|Install OS"),
+    Milestone("efi_stub", r"EFI stub: "),
+    Milestone("kernel", r"Linux version"),
+    Milestone("initrd", r"Unpacking initramfs|Freeing initrd memory|Run /init"),
+    Milestone("installer_start", r"Starting installer|ignition\[\d+\]: Ignition \d"),
+    Milestone(
+        "installer_finish", r"Installation complete|Ignition finished successfully"
+    ),
+    Milestone("login", r"login:"),
+]
+
+
+@dataclasses.dataclass
+class BootTimeline:
+    device: str
+    milestones: dict[str, float] = dataclasses.field(default_factory=dict)
+    ready: Optional[float] = None
+    labels: dict[str, str] = dataclasses.field(default_factory=dict)
+
+
+class BootProfiler:
+    """
+    Start it before triggering the boot, so no console output is missed:
+
+        with BootProfiler("BF0", console_device, PXEBOOT_MILESTONES) as profiler:
+            reboot()
+            ...
+        profiler.save()
+    """
+
+    def __init__(
+        self,
+        name: str,
+        console_device: Optional[ConsoleDevice],
+        milestones: list[Milestone],
+        labels: Optional[dict[str, str]] = None,
+    ):
+        self.name = name
+        self.console_device = console_device
+        self.milestones = milestones
+        self.timeline = BootTimeline(name, labels=dict(labels or {}))
+        self.console: Optional[ConsoleBase] = None
+        self.stop_event = threading.Event()
+        self.progress = threading.Condition()
+        self.watcher: Optional[threading.Thread] = None
+        self.start = time.monotonic()
+        self.started_at = time.time()
+
+    def __enter__(self) -> "BootProfiler":
+        self.begin()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.end()
+
+    def begin(self) -> None:
+        self.start = time.monotonic()
+        self.started_at = time.time()
+        if self.console_device is not None:
+            try:
+                self.console = open_console(self.console_device)
+            except (OSError, TimeoutError) as e:
+                logger.info(f"Can't watch the console of {self.name}: {e}")
+        if self.console is not None:
+            self.watcher = threading.Thread(target=self._watch, daemon=True)
+            self.watcher.start()
+
+    def end(self) -> None:
+        self.stop_event.set()
+        if self.watcher is not None:
+            self.watcher.join()
+        if self.console is not None:
+            self.console.close()
+
+    def elapsed(self) -> float:
+        return round(time.monotonic() - self.start, 2)
+
+    def _watch(self) -> None:
+        assert self.console is not None
+        pending = list(self.milestones)
+        window = b""
+        while not self.stop_event.is_set() and pending:
+            try:
+                window += self.console.read_nonblocking(4096, 0.5)
+            except EOFError:
+                logger.info(f"Lost the console of {self.name}")
+                break
+            window = window[-WINDOW_SIZE:]
+            for milestone in list(pending):
+                match = re.search(milestone.pattern.encode(), window)
+                if match is None:
+                    continue
+                # later milestones imply the earlier ones were passed, even if missed
+                pending = pending[pending.index(milestone) + 1 :]
+                window = window[match.end() :]
+                with self.progress:
+                    self.timeline.milestones[milestone.name] = self.elapsed()
+                    self.progress.notify_all()
+                logger.info(f"{self.name}: {milestone.name} after {self.elapsed()}s")
+                break
+
+    def booting(self) -> bool:
+        return bool(self.timeline.milestones)
+
+    def save(self, directory: str = PROFILE_DIR) -> Optional[str]:
+        """Write the timeline to a file of its own, returns its path"""
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+        path = os.path.join(directory, f"{self.name}-{stamp}.json")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(path, "w") as f:
+                entry = {"time": self.started_at, **dataclasses.asdict(self.timeline)}
+                json.dump(entry, f, indent=2)
+        except OSError as e:
+            logger.debug(f"Couldn't save the boot timeline: {e}")
+            return None
+        logger.info(f"Boot timeline saved to {path}")
+        return path
+
+
+def load(path: str) -> BootTimeline:
+    with open(path) as f:
+        entry = json.load(f)
+    return BootTimeline(
+        entry["device"],
+        {k: float(v) for k, v in entry.get("milestones", {}).items()},
+        entry.get("ready"),
+        entry.get("labels", {}),
+    )
+
+
+def latest(count: int, directory: str = PROFILE_DIR) -> list[str]:
+    """The last count timelines saved, oldest first"""
+    try:
+        paths = [os.path.join(directory, n) for n in os.listdir(directory)]
+    except FileNotFoundError:
+        return []
+    paths = [p for p in paths if p.endswith(".json")]
+    return sorted(paths, key=os.path.getmtime)[-count:]
+
+
+def stages(timeline: BootTimeline) -> dict[str, float]:
+    """How long it took to get to every milestone from the one before"""
+    durations = {}
+    previous = 0.0
+    points = list(timeline.milestones.items())
+    if timeline.ready is not None:
+        points.append(("ready", timeline.ready))
+    for name, at in sorted(points, key=lambda p: p[1]):
+        durations[name] = round(at - previous, 2)
+        previous = at
+    return durations
+
+
+def compare(paths: list[str]) -> str:
+    """
+    Table of the stage durations of the given timelines, one column per timeline.
+    Stages that took notably longer than in the first one are marked.
+    """
+    timelines = [load(p) for p in paths]
+    columns = [stages(t) for t in timelines]
+    names: list[str] = []
+    for column in columns:
+        names += [n for n in column if n not in names]
+
+    headers = [os.path.basename(p).rsplit(".", 1)[0] for p in paths]
+    lines = ["stage".ljust(18) + "".join(h[-24:].rjust(26) for h in headers)]
+    for name in names + ["total"]:
+        row = name.ljust(18)
+        base = columns[0].get(name) if name != "total" else sum(columns[0].values())
+        for column in columns:
+            value = column.get(name) if name != "total" else sum(column.values())
+            if value is None:
+                row += "-".rjust(26)
+                continue
+            cell = f"{value:.1f}s"
+            if (
+                base is not None
+                and column is not columns[0]
+                and value - base > REGRESSION_SECONDS
+                and value > base * REGRESSION_RATIO
+            ):
+                cell = f"(+{value - base:.1f}s) {cell}"
+            row += cell.rjust(26)
+        lines.append(row)
+    for header, t in zip(headers, timelines):
+        if t.labels:
+            labels = ", ".join(f"{k}={v}" for k, v in sorted(t.labels.items()))
+            lines.append(f"{header}: {labels}")
+    return "\n".join(lines)
@@ -1,14 +1,25 @@
 import subprocess
 from logger import logger
-from typing import IO
-import requests
+from typing import IO, Callable, Iterable, Optional, TypeVar, cast
 import tarfile
+import shutil
 import os
 import re
 import dataclasses
 import threading
+import time
 
 from enum import Enum
+from utils.progress import ProgressParser
+
+# Options for every ssh to a DPU. Connections are multiplexed over a master that stays
+# around for a while, so consecutive commands to the same host skip the handshake.
+# Keepalives make sure a master to a host that rebooted is noticed quickly.
+SSH_OPTIONS = (
+    "-o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null'"
+    " -o ControlMaster=auto -o 'ControlPath=/tmp/dpu-tools-ssh-%C' -o ControlPersist=600"
+    " -o ServerAliveInterval=5 -o ServerAliveCountMax=3"
+)
 
 
 class DPUType(Enum):
@@ -24,10 +35,16 @@ class Result:
     returncode: int
 
 
-def run(command: str, capture_output: bool = True, dry_run: bool = False) -> Result:
+def run(
+    command: str,
+    capture_output: bool = True,
+    dry_run: bool = False,
+    progress: Optional[ProgressParser] = None,
+) -> Result:
     """
     This run command is able to both output to the screen and capture its respective stream into a Result, using multithreading
     to avoid the blocking operaton that comes from reading from both pipes and outputing in real time.
+    Output lines showing progress are handed to the progress parser instead of being logged.
     """
     if dry_run:
         logger.info(f"[DRY RUN] Command: {command}")
@@ -43,10 +60,9 @@ def run(command: str, capture_output: bool = True, dry_run: bool = False) -> Res
     )
 
     def stream_output(pipe: IO[str], buffer: list[str], stream_type: str) -> None:
+        # universal newlines also split the \r separated updates of progress output
         for line in iter(pipe.readline, ""):
-            if stream_type == "stdout":
-                logger.debug(line.strip())
-            else:
+            if progress is None or not progress.feed(line):
                 logger.debug(line.strip())
 
             if capture_output:
@@ -73,6 +89,8 @@ def run(command: str, capture_output: bool = True, dry_run: bool = False) -> Res
     process.wait()
     stdout_thread.join()
     stderr_thread.join()
+    if progress is not None:
+        progress.finish()
 
     # Avoid joining operation if the output isn't captured
     if capture_output:
@@ -89,6 +107,8 @@ def download_file(url: str, dest_dir: str) -> str:
     """
     Download a file from the given URL and save it to the destination directory.
     """
+    import requests
+
     local_filename = os.path.join(dest_dir, url.split("/")[-1])
     with requests.get(url, stream=True) as r:
         r.raise_for_status()
@@ -99,15 +119,39 @@ def download_file(url: str, dest_dir: str) -> str:
     return local_filename
 
 
-def extract_tar_gz(tar_path: str, extract_dir: str) -> list[str]:
+def fetch(url: str) -> bytes:
     """
-    Extract a .tar.gz file and return the list of all extracted files.
+    Download a (small) file from the given URL and return its contents.
     """
-    extracted_files = []
-    with tarfile.open(tar_path, "r:gz") as tar:
-        tar.extractall(path=extract_dir)
-        extracted_files = [os.path.join(extract_dir, name) for name in tar.getnames()]
-    return extracted_files
+    import requests
+
+    r = requests.get(url)
+    r.raise_for_status()
+    return r.content
+
+
+def extract_member(
+    tar_path: str, extract_dir: str, name_prefix: str, identifier: str = ""
+) -> str:
+    """
+    Stream through a .tar.gz file and extract the first file whose name contains both
+    name_prefix and identifier, without unpacking anything else. Return its path.
+    """
+    with tarfile.open(tar_path, "r|gz") as tar:
+        for member in tar:
+            name = os.path.basename(member.name)
+            if not member.isfile() or name_prefix not in name or identifier not in name:
+                continue
+            src = tar.extractfile(member)
+            if src is None:
+                continue
+            path = os.path.join(extract_dir, name)
+            with src, open(path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            return path
+    raise FileNotFoundError(
+        f"{name_prefix} with identifier {identifier} not found in {tar_path}."
+    )
 
 
 def find_bus_pci_address(address: str) -> str:
@@ -123,31 +167,73 @@ def find_bus_pci_address(address: str) -> str:
         return "Invalid PCI address format"
 
 
+# The lspci and lshw scans are kept around for a while, so that a command only runs them
+# once however many lookups it does. The daemon (see utils/daemon.py) refreshes them in
+# the background, so the commands it runs don't scan at all.
+INVENTORY_TTL = 60
+_scans: dict[str, tuple[float, object]] = {}
+
+T = TypeVar("T")
+
+
+def _cached(name: str, scan: Callable[[], T], refresh: bool = False) -> T:
+    cached = _scans.get(name)
+    if not refresh and cached is not None:
+        if time.monotonic() - cached[0] < INVENTORY_TTL:
+            return cast(T, cached[1])
+    value = scan()
+    _scans[name] = (time.monotonic(), value)
+    return value
+
+
+def refresh_inventory() -> None:
+    """Scan again, whether or not what's kept around is still recent"""
+    _cached("lspci", _lspci_dpus, refresh=True)
+    _cached("lshw", _lshw_network, refresh=True)
+
+
+def lspci_dpus() -> list[tuple[str, str]]:
+    """(bus PCI address, kind) of every DPU"""
+    return list(_cached("lspci", _lspci_dpus))
+
+
+def lshw_network() -> list[str]:
+    """The lines of "lshw -c network -businfo" """
+    return list(_cached("lshw", _lshw_network))
+
+
 def scan_for_dpus() -> dict[str, tuple[str, str]]:
+    dpus = lspci_dpus()
+    if not dpus:
+        return {}
     devs = {}
+    lshw = lshw_network()
+    for addr, kind in dpus:
+        for line in lshw:
+            if addr in line:
+                dev = line.split()[1]
+                devs[dev] = (addr, kind)
+    return devs
+
+
+def _lspci_dpus() -> list[tuple[str, str]]:
+    dpus = []
     for e in run("lspci", capture_output=True).out.split("\n"):
         if "Intel Corporation Device 145" in e:
-            addr = find_bus_pci_address(e.split()[0])
-            for line in run("lshw -c network -businfo", capture_output=True).out.split(
-                "\n"
-            ):
-                if addr in line:
-                    dev = line.split()[1]
-                    devs[dev] = (addr, "IPU")
+            dpus.append((find_bus_pci_address(e.split()[0]), "IPU"))
         if "BlueField" in e:
-            addr = find_bus_pci_address(e.split()[0])
-            for line in run("lshw -c network -businfo", capture_output=True).out.split(
-                "\n"
-            ):
-                if addr in line:
-                    dev = line.split()[1]
-                    devs[dev] = (addr, "BF")
-    return devs
+            dpus.append((find_bus_pci_address(e.split()[0]), "BF"))
+    return dpus
+
+
+def _lshw_network() -> list[str]:
+    # lshw is slow, it's run once for all lookups
+    return run("lshw -c network -businfo", capture_output=True).out.split("\n")
 
 
 def detect_dpu_type() -> Result:
-    devs = scan_for_dpus()
-    kinds = {kind for (_, (_, kind)) in devs.items()}
+    # the netdevs don't matter here, so skip lshw
+    kinds = {kind for (_, kind) in lspci_dpus()}
     if len(kinds) > 1:
         return Result(
             "",
@@ -168,6 +254,8 @@ def list_http_directory(url: str) -> list[str]:
     """
     Fetch the directory listing from an HTTP server.
     """
+    import requests
+
     response = requests.get(url)
     response.raise_for_status()
     # Use a simple regex to extract links
@@ -179,6 +267,79 @@ def ssh_run(cmd: str, address: str, dry_run: bool) -> Result:
     Takes a command and runs it on the remote location
     """
     return run(
-        f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {address} '{cmd}'",
+        f"ssh {SSH_OPTIONS} {address} '{cmd}'",
         dry_run=dry_run,
     )
+
+
+def ssh_write(
+    cmd: str,
+    address: str,
+    chunks: Iterable[bytes],
+    dry_run: bool = False,
+    progress: Optional[ProgressParser] = None,
+) -> Result:
+    """
+    Runs a command on the remote location with the given data streamed into its stdin,
+    its stderr is fed to the progress parser as it comes in
+    """
+    command = f"ssh {SSH_OPTIONS} {address} '{cmd}'"
+    if dry_run:
+        logger.info(f"[DRY RUN] Command: {command} < (image data)")
+        return Result("", "", 0)
+
+    logger.debug(f"Executing: {command}")
+    process = subprocess.Popen(
+        command,
+        shell=True,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    assert process.stdin is not None
+    output: dict[str, bytes] = {}
+    complete = False
+
+    def collect(pipe: IO[bytes], name: str) -> None:
+        data = b""
+        pending = b""
+        while True:
+            more = os.read(pipe.fileno(), 65536)
+            if not more:
+                break
+            data += more
+            if progress is not None and name == "err":
+                *lines, pending = re.split(rb"[\r\n]", pending + more)
+                for line in lines:
+                    progress.feed(line.decode(errors="replace"))
+        output[name] = data
+        pipe.close()
+
+    threads = [
+        threading.Thread(target=collect, args=(process.stdout, "out")),
+        threading.Thread(target=collect, args=(process.stderr, "err")),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for chunk in chunks:
+            process.stdin.write(chunk)
+        complete = True
+    except BrokenPipeError:
+        logger.error(f"{command} exited before all data was written")
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    process.wait()
+    for thread in threads:
+        thread.join()
+    if progress is not None:
+        progress.finish()
+
+    return Result(
+        output["out"].decode(errors="replace"),
+        output["err"].decode(errors="replace"),
+        process.returncode if complete else process.returncode or 1,
+    )
@@ -1,12 +1,13 @@
+import concurrent.futures
 import dataclasses
 from logger import logger
-import os
 import sys
 import argparse
-import requests
 import time
 from typing import Optional
-from utils.common import run
+from utils.common import lshw_network, run
+from utils.console import bf_console_device, open_console
+from utils.devlink import info_all
 
 
 @dataclasses.dataclass(frozen=True)
@@ -17,9 +18,8 @@ class Result:
 
 
 def all_interfaces() -> dict[str, str]:
-    out = run("lshw -c network -businfo").out
     ret = {}
-    for e in out.split("\n")[2:]:
+    for e in lshw_network()[2:]:
         e = e.strip()
         if not e:
             continue
@@ -36,6 +36,21 @@ def find_bf_pci_addresses() -> list[str]:
     return [k.split("@")[1] for k, v in bfs]
 
 
+def find_bf_devices() -> dict[int, str]:
+    """
+    One PCI function of every BF by its BF id. Every BF has two (and the ids count
+    both), but settings like the mode and the firmware are shared by the whole device.
+    """
+    devices = {}
+    buses = set()
+    for bf_id, pci in enumerate(find_bf_pci_addresses()):
+        bus = pci.rsplit(":", 1)[0]
+        if bus not in buses:
+            buses.add(bus)
+            devices[bf_id] = pci
+    return devices
+
+
 def find_bf_pci_addresses_or_quit(bf_id: int) -> str:
     bf_pci = find_bf_pci_addresses()
     if not bf_pci:
@@ -65,9 +80,44 @@ def mst_flint(pci: str) -> dict[str, str]:
     return ret
 
 
+def _devlink_fw_info(pcis: list[str]) -> dict[str, dict[str, str]]:
+    try:
+        devices = info_all()
+    except OSError as e:
+        logger.debug(f"devlink isn't available: {e}")
+        return {}
+    ret = {}
+    for pci in pcis:
+        info = devices.get(pci)
+        if info is None:
+            continue
+        # mstflint's FW Version is the one burnt on the flash, running until a reset
+        version = info.stored.get("fw.version") or info.running.get("fw.version")
+        psid = info.fixed.get("fw.psid")
+        if version and psid:
+            ret[pci] = {"FW Version": version, "PSID": psid}
+    return ret
+
+
+def query_fw_info(pcis: list[str]) -> list[dict[str, str]]:
+    """
+    FW Version and PSID of the given BFs, as mstflint reports them. Read from devlink for
+    all of them at once, mstflint is only run (in parallel) for those devlink can't tell.
+    """
+    known = _devlink_fw_info(pcis)
+    missing = [pci for pci in pcis if pci not in known]
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(len(missing)) as executor:
+            known.update(zip(missing, executor.map(mst_flint, missing)))
+    return [known[pci] for pci in pcis]
+
+
+def fw_info(pci: str) -> dict[str, str]:
+    return query_fw_info([pci])[0]
+
+
 def bf_version(pci: str) -> Optional[int]:
-    out = run("lshw -c network -businfo").out
-    for e in out.split("\n"):
+    for e in lshw_network():
         if not e.startswith(f"pci@{pci}"):
             continue
         return int(e.split("BlueField-")[1].split()[0])
@@ -76,93 +126,132 @@ def bf_version(pci: str) -> Optional[int]:
 
 def console_bf(args: argparse.Namespace) -> None:
     _ = find_bf_pci_addresses_or_quit(args.bf_id)
-    os.system(
-        f"minicom --color on --baudrate 115200 --device /dev/rshim{args.bf_id//2}/console"
-    )
-
+    with open_console(bf_console_device(args.bf_id), replay=True) as console:
+        console.interact()
 
-def bf_get_mode(id: int, should_next_boot: bool) -> None:
-    bf = find_bf_pci_addresses_or_quit(id)
 
-    cfg = [
-        "INTERNAL_CPU_MODEL",
-        "INTERNAL_CPU_PAGE_SUPPLIER",
-        "INTERNAL_CPU_ESWITCH_MANAGER",
-        "INTERNAL_CPU_IB_VPORT0",
-        "INTERNAL_CPU_OFFLOAD_ENGINE",
-    ]
-    all_cfg = " ".join(cfg)
-    ret = run(f"mstconfig -e -d {bf} q {all_cfg}", capture_output=True).out
+MODE_KEYS = [
+    "INTERNAL_CPU_MODEL",
+    "INTERNAL_CPU_PAGE_SUPPLIER",
+    "INTERNAL_CPU_ESWITCH_MANAGER",
+    "INTERNAL_CPU_IB_VPORT0",
+    "INTERNAL_CPU_OFFLOAD_ENGINE",
+]
 
-    save_next = False
-    settings = {}
-    for e in ret.split("\n"):
-        if not e:
-            continue
-        if e.startswith("Configurations:"):
-            save_next = True
-        elif save_next:
-            if "different from default/current" in e:
-                save_next = False
-                continue
-            k, default, current, next_boot = e.lstrip("*").split()
-            config = next_boot if should_next_boot else current
-            settings[k] = config.split("(")[1].split(")")[0]
-
-    dpu_mode = {
+MODES = {
+    "dpu": {
         "INTERNAL_CPU_MODEL": "1",
         "INTERNAL_CPU_PAGE_SUPPLIER": "0",
         "INTERNAL_CPU_ESWITCH_MANAGER": "0",
         "INTERNAL_CPU_IB_VPORT0": "0",
         "INTERNAL_CPU_OFFLOAD_ENGINE": "0",
-    }
-
-    nic_mode = {
+    },
+    "nic": {
         "INTERNAL_CPU_MODEL": "1",
         "INTERNAL_CPU_PAGE_SUPPLIER": "1",
         "INTERNAL_CPU_ESWITCH_MANAGER": "1",
         "INTERNAL_CPU_IB_VPORT0": "1",
         "INTERNAL_CPU_OFFLOAD_ENGINE": "1",
-    }
+    },
+}
 
-    if dpu_mode == settings:
-        logger.info("dpu")
-    elif nic_mode == settings:
-        logger.info("nic")
-    else:
-        logger.info("unknown")
-    logger.debug(settings)
 
+@dataclasses.dataclass(frozen=True)
+class ModeConfig:
+    pci: str
+    current: dict[str, str]
+    next_boot: dict[str, str]
 
-def bf_set_mode(id: int, mode: str) -> None:
-    bf = find_bf_pci_addresses_or_quit(id)
+    def mode(self, next_boot: bool = False) -> str:
+        settings = self.next_boot if next_boot else self.current
+        for name, values in MODES.items():
+            if settings == values:
+                return name
+        return "unknown"
 
-    dpu_mode = {
-        "INTERNAL_CPU_MODEL": "EMBEDDED_CPU(1)",
-        "INTERNAL_CPU_PAGE_SUPPLIER": "ECPF(0)",
-        "INTERNAL_CPU_ESWITCH_MANAGER": "ECPF(0)",
-        "INTERNAL_CPU_IB_VPORT0": "ECPF(0)",
-        "INTERNAL_CPU_OFFLOAD_ENGINE": "ENABLED(0)",
-    }
+    def diff(self, mode: str) -> dict[str, str]:
+        """The keys that need to be written for the next boot to be in mode"""
+        return {k: v for k, v in MODES[mode].items() if self.next_boot.get(k) != v}
 
-    nic_mode = {
-        "INTERNAL_CPU_MODEL": "EMBEDDED_CPU(1)",
-        "INTERNAL_CPU_PAGE_SUPPLIER": "ECPF(1)",
-        "INTERNAL_CPU_ESWITCH_MANAGER": "ECPF(1)",
-        "INTERNAL_CPU_IB_VPORT0": "ECPF(1)",
-        "INTERNAL_CPU_OFFLOAD_ENGINE": "ENABLED(1)",
-    }
 
-    settings = dpu_mode if mode == "dpu" else nic_mode
+def query_mode(pci: str) -> ModeConfig:
+    ret = run(f"mstconfig -e -d {pci} q {' '.join(MODE_KEYS)}", capture_output=True).out
 
-    joined = ""
-    for k, v in settings.items():
-        value = v[-3:].strip("()")
-        joined += f"{k}={value} "
-    run(f"mstconfig -y -d {bf} s {joined}")
+    save_next = False
+    current = {}
+    next_boot = {}
+    for e in ret.split("\n"):
+        if not e:
+            continue
+        if e.startswith("Configurations:"):
+            save_next = True
+        elif save_next:
+            if "different from default/current" in e:
+                save_next = False
+                continue
+            k, default, cur, nxt = e.lstrip("*").split()
+            current[k] = cur.split("(")[1].split(")")[0]
+            next_boot[k] = nxt.split("(")[1].split(")")[0]
+    return ModeConfig(pci, current, next_boot)
+
+
+def query_modes(pcis: list[str]) -> list[ModeConfig]:
+    """Current and next boot mode config of all the given BFs, queried in parallel"""
+    with concurrent.futures.ThreadPoolExecutor(max(1, len(pcis))) as executor:
+        return list(executor.map(query_mode, pcis))
+
+
+def selected_bfs(id: int, all_bfs: bool) -> list[str]:
+    if all_bfs:
+        bfs = list(find_bf_devices().values())
+        if not bfs:
+            print("No BF found")
+            sys.exit(-1)
+        return bfs
+    return [find_bf_pci_addresses_or_quit(id)]
+
+
+def bf_get_mode(id: int, should_next_boot: bool, all_bfs: bool = False) -> None:
+    for config in query_modes(selected_bfs(id, all_bfs)):
+        mode = config.mode(should_next_boot)
+        logger.info(f"{config.pci}: {mode}" if all_bfs else mode)
+        logger.debug(config.next_boot if should_next_boot else config.current)
+
+
+def bf_set_mode(id: int, mode: str, all_bfs: bool = False) -> list[str]:
+    """
+    Only the keys whose next boot value differs from mode are written, so BFs that are
+    already (going to be) in that mode are left alone. Returns the BFs that were changed.
+    """
+    return stage_modes(query_modes(selected_bfs(id, all_bfs)), mode)
+
+
+def stage_modes(configs: list[ModeConfig], mode: str) -> list[str]:
+    """Write what differs from mode for the next boot of the BFs, in parallel"""
+
+    def apply(config: ModeConfig) -> bool:
+        diff = config.diff(mode)
+        if not diff:
+            if config.mode() != mode:
+                logger.info(
+                    f"{config.pci} is already set to {mode}, it takes effect after a firmware reset"
+                )
+            else:
+                logger.info(f"{config.pci} is already in {mode} mode")
+            return False
+        joined = " ".join(f"{k}={v}" for k, v in diff.items())
+        logger.info(f"{config.pci}: setting {joined}")
+        run(f"mstconfig -y -d {config.pci} s {joined}")
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, len(configs))) as executor:
+        changed = list(executor.map(apply, configs))
+    return [c.pci for c, was_changed in zip(configs, changed) if was_changed]
 
 
 def download_bfb(id: int) -> None:
+    import requests
+
     _ = find_bf_pci_addresses_or_quit(id)
 
     bfb_image = "DOCA_2.0.2_BSP_4.0.3_Ubuntu_22.04-8.23-04.prod.bfb"
@@ -1,28 +1,24 @@
 from logger import logger
-import os
+import queue
 import re
-import pexpect
+import threading
 import time
 import argparse
-from utils.minicom import configure_minicom, pexpect_child_wait, minicom_cmd
-from utils.common import Result, run
+from typing import Optional
+from utils.console import ipu_console_device, open_console
+from utils.common import SSH_OPTIONS, Result, run
 
 VERSIONS = ["1.2.0.7550", "1.6.2.9418", "1.8.0.10052", "2.0.0.11126"]
 
 
-def find_image(
-    extracted_files: list[str], bin_file_prefix: str, identifier: str = ""
-) -> str:
-    """
-    Search through extracted files to find the binary file matching the prefix and identifier.
-    """
-    for root, _, files in os.walk(extracted_files[0]):  # Traverse directory
-        for file in files:
-            if bin_file_prefix in file and identifier in file:
-                return os.path.join(root, file)
-    raise FileNotFoundError(
-        f"{bin_file_prefix} with identifier {identifier} not found in the extracted files."
-    )
+# Deadline for both version probes, the serial one needs a bit longer to get a prompt
+SSH_PROBE_TIMEOUT = 5
+CONSOLE_PROBE_TIMEOUT = 15
+# How long ssh gets to answer before the serial console is tried too. The console is
+# shared (see utils/console.py), so it's only typed into when ssh doesn't answer.
+SSH_HEAD_START = 2
+
+_probed_versions: dict[str, str] = {}
 
 
 def get_current_version(imc_address: str, dry_run: bool = False) -> Result:
@@ -30,7 +26,7 @@ def get_current_version(imc_address: str, dry_run: bool = False) -> Result:
     version = ""
     # Execute the commands over SSH with dry_run handling
     result = run(
-        f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {imc_address} 'cat /etc/issue.net'",
+        f"ssh {SSH_OPTIONS} -o ConnectTimeout={SSH_PROBE_TIMEOUT} {imc_address} 'cat /etc/issue.net'",
         dry_run=dry_run,
         capture_output=True,
     )
@@ -45,30 +41,31 @@ def get_current_version(imc_address: str, dry_run: bool = False) -> Result:
     return Result(version, result.err, result.returncode)
 
 
-def minicom_get_version() -> str:
+def console_get_version(
+    timeout: float = 120, stop: Optional[threading.Event] = None
+) -> str:
+    """
+    Version shown by the IMC over its serial console. Nothing is typed once stop is set,
+    and the command is only typed at a shell, a login prompt would take it as user name.
+    """
     version = ""
-    run("pkill -9 minicom")
-    logger.debug("Configuring minicom")
-    configure_minicom()
-    logger.debug("spawn minicom")
-    child = pexpect.spawn(minicom_cmd("imc"))
-    child.maxread = 10000
-    pexpect_child_wait(child, ".*Press CTRL-A Z for help on special keys.*", 120)
-    logger.debug("Ready to enter command")
-    child.sendline("cat /etc/issue.net")
-
-    # Wait for the expected response (adjust the timeout as needed)
-
-    try:
-        pexpect_child_wait(child, ".*IPU IMC.*", 120)
-    except Exception as e:
-        raise e
-
-    # Capture and print the output
-    assert child.before is not None
-    logger.debug(child.before.decode("utf-8"))
-    logger.debug(child.after.decode("utf-8"))
-    version_line = child.after.decode("utf-8")
+    with open_console(ipu_console_device("imc")) as console:
+        if stop is not None and stop.is_set():
+            return ""
+        console.sendline()
+        console.expect(r"(login:|[#$]) *$", timeout)
+        if b"login" in console.after:
+            logger.debug("The IMC console is at a login prompt, can't get the version")
+            return ""
+        if stop is not None and stop.is_set():
+            return ""
+        logger.debug("Ready to enter command")
+        console.sendline("cat /etc/issue.net")
+        console.expect(".*IPU IMC.*", timeout)
+
+        logger.debug(console.before.decode("utf-8", errors="replace"))
+        logger.debug(console.after.decode("utf-8", errors="replace"))
+        version_line = console.after.decode("utf-8", errors="replace")
 
     # Regular expression to match the full version (e.g., 1.8.0.10052)
     version_pattern = r"\d+\.\d+\.\d+\.\d+"
@@ -78,55 +75,69 @@ def minicom_get_version() -> str:
 
     if match:
         version = match.group(0)
-
-    # Gracefully close Picocom (equivalent to pressing Ctrl-A and Ctrl-X)
-    child.sendcontrol("a")
-    child.sendline("x")
-    # Ensure Picocom closes properly
-    child.expect(pexpect.EOF)
     return version
 
 
-def check_connectivity(
-    address: str,
-    capture_output: bool = False,
-    dry_run: bool = False,
-    retries: int = 3,
-    delay: int = 2,
-) -> bool:
+def probe_version(imc_address: str) -> str:
     """
-    Checks connectivity to the specified address by performing a ping, with retry capability.
+    Version running on the IMC, or an empty string if it couldn't be found.
+    SSH gets a head start, the serial console is only tried if ssh hasn't answered by
+    then, and the first answer wins. Nothing is typed into the console after that.
+    The result is kept for the rest of the run, so the IMC is only probed once.
     """
-    # Extract hostname if address is in the form user@hostname
-    if "@" in address:
-        host = address.split("@")[-1]
-    else:
-        host = address
-
-    # Attempt to ping with retry logic
-    for attempt in range(1, retries + 1):
-        result = run(
-            f"ping -c 1 -W 1 {host}", capture_output=capture_output, dry_run=dry_run
-        )
-
-        if result.returncode == 0:
-            logger.debug(f"{host} is reachable.")
-            return True
+    if imc_address in _probed_versions:
+        return _probed_versions[imc_address]
+
+    answers: queue.Queue[tuple[str, str]] = queue.Queue()
+    answered = threading.Event()
+
+    def ssh_probe() -> None:
+        result = get_current_version(imc_address)
+        if result.returncode:
+            logger.debug(f"Version probe over ssh failed: {result.err.strip()}")
+        answers.put(("ssh", result.out))
+
+    def console_probe() -> None:
+        version = ""
+        try:
+            version = console_get_version(CONSOLE_PROBE_TIMEOUT, answered)
+        except Exception as e:
+            logger.debug(f"Version probe over the console failed: {e}")
+        answers.put(("console", version))
+
+    # daemon threads, the probe that loses the race is simply left behind
+    threading.Thread(target=ssh_probe, daemon=True).start()
+    pending = 1
+    console_started = False
+    head_start = time.monotonic() + SSH_HEAD_START
+    deadline = time.monotonic() + max(SSH_PROBE_TIMEOUT, CONSOLE_PROBE_TIMEOUT) + 5
+    version = ""
+    while pending:
+        until = deadline if console_started else head_start
+        timeout = max(0, until - time.monotonic())
+        try:
+            source, answer = answers.get(timeout=timeout)
+        except queue.Empty:
+            if time.monotonic() >= deadline:
+                break
+            source, answer = "", ""
         else:
-            logger.debug(f"Attempt {attempt} to reach {host} failed.")
-            if attempt < retries:
-                logger.debug(f"Retrying in {delay} seconds...")
-                time.sleep(delay)
-
-    logger.debug(f"Failed to reach {host} after {retries} attempts.")
-    return False
+            pending -= 1
+        if answer:
+            logger.debug(f"Got version {answer} over {source}")
+            version = answer
+            break
+        if not console_started:
+            # ssh is slow or failed, the console is tried next to it
+            console_started = True
+            threading.Thread(target=console_probe, daemon=True).start()
+            pending += 1
+    answered.set()
+
+    _probed_versions[imc_address] = version
+    return version
 
 
 def console_ipu(args: argparse.Namespace) -> None:
-    if args.target == "imc":
-        minicom_cmd = "minicom -b 460800 -D /dev/ttyUSB2"
-    else:
-        minicom_cmd = "minicom -b 115200 -D /dev/ttyUSB0"
-
-    with configure_minicom():
-        os.system(minicom_cmd)
+    with open_console(ipu_console_device(args.target), replay=True) as console:
+        console.interact()
@@ -0,0 +1,327 @@
+import dataclasses
+import os
+import re
+import select
+import socket
+import subprocess
+import sys
+import termios
+import time
+import tty
+from abc import ABC, abstractmethod
+from logger import logger
+from typing import Any, Optional, TypeVar, Union
+
+BAUDRATES = {
+    9600: termios.B9600,
+    115200: termios.B115200,
+    460800: termios.B460800,
+}
+
+# Ctrl-], same as telnet
+ESCAPE_CHAR = b"\x1d"
+
+# Upper bound on how much unmatched output is kept around for expect()
+MAX_BUFFER = 1024 * 1024
+
+# Every console is owned by a broker process listening on a socket in here
+SOCKET_DIR = "/run/dpu-tools"
+
+# Sent by subscribers right after connecting to the broker
+ATTACH_REPLAY = b"R"
+ATTACH_LIVE = b"L"
+
+ConsoleT = TypeVar("ConsoleT", bound="ConsoleBase")
+
+
+@dataclasses.dataclass(frozen=True)
+class ConsoleDevice:
+    path: str
+    baudrate: int
+
+
+def ipu_console_device(target: str) -> ConsoleDevice:
+    if target == "imc":
+        return ConsoleDevice("/dev/ttyUSB2", 460800)
+    return ConsoleDevice("/dev/ttyUSB0", 115200)
+
+
+def bf_console_device(bf_id: int) -> ConsoleDevice:
+    return ConsoleDevice(f"/dev/rshim{bf_id//2}/console", 115200)
+
+
+def socket_path(device: ConsoleDevice) -> str:
+    name = device.path.strip("/").replace("/", "-")
+    return os.path.join(SOCKET_DIR, f"console-{name}.sock")
+
+
+class ConsoleBase(ABC):
+    """
+    expect/send helpers shared by the tty itself and by the subscribers of a broker.
+    """
+
+    def __init__(self, device: ConsoleDevice):
+        self.device = device
+        self.buffer = b""
+        self.before = b""
+        self.after = b""
+
+    def __enter__(self: ConsoleT) -> ConsoleT:
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+    @abstractmethod
+    def fileno(self) -> int:
+        pass
+
+    @abstractmethod
+    def close(self) -> None:
+        pass
+
+    @abstractmethod
+    def send(self, data: Union[str, bytes]) -> None:
+        pass
+
+    @abstractmethod
+    def _read(self, size: int) -> bytes:
+        """Read once, fileno() has been reported readable by select()."""
+        pass
+
+    def sendline(self, line: str = "") -> None:
+        self.send(line + "\n")
+
+    def read_nonblocking(self, size: int = 1024, timeout: float = 0) -> bytes:
+        """
+        Read whatever is available (up to size bytes), waiting at most timeout seconds.
+        Returns an empty string if nothing arrived in time.
+        """
+        ready, _, _ = select.select([self.fileno()], [], [], timeout)
+        if not ready:
+            return b""
+        try:
+            data = self._read(size)
+        except BlockingIOError:
+            return b""
+        if not data:
+            raise EOFError(f"Console {self.device.path} was closed")
+        return data
+
+    def clear_buffer(self) -> None:
+        """Drop everything received so far, including what's still pending on the device."""
+        while self.read_nonblocking(4096):
+            pass
+        self.buffer = b""
+
+    def expect(self, pattern: str, timeout: float) -> float:
+        """
+        Wait until pattern shows up in the console output. Like pexpect, '.' also matches
+        newlines. On success, before/after hold the output preceding and matching the pattern.
+        Returns the time it took in seconds, raises TimeoutError otherwise.
+        """
+        logger.debug(f"Waiting {timeout} sec for pattern '{pattern}'")
+        regex = re.compile(pattern.encode("utf-8"), re.DOTALL)
+        start_time = time.monotonic()
+        deadline = start_time + timeout
+        while True:
+            match = regex.search(self.buffer)
+            if match:
+                self.before = self.buffer[: match.start()]
+                self.after = match.group(0)
+                self.buffer = self.buffer[match.end() :]
+                return round(time.monotonic() - start_time, 2)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"Timed out after {timeout}s waiting for pattern '{pattern}'"
+                )
+            self.buffer += self.read_nonblocking(4096, remaining)
+            self.buffer = self.buffer[-MAX_BUFFER:]
+
+    def interact(self) -> None:
+        """Connect the console to the local terminal until Ctrl-] is pressed."""
+        stdin = sys.stdin.fileno()
+        stdout = sys.stdout.fileno()
+        old_attrs: Optional[list[Any]] = None
+        if os.isatty(stdin):
+            old_attrs = termios.tcgetattr(stdin)
+            tty.setraw(stdin)
+        print(f"Connected to {self.device.path}, press Ctrl-] to exit\r")
+        try:
+            if self.buffer:
+                os.write(stdout, self.buffer)
+                self.buffer = b""
+            while True:
+                ready, _, _ = select.select([stdin, self.fileno()], [], [])
+                if self.fileno() in ready:
+                    os.write(stdout, self.read_nonblocking(4096))
+                if stdin in ready:
+                    data = os.read(stdin, 1024)
+                    if not data:
+                        break
+                    if ESCAPE_CHAR in data:
+                        self.send(data.split(ESCAPE_CHAR)[0])
+                        break
+                    self.send(data)
+        finally:
+            if old_attrs is not None:
+                termios.tcsetattr(stdin, termios.TCSADRAIN, old_attrs)
+            print()
+
+
+class Console(ConsoleBase):
+    """
+    Talks to a serial (or rshim) console directly through the tty, replacing the
+    minicom + pexpect combination. The device is put in raw mode at the given baudrate
+    with both hardware and software flow control disabled.
+    """
+
+    def __init__(self, device: ConsoleDevice):
+        super().__init__(device)
+        logger.debug(f"Opening console {device.path} at {device.baudrate} baud")
+        self.fd = os.open(device.path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        self._configure()
+
+    def _configure(self) -> None:
+        try:
+            attrs = termios.tcgetattr(self.fd)
+        except termios.error:
+            # The rshim console isn't always backed by a real tty, nothing to set up then
+            logger.debug(f"{self.device.path} is not a tty, skipping line setup")
+            return
+
+        iflag, oflag, cflag, lflag, _, _, cc = attrs
+        iflag &= ~(
+            termios.IGNBRK
+            | termios.BRKINT
+            | termios.PARMRK
+            | termios.ISTRIP
+            | termios.INLCR
+            | termios.IGNCR
+            | termios.ICRNL
+            | termios.IXON
+            | termios.IXOFF
+            | termios.IXANY
+        )
+        oflag &= ~termios.OPOST
+        lflag &= ~(
+            termios.ECHO
+            | termios.ECHONL
+            | termios.ICANON
+            | termios.ISIG
+            | termios.IEXTEN
+        )
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB | termios.CRTSCTS)
+        cflag |= termios.CS8 | termios.CLOCAL | termios.CREAD
+        cc[termios.VMIN] = 0
+        cc[termios.VTIME] = 0
+        speed = BAUDRATES[self.device.baudrate]
+        termios.tcsetattr(
+            self.fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc]
+        )
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def send(self, data: Union[str, bytes]) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        while data:
+            try:
+                written = os.write(self.fd, data)
+            except BlockingIOError:
+                select.select([], [self.fd], [])
+                continue
+            data = data[written:]
+
+    def _read(self, size: int) -> bytes:
+        return os.read(self.fd, size)
+
+
+class ConsoleClient(ConsoleBase):
+    """
+    A subscriber of the broker owning the console (see utils/console_broker.py).
+    Any number of them can be attached to the same console at the same time.
+    """
+
+    def __init__(self, device: ConsoleDevice, sock: socket.socket):
+        super().__init__(device)
+        self.sock = sock
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def send(self, data: Union[str, bytes]) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.sock.sendall(data)
+
+    def _read(self, size: int) -> bytes:
+        return self.sock.recv(size)
+
+
+def _connect(path: str) -> Optional[socket.socket]:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+
+def _spawn_broker(device: ConsoleDevice) -> None:
+    os.makedirs(SOCKET_DIR, exist_ok=True)
+    log_path = socket_path(device).replace(".sock", ".log")
+    logger.debug(f"Starting console broker for {device.path}, logging to {log_path}")
+    with open(log_path, "a") as log:
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "utils.console_broker",
+                device.path,
+                str(device.baudrate),
+            ],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+
+
+def open_console(
+    device: ConsoleDevice, replay: bool = False, timeout: float = 10
+) -> ConsoleClient:
+    """
+    Attach to the broker of the given console, starting it if nobody did so yet.
+    With replay, the recent console output is sent first, otherwise only new output is seen.
+    """
+    path = socket_path(device)
+    sock = _connect(path)
+    if sock is None:
+        if not os.path.exists(device.path):
+            raise FileNotFoundError(f"Console {device.path} doesn't exist")
+        _spawn_broker(device)
+        deadline = time.monotonic() + timeout
+        while sock is None:
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f"Console broker for {device.path} didn't come up in {timeout}s"
+                )
+            time.sleep(0.05)
+            sock = _connect(path)
+
+    sock.sendall(ATTACH_REPLAY if replay else ATTACH_LIVE)
+    return ConsoleClient(device, sock)
@@ -0,0 +1,179 @@
+"""
+Per-console broker. It owns the tty of one DPU console and shares it with any number of
+local subscribers connected over a Unix socket: console output is fanned out to all of them
+(optionally preceded by a replay of the recent output) and their input is written to the
+tty one chunk at a time, in the order it was received.
+
+The broker is started on demand by utils.console.open_console and exits on its own once
+it has had no subscribers for a while. It can also be started by hand:
+
+    python3 -m utils.console_broker /dev/rshim0/console 115200
+"""
+
+import dataclasses
+import fcntl
+import os
+import select
+import socket
+import sys
+import time
+from logger import logger
+from utils.console import (
+    ATTACH_LIVE,
+    ATTACH_REPLAY,
+    Console,
+    ConsoleDevice,
+    socket_path,
+)
+
+# How much of the console output is kept around for subscribers attaching later
+REPLAY_SIZE = 64 * 1024
+
+# Subscribers that don't keep up are dropped once this much output is queued for them
+MAX_PENDING = 4 * 1024 * 1024
+
+# Exit once there have been no subscribers for this long (in seconds)
+IDLE_TIMEOUT = 300
+
+
+@dataclasses.dataclass
+class Subscriber:
+    sock: socket.socket
+    attached: bool = False
+    pending: bytearray = dataclasses.field(default_factory=bytearray)
+
+
+class ConsoleBroker:
+    def __init__(self, device: ConsoleDevice):
+        self.device = device
+        self.path = socket_path(device)
+        self.replay = bytearray()
+        self.subscribers: dict[int, Subscriber] = {}
+
+    def _lock(self) -> bool:
+        """Make sure there's only one broker per console, returns False if one is already up"""
+        self.lock_file = open(f"{self.path}.lock", "w")
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _listen(self) -> socket.socket:
+        # Anything left behind at this point is from a broker that died
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        listener.listen()
+        return listener
+
+    def _drop(self, sub: Subscriber) -> None:
+        self.subscribers.pop(sub.sock.fileno(), None)
+        sub.sock.close()
+        logger.info(f"Subscriber detached, {len(self.subscribers)} left")
+
+    def _publish(self, data: bytes) -> None:
+        self.replay += data
+        del self.replay[:-REPLAY_SIZE]
+        for sub in list(self.subscribers.values()):
+            if not sub.attached:
+                continue
+            sub.pending += data
+            if len(sub.pending) > MAX_PENDING:
+                logger.info("Dropping subscriber that isn't reading its output")
+                self._drop(sub)
+
+    def _handle_input(self, sub: Subscriber, console: Console) -> None:
+        try:
+            data = sub.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionError:
+            data = b""
+        if not data:
+            self._drop(sub)
+            return
+        if not sub.attached:
+            sub.attached = True
+            if data[:1] == ATTACH_REPLAY:
+                sub.pending += self.replay
+            elif data[:1] != ATTACH_LIVE:
+                logger.info("Dropping subscriber with an unknown attach request")
+                self._drop(sub)
+                return
+            data = data[1:]
+        if data:
+            console.send(data)
+
+    def _flush(self, sub: Subscriber) -> None:
+        try:
+            sent = sub.sock.send(sub.pending)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionError:
+            self._drop(sub)
+            return
+        del sub.pending[:sent]
+
+    def serve_forever(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if not self._lock():
+            logger.info(f"A broker for {self.device.path} is already running")
+            return
+
+        listener = self._listen()
+        logger.info(f"Brokering {self.device.path} on {self.path}")
+        idle_since = time.monotonic()
+        try:
+            with Console(self.device) as console:
+                while True:
+                    readers = [listener.fileno(), console.fileno()]
+                    readers += list(self.subscribers)
+                    writers = [fd for fd, s in self.subscribers.items() if s.pending]
+                    readable, writable, _ = select.select(readers, writers, [], 1)
+
+                    if console.fileno() in readable:
+                        self._publish(console.read_nonblocking(4096))
+
+                    if listener.fileno() in readable:
+                        sock, _ = listener.accept()
+                        sock.setblocking(False)
+                        self.subscribers[sock.fileno()] = Subscriber(sock)
+                        logger.info(
+                            f"Subscriber attached, {len(self.subscribers)} in total"
+                        )
+
+                    for fd in readable:
+                        if fd in self.subscribers:
+                            self._handle_input(self.subscribers[fd], console)
+
+                    for fd in writable:
+                        if fd in self.subscribers:
+                            self._flush(self.subscribers[fd])
+
+                    if self.subscribers:
+                        idle_since = time.monotonic()
+                    elif time.monotonic() - idle_since > IDLE_TIMEOUT:
+                        logger.info(f"No subscribers for {IDLE_TIMEOUT}s, exiting")
+                        break
+        except (EOFError, OSError) as e:
+            logger.error(f"Lost {self.device.path}: {e}")
+        finally:
+            for sub in list(self.subscribers.values()):
+                self._drop(sub)
+            listener.close()
+            os.remove(self.path)
+
+
+def main() -> None:
+    if len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} <console device> <baudrate>")
+        sys.exit(1)
+    broker = ConsoleBroker(ConsoleDevice(sys.argv[1], int(sys.argv[2])))
+    broker.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
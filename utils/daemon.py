@@ -0,0 +1,211 @@
+"""
+Long-lived dpu-tools process ("dpu-tools serve") that runs CLI invocations on behalf of a
+thin client, so they don't pay for starting Python, importing everything and scanning
+for DPUs every time.
+
+The client connects to SOCKET_PATH and sends its arguments, working directory and
+environment together with its stdin, stdout and stderr (as SCM_RIGHTS file descriptors).
+The daemon forks for every request, the child takes over those descriptors and runs the
+command like the CLI would, then sends its exit code back. Everything loaded in the daemon
+(modules, the DPU inventory) is shared with the children for free. SSH connections are
+kept warm by the ssh multiplexing in SSH_OPTIONS and consoles by their brokers.
+"""
+
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from logger import logger, setup_logging
+from typing import Callable, Optional
+from utils.common import INVENTORY_TTL
+
+SOCKET_PATH = "/run/dpu-tools/daemon.sock"
+
+# Request size limit, arguments and environment easily fit
+MAX_REQUEST = 1024 * 1024
+
+EXIT_CODE = struct.Struct("!i")
+
+# How often what's kept around for the children is refreshed, often enough for the DPU
+# inventory (see utils/common.py) to never expire
+WARM_UP_INTERVAL = INVENTORY_TTL / 2
+
+# The children forked for requests, only those are reaped (see _reap)
+_children: set[int] = set()
+
+# Set to run dpu-tools locally even when the daemon is up
+NO_DAEMON_ENV = "DPU_TOOLS_NO_DAEMON"
+
+
+def forward(argv: list[str]) -> Optional[int]:
+    """
+    Run the command in the daemon, returns its exit code or None if there's no daemon
+    (or it's disabled), in which case the command should be run locally.
+    """
+    if os.environ.get(NO_DAEMON_ENV) or not os.path.exists(SOCKET_PATH):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+        socket.send_fds(sock, [json.dumps(request).encode()], [0, 1, 2])
+        sock.shutdown(socket.SHUT_WR)
+        # the child running the command first sends its pid, then its exit code
+        pid = _read_int(sock)
+        while True:
+            try:
+                code = _read_int(sock)
+                break
+            except KeyboardInterrupt:
+                # the child isn't in our process group, pass Ctrl-C on
+                if pid is not None:
+                    os.kill(pid, signal.SIGINT)
+        if code is None:
+            logger.error("dpu-tools daemon went away while running the command")
+            return 1
+        return code
+
+
+def _read_int(sock: socket.socket) -> Optional[int]:
+    data = b""
+    while len(data) < EXIT_CODE.size:
+        more = sock.recv(EXIT_CODE.size - len(data))
+        if not more:
+            return None
+        data += more
+    value: int = EXIT_CODE.unpack(data)[0]
+    return value
+
+
+def _receive(conn: socket.socket) -> tuple[dict[str, object], list[int]]:
+    data, fds, _, _ = socket.recv_fds(conn, MAX_REQUEST, 3)
+    while True:
+        more = conn.recv(MAX_REQUEST)
+        if not more:
+            break
+        data += more
+    request: dict[str, object] = json.loads(data)
+    return request, fds
+
+
+def _run_request(
+    conn: socket.socket, handler: Callable[[list[str]], None], listener: socket.socket
+) -> None:
+    """In the forked child, never returns."""
+    code = 1
+    try:
+        listener.close()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        request, fds = _receive(conn)
+        conn.sendall(EXIT_CODE.pack(os.getpid()))
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        # the daemon's streams are buffered for where its own output went (blocks under
+        # systemd), the client's output should show up as it's written
+        sys.stdin = open(0, closefd=False)
+        sys.stdout = open(1, "w", buffering=1, closefd=False)
+        sys.stderr = open(2, "w", buffering=1, closefd=False)
+        # the log handler still writes to the daemon's stdout
+        setup_logging()
+        os.setsid()
+        os.chdir(str(request["cwd"]))
+        env = request["env"]
+        assert isinstance(env, dict)
+        os.environ.clear()
+        os.environ.update(env)
+        argv = request["argv"]
+        assert isinstance(argv, list)
+        try:
+            handler(argv)
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except KeyboardInterrupt:
+            code = 130
+        except Exception as e:
+            logger.exception(e)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            conn.sendall(EXIT_CODE.pack(code))
+        except OSError:
+            pass
+        os._exit(code)
+
+
+def _reap(*args: object) -> None:
+    """
+    Reap the children that ran requests. Other children of the daemon (e.g. subprocesses
+    run by warm_up) are left to whoever waits for them, reaping those here would lose
+    their exit code.
+    """
+    for pid in list(_children):
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                _children.discard(pid)
+        except ChildProcessError:
+            _children.discard(pid)
+
+
+def _keep_warm(warm_up: Callable[[], None]) -> None:
+    while True:
+        time.sleep(WARM_UP_INTERVAL)
+        try:
+            warm_up()
+        except Exception as e:
+            logger.debug(f"Warming up failed: {e}")
+
+
+def serve(handler: Callable[[list[str]], None], warm_up: Callable[[], None]) -> None:
+    """
+    Serve requests until killed. handler runs a command line (without the program name)
+    in a forked child. warm_up is run in the background every WARM_UP_INTERVAL, so that
+    the children start with whatever it keeps around up to date without a request ever
+    waiting for it.
+    """
+    os.makedirs(os.path.dirname(SOCKET_PATH), exist_ok=True)
+    if os.path.exists(SOCKET_PATH):
+        os.remove(SOCKET_PATH)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(SOCKET_PATH)
+    os.chmod(SOCKET_PATH, 0o600)
+    listener.listen()
+    signal.signal(signal.SIGCHLD, _reap)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    warm_up()
+    threading.Thread(target=_keep_warm, args=(warm_up,), daemon=True).start()
+    logger.info(f"Serving dpu-tools on {SOCKET_PATH}")
+
+    try:
+        while True:
+            readable, _, _ = select.select([listener], [], [])
+            if not readable:
+                continue
+            conn, _ = listener.accept()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                _run_request(conn, handler, listener)
+            _children.add(pid)
+            # it may have exited before it was known here
+            _reap()
+            conn.close()
+    finally:
+        listener.close()
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
@@ -0,0 +1,186 @@
+"""
+Firmware information of all devlink devices, read from the kernel over generic netlink
+(what "devlink dev info" shows) with one request on one socket. This is much faster than
+running mstflint for every device and doesn't need the MST tools.
+"""
+
+import dataclasses
+import os
+import socket
+import struct
+from logger import logger
+from typing import Iterator, Optional
+
+NETLINK_GENERIC = 16
+
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+DEVLINK_GENL_NAME = "devlink"
+DEVLINK_GENL_VERSION = 1
+DEVLINK_CMD_INFO_GET = 51
+
+DEVLINK_ATTR_BUS_NAME = 1
+DEVLINK_ATTR_DEV_NAME = 2
+DEVLINK_ATTR_INFO_DRIVER_NAME = 98
+DEVLINK_ATTR_INFO_SERIAL_NUMBER = 99
+DEVLINK_ATTR_INFO_VERSION_FIXED = 100
+DEVLINK_ATTR_INFO_VERSION_RUNNING = 101
+DEVLINK_ATTR_INFO_VERSION_STORED = 102
+DEVLINK_ATTR_INFO_VERSION_NAME = 103
+DEVLINK_ATTR_INFO_VERSION_VALUE = 104
+
+NLA_TYPE_MASK = 0x3FFF
+
+NLMSGHDR = struct.Struct("=IHHII")
+GENLMSGHDR = struct.Struct("=BBH")
+NLATTR = struct.Struct("=HH")
+
+RECV_SIZE = 65536
+
+
+@dataclasses.dataclass
+class DevlinkInfo:
+    bus: str
+    device: str
+    driver: str = ""
+    serial: str = ""
+    # versions by name, e.g. "fw.psid" (fixed) and "fw.version" (running and stored)
+    fixed: dict[str, str] = dataclasses.field(default_factory=dict)
+    running: dict[str, str] = dataclasses.field(default_factory=dict)
+    stored: dict[str, str] = dataclasses.field(default_factory=dict)
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def _attr(kind: int, payload: bytes) -> bytes:
+    header = NLATTR.pack(NLATTR.size + len(payload), kind)
+    return (header + payload).ljust(_align(NLATTR.size + len(payload)), b"\0")
+
+
+def _attrs(data: bytes) -> Iterator[tuple[int, bytes]]:
+    offset = 0
+    while offset + NLATTR.size <= len(data):
+        length, kind = NLATTR.unpack_from(data, offset)
+        if length < NLATTR.size:
+            break
+        yield kind & NLA_TYPE_MASK, data[offset + NLATTR.size : offset + length]
+        offset += _align(length)
+
+
+def _string(payload: bytes) -> str:
+    return payload.split(b"\0", 1)[0].decode(errors="replace")
+
+
+class _GenlSocket:
+    def __init__(self) -> None:
+        self.sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_CLOEXEC, NETLINK_GENERIC
+        )
+        self.sock.bind((0, 0))
+        self.seq = 0
+
+    def close(self) -> None:
+        self.sock.close()
+
+    def request(
+        self, family: int, cmd: int, version: int, flags: int, attrs: bytes = b""
+    ) -> Iterator[bytes]:
+        """Send a request, yields the payload (after the genl header) of every reply"""
+        self.seq += 1
+        payload = GENLMSGHDR.pack(cmd, version, 0) + attrs
+        header = NLMSGHDR.pack(
+            NLMSGHDR.size + len(payload), family, NLM_F_REQUEST | flags, self.seq, 0
+        )
+        self.sock.send(header + payload)
+        while True:
+            data = self.sock.recv(RECV_SIZE)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                length, kind, _, seq, _ = NLMSGHDR.unpack_from(data, offset)
+                if length < NLMSGHDR.size:
+                    return
+                message = data[offset + NLMSGHDR.size : offset + length]
+                offset += _align(length)
+                if seq != self.seq:
+                    continue
+                if kind == NLMSG_DONE:
+                    return
+                if kind == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", message)[0]
+                    if error:
+                        raise OSError(error, os.strerror(error))
+                    # an ack, the request is done
+                    return
+                yield message[GENLMSGHDR.size :]
+            if not flags & NLM_F_DUMP:
+                return
+
+    def family(self, name: str) -> int:
+        attrs = _attr(CTRL_ATTR_FAMILY_NAME, name.encode() + b"\0")
+        for message in self.request(GENL_ID_CTRL, CTRL_CMD_GETFAMILY, 1, 0, attrs):
+            for kind, payload in _attrs(message):
+                if kind == CTRL_ATTR_FAMILY_ID:
+                    family: int = struct.unpack_from("=H", payload)[0]
+                    return family
+        raise OSError(f"No generic netlink family {name}")
+
+
+def _versions(payload: bytes) -> tuple[str, str]:
+    name = value = ""
+    for kind, data in _attrs(payload):
+        if kind == DEVLINK_ATTR_INFO_VERSION_NAME:
+            name = _string(data)
+        elif kind == DEVLINK_ATTR_INFO_VERSION_VALUE:
+            value = _string(data)
+    return name, value
+
+
+def _parse_info(message: bytes) -> Optional[DevlinkInfo]:
+    info = DevlinkInfo("", "")
+    for kind, payload in _attrs(message):
+        if kind == DEVLINK_ATTR_BUS_NAME:
+            info.bus = _string(payload)
+        elif kind == DEVLINK_ATTR_DEV_NAME:
+            info.device = _string(payload)
+        elif kind == DEVLINK_ATTR_INFO_DRIVER_NAME:
+            info.driver = _string(payload)
+        elif kind == DEVLINK_ATTR_INFO_SERIAL_NUMBER:
+            info.serial = _string(payload)
+        elif kind == DEVLINK_ATTR_INFO_VERSION_FIXED:
+            info.fixed.update([_versions(payload)])
+        elif kind == DEVLINK_ATTR_INFO_VERSION_RUNNING:
+            info.running.update([_versions(payload)])
+        elif kind == DEVLINK_ATTR_INFO_VERSION_STORED:
+            info.stored.update([_versions(payload)])
+    return info if info.device else None
+
+
+def info_all() -> dict[str, DevlinkInfo]:
+    """
+    devlink info of every device, keyed by device name (the PCI address for PCI devices).
+    Raises OSError when devlink isn't available.
+    """
+    sock = _GenlSocket()
+    try:
+        family = sock.family(DEVLINK_GENL_NAME)
+        devices = {}
+        for message in sock.request(
+            family, DEVLINK_CMD_INFO_GET, DEVLINK_GENL_VERSION, NLM_F_DUMP
+        ):
+            info = _parse_info(message)
+            if info is not None:
+                devices[info.device] = info
+        logger.debug(f"devlink info of {list(devices)}")
+        return devices
+    finally:
+        sock.close()
@@ -0,0 +1,147 @@
+"""
+Wiping of a remote block device. The fastest thing the device supports is used: offloading
+to the device with write-zeroes (blkdiscard -z) or an NVMe format, and only if neither is
+there, zeros are written with a few dd's in parallel, each covering its own range.
+"""
+
+import dataclasses
+import time
+from logger import logger
+from utils.common import ssh_run
+
+# Block size used by the dd fallback, large enough for the NVMe to stream at full speed
+DD_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Number of dd's writing zeros at the same time in the fallback
+DD_JOBS = 4
+
+
+@dataclasses.dataclass(frozen=True)
+class DiskInfo:
+    size: int
+    write_zeroes: bool
+    has_blkdiscard: bool
+    has_nvme_cli: bool
+
+
+def _probe_value(out: str, key: str) -> str:
+    for line in out.splitlines():
+        if line.startswith(f"{key}="):
+            return line[len(key) + 1 :].strip()
+    return ""
+
+
+def probe(address: str, device: str) -> DiskInfo:
+    name = device.split("/")[-1]
+    cmd = "; ".join(
+        [
+            f"echo size=$(blockdev --getsize64 {device})",
+            f"echo write_zeroes=$(cat /sys/block/{name}/queue/write_zeroes_max_bytes)",
+            "echo blkdiscard=$(command -v blkdiscard)",
+            "echo nvme=$(command -v nvme)",
+        ]
+    )
+    out = ssh_run(cmd, address, dry_run=False).out
+    size = _probe_value(out, "size")
+    write_zeroes = _probe_value(out, "write_zeroes")
+    info = DiskInfo(
+        size=int(size) if size.isdigit() else 0,
+        write_zeroes=write_zeroes.isdigit() and int(write_zeroes) > 0,
+        has_blkdiscard=bool(_probe_value(out, "blkdiscard")),
+        has_nvme_cli=bool(_probe_value(out, "nvme")),
+    )
+    logger.debug(f"{device} on {address}: {info}")
+    return info
+
+
+# dd stops with this once it gets to the end of the device, which is expected
+NO_SPACE = "No space left on device"
+
+
+def _dd_job(n: int, dd: str) -> str:
+    """dd in the background, with its messages and exit code prefixed with n"""
+    return f'{{ {dd}; echo "exit $?"; }} 2>&1 | sed "s/^/{n} /" &'
+
+
+def _dd_failures(out: str, jobs: int) -> list[str]:
+    """What went wrong with the dd's of _dd_job, nothing if they all succeeded"""
+    exits: dict[int, str] = {}
+    messages: dict[int, list[str]] = {n: [] for n in range(jobs)}
+    for line in out.splitlines():
+        job, _, message = line.partition(" ")
+        if not job.isdigit() or int(job) not in messages:
+            continue
+        if message.startswith("exit "):
+            exits[int(job)] = message[len("exit ") :].strip()
+        else:
+            messages[int(job)].append(message)
+    failures = []
+    for n in range(jobs):
+        if n not in exits:
+            failures.append(f"dd {n} didn't finish")
+        elif exits[n] != "0" and not any(NO_SPACE in m for m in messages[n]):
+            failures.append(f"dd {n} exited with {exits[n]}: {' '.join(messages[n])}")
+    return failures
+
+
+def _dd_ranges(device: str, size: int, start: int) -> list[str]:
+    """dd's zeroing [start, size) of device, to be run in parallel"""
+    first = start // DD_BLOCK_SIZE
+    blocks = (size + DD_BLOCK_SIZE - 1) // DD_BLOCK_SIZE - first
+    per_job = max(1, (blocks + DD_JOBS - 1) // DD_JOBS)
+    jobs = []
+    for seek in range(first, first + blocks, per_job):
+        count = min(per_job, first + blocks - seek)
+        # the last block may go past the end of the device, dd stops there
+        jobs.append(
+            f"dd if=/dev/zero of={device} bs={DD_BLOCK_SIZE} seek={seek} count={count} conv=notrunc"
+        )
+    return jobs
+
+
+def wipe(address: str, device: str, start: int = 0, dry_run: bool = False) -> str:
+    """
+    Zero device on the remote host from offset start to its end, returns the method used.
+    Raises RuntimeError if the device couldn't be wiped.
+    """
+    begin = time.monotonic()
+    if dry_run:
+        info = DiskInfo(0, False, False, False)
+    else:
+        info = probe(address, device)
+
+    # round down so the (partial) block the image ends in is wiped too
+    start -= start % DD_BLOCK_SIZE
+    if info.size:
+        dds = _dd_ranges(device, info.size, start)
+    else:
+        # without a size, dd runs until the end of the device
+        dds = [
+            f"dd if=/dev/zero of={device} bs={DD_BLOCK_SIZE} seek={start // DD_BLOCK_SIZE}"
+        ]
+    dd_cmd = " ".join(_dd_job(n, dd) for n, dd in enumerate(dds)) + " wait"
+
+    if info.has_blkdiscard and info.write_zeroes:
+        method = "blkdiscard"
+        cmd = f"blkdiscard -z -o {start} {device}"
+    elif info.has_nvme_cli and start == 0:
+        # formatting always covers the whole namespace
+        method = "nvme-format"
+        cmd = f"nvme format {device} --ses=1 --force"
+    else:
+        method = "dd"
+        cmd = dd_cmd
+
+    logger.info(f"Wiping {device} from offset {start} with {method}")
+    result = ssh_run(cmd, address, dry_run)
+    if result.returncode and method != "dd":
+        logger.info(f"{method} failed ({result.err.strip()}), falling back to dd")
+        method = "dd"
+        result = ssh_run(dd_cmd, address, dry_run)
+    if method == "dd" and not dry_run:
+        failures = _dd_failures(result.out, len(dds))
+        if failures:
+            raise RuntimeError(f"Wiping {device} failed: {'; '.join(failures)}")
+
+    logger.info(f"Wiped {device} with {method} in {time.monotonic() - begin:.1f}s")
+    return method
@@ -1,30 +1,50 @@
 #!/usr/bin/env python3
+import concurrent.futures
 from logger import logger
-from os import makedirs
+import os
 import sys
-import pexpect
 import json
-import re
 import tempfile
+import re
+import time
 from typing import Optional
-from utils.minicom import minicom_cmd, pexpect_child_wait, configure_minicom
+from utils.console import ipu_console_device, open_console
 from utils.common_ipu import (
-    check_connectivity,
-    find_image,
-    get_current_version,
     VERSIONS,
-    minicom_get_version,
+    probe_version,
+)
+from utils.common_bf import (
+    bf_version,
+    find_bf_pci_addresses_or_quit,
+    fw_info,
+    query_fw_info,
+    selected_bfs,
 )
-from utils.common_bf import find_bf_pci_addresses_or_quit, mst_flint, bf_version
 from utils.common import (
-    extract_tar_gz,
+    SSH_OPTIONS,
+    extract_member,
     download_file,
     run,
-    Result,
+    fetch,
     list_http_directory,
     ssh_run,
+    ssh_write,
 )
+from utils.disk_wipe import wipe
+from utils.image_store import ChunkedImage, ImageStore
+from utils.image_verify import repair, verify
+from utils.progress import DdProgress, MstflintProgress
+from utils.reachability import wait_for_ssh
 from utils.remote_api import RemoteAPI
+from utils.spi_flash import SpiFlash
+from utils.steps import Step, StepRunner
+
+# Board configs are only downloaded once per IMC, they don't change
+BOARD_CONFIG_CACHE = "/var/cache/dpu-tools/board-configs"
+
+# Where fixboard writes the board config on the SPI flash
+BOARD_CONFIG_OFFSET = 0x30000
+BOARD_CONFIG_SIZE = 0x1000
 
 
 class IPUFirmware:
@@ -33,7 +53,11 @@ class IPUFirmware:
         imc_address: str,
         version: str = "",
         repo_url: str = "",
-        steps_to_run: list[str] = [],
+        steps_to_run: Optional[list[str]] = None,
+        resume_from: Optional[str] = None,
+        wipe_tail_only: bool = False,
+        verify: bool = False,
+        repair: bool = False,
         dry_run: bool = False,
         verbose: bool = False,
     ):
@@ -42,207 +66,241 @@ class IPUFirmware:
         self.dry_run = dry_run
         self.version_to_flash = version or VERSIONS[-1]
         self.repo_url = repo_url or "wsfd-advnetlab-amp04.anl.eng.bos2.dc.redhat.com"
-        if not steps_to_run:
-            steps_to_run = [
-                "clean_up_imc",
-                "flash_ssd_image",
-                "flash_spi_image",
-                "apply_fixboard",
-            ]
-        self.steps_to_run = steps_to_run if not dry_run else []
+        self.current_version = ""
+        # whether apply_fixboard rebooted the IMC, nothing else does
+        self.rebooted = False
+        self.ssd_image: Optional[ChunkedImage] = None
+        self.spi_image: Optional[ChunkedImage] = None
+        self.wipe_tail_only = wipe_tail_only
+        self.repair = repair
+        self.verify = verify or repair
+        self.runner = StepRunner(self.steps(), steps_to_run, resume_from)
+        # ipu_runtime_access is only needed on old firmware, unless asked for explicitly
+        self.force_runtime_access = "ipu_runtime_access" in (steps_to_run or [])
         if self.dry_run:
             logger.info(
                 "DRY RUN, This is just a preview of the actions that will be taken"
             )
             logger.debug(f"version_to_flash: {self.version_to_flash}")
             logger.debug(f"imc_address: {self.imc_address}")
-            logger.debug(f"steps_to_run: {self.steps_to_run}")
+            logger.debug(f"steps_to_run: {self.runner.plan()}")
             logger.debug(f"repo_url: {self.repo_url}")
             logger.debug(f"dry_run: {self.dry_run}")
             logger.debug(f"verbose: {self.verbose}")
 
-    def should_run(self, step_name: str) -> bool:
-        """Check if the step should be run"""
-        return step_name in self.steps_to_run
+    def steps(self) -> list[Step]:
+        """
+        The reflash as a dependency graph: the images are downloaded and extracted while
+        the IMC is being cleaned up, and the SSD and SPI flashes run at the same time.
+        """
+        steps = [
+            Step("detect_version", self.detect_version, auto=True),
+            Step("get_images", self.retrieve_images, auto=True),
+            Step("ipu_runtime_access", self.ipu_runtime_access, ("detect_version",)),
+            # wiping only what the image doesn't cover needs to know the image size
+            Step(
+                "clean_up_imc",
+                self.clean_up_imc,
+                (
+                    ("ipu_runtime_access", "get_images")
+                    if self.wipe_tail_only
+                    else ("ipu_runtime_access",)
+                ),
+            ),
+            Step(
+                "flash_ssd_image",
+                self.flash_ssd_image,
+                ("get_images", "clean_up_imc"),
+            ),
+            Step(
+                "flash_spi_image",
+                self.flash_spi_image,
+                ("get_images", "ipu_runtime_access"),
+            ),
+        ]
+        flashed = ["flash_ssd_image", "flash_spi_image"]
+        if self.verify:
+            steps += [
+                Step(
+                    "verify_ssd_image",
+                    self.verify_ssd_image,
+                    ("get_images", "flash_ssd_image"),
+                ),
+                Step(
+                    "verify_spi_image",
+                    self.verify_spi_image,
+                    ("get_images", "flash_spi_image"),
+                ),
+            ]
+            flashed = ["verify_ssd_image", "verify_spi_image"]
+        # fixboard ends with rebooting the IMC, so it has to come last
+        steps.append(
+            Step("apply_fixboard", self.apply_fixboard_if_needed, tuple(flashed))
+        )
+        return steps
+
+    def reboots(self) -> bool:
+        """Whether the planned steps can reboot the IMC (only fixboard does, if needed)"""
+        return any("apply_fixboard" in wave for wave in self.runner.plan())
 
-    def reflash_ipu(self) -> None:
+    def reflash_ipu(self) -> bool:
+        """Returns whether the IMC was rebooted."""
         logger.info("Reflashing the firmware of IPU.")
+        logger.info(f"Version: '{self.version_to_flash}'")
 
-        if not self.dry_run:
-            logger.info("Detecting version")
-            result = get_current_version(imc_address=self.imc_address)
-            if result.returncode:
-                current_version = minicom_get_version()
-            else:
-                current_version = result.out
-            logger.info(f"Version: '{self.version_to_flash}'")
-            if current_version == "1.2.0.7550":
-                self.steps_to_run.insert(0, "ipu_runtime_access")
+        if self.dry_run:
+            for i, wave in enumerate(self.runner.plan()):
+                logger.info(f"[DRY RUN] Stage {i + 1}: {', '.join(wave)}")
         else:
-            logger.info("[DRY RUN] Detecting version")
+            self.runner.run()
 
-        # Retrieve images if not a dry run
+        logger.info("Done!")
+        if not self.rebooted:
+            logger.info(f"Please cold reboot IMC at {self.imc_address}")
+        return self.rebooted
+
+    def detect_version(self) -> None:
+        logger.info("Detecting version")
+        self.current_version = probe_version(self.imc_address)
+        if not self.current_version:
+            logger.error("Couldn't get the current version over ssh nor the console")
+            sys.exit(1)
+        logger.info(f"Current version: '{self.current_version}'")
+
+    def retrieve_images(self) -> None:
         logger.info("Retrieving images.....")
-        ssd_image_path, spi_image_path = (
-            self.get_images() if not self.dry_run else ("", "")
-        )
+        self.ssd_image, self.spi_image = self.get_images()
         logger.info("Done Retrieving images")
 
-        # Step 1: ipu_runtime_access
-        logger.info("Step 1: ipu_runtime_access")
-        if self.should_run("ipu_runtime_access"):
-            self.ipu_runtime_access()
-        else:
-            logger.info("Skipping ipu_runtime_access")
-
-        # Step 2: clean_up_imc
-        logger.info("Step 2: clean_up_imc")
-        if self.should_run("clean_up_imc"):
-            self.clean_up_imc()
-        else:
-            logger.info("Skipping clean_up_imc")
-
-        # Step 3: Flash SSD image using dd
-        logger.info("Step 3: flash_ssd_image")
-        if self.should_run("flash_ssd_image"):
-            result = run(
-                f"dd bs=16M if={ssd_image_path} | ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null {self.imc_address} 'dd bs=16M of=/dev/nvme0n1' status=progress",
-                dry_run=self.dry_run,
-            )
-            if result.returncode:
-                logger.error("Failed to flash_ssd_image")
-                sys.exit(result.returncode)
-
-            logger.info("Tidy up file system")
-            # sync at IMC to refresh the partition tables
-            run(
-                f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {self.imc_address} 'sync ; sync ; sync'",
-                dry_run=self.dry_run,
-            )
-            # write the in-memory partition table to disk
-            run(
-                f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {self.imc_address} 'echo -e \"w\" | fdisk /dev/nvme0n1'",
-                dry_run=self.dry_run,
-            )
-            run(
-                f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {self.imc_address} 'parted -sf /dev/nvme0n1 print'",
-                dry_run=self.dry_run,
-            )
-
-        else:
-            logger.info("Skipping flash_ssd_image")
+    def flash_ssd_image(self) -> None:
+        assert self.ssd_image is not None
+        result = ssh_write(
+            "dd bs=16M of=/dev/nvme0n1 status=progress",
+            self.imc_address,
+            self.ssd_image.iter_chunks(),
+            dry_run=self.dry_run,
+            progress=DdProgress("SSD image", total=self.ssd_image.size),
+        )
+        if result.returncode:
+            logger.error("Failed to flash_ssd_image")
+            sys.exit(result.returncode)
 
-        # Step 4: Flash SPI image
-        logger.info("Step 4: flash_spi_image")
-        if self.should_run("flash_spi_image"):
-            result = run(
-                f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {self.imc_address} 'flash_erase /dev/mtd0 0 0'",
-                dry_run=self.dry_run,
-            )
-            if result.returncode:
-                logger.error("Failed to erase SPI image")
-                sys.exit(result.returncode)
+        logger.info("Tidy up file system")
+        # sync at IMC to refresh the partition tables
+        run(
+            f"ssh {SSH_OPTIONS} {self.imc_address} 'sync ; sync ; sync'",
+            dry_run=self.dry_run,
+        )
+        # write the in-memory partition table to disk
+        run(
+            f"ssh {SSH_OPTIONS} {self.imc_address} 'echo -e \"w\" | fdisk /dev/nvme0n1'",
+            dry_run=self.dry_run,
+        )
+        run(
+            f"ssh {SSH_OPTIONS} {self.imc_address} 'parted -sf /dev/nvme0n1 print'",
+            dry_run=self.dry_run,
+        )
 
-            result = run(
-                f"dd bs=16M if={spi_image_path} | ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {self.imc_address} 'dd bs=16M of=/dev/mtd0 status=progress'",
-                dry_run=self.dry_run,
-            )
-            if result.returncode:
-                logger.error("Failed to flash_spi_image")
-                sys.exit(result.returncode)
-        else:
-            logger.info("Skipping flash_spi_image")
-
-        logger.info("Step 5: apply_fixboard")
-        if self.should_run("apply_fixboard"):
-            if self.fixboard_is_needed():
-                logger.info("Applying fixboard!")
-                self.apply_fixboard()
-            else:
-                logger.info("Fixboard not needed!")
+    def flash_spi_image(self) -> None:
+        assert self.spi_image is not None
+        spi = SpiFlash(self.imc_address, "/dev/mtd0", dry_run=self.dry_run)
+        image = b"".join(self.spi_image.iter_chunks())
+        try:
+            # everything past the image is left erased, like after a full erase
+            size = 0 if self.dry_run else spi.info().size
+            spi.program(spi.pad(image, size))
+        except RuntimeError as e:
+            logger.error(f"Failed to flash_spi_image: {e}")
+            sys.exit(1)
+
+    def verify_image(self, device: str, image: Optional[ChunkedImage]) -> None:
+        assert image is not None
+        bad = verify(self.imc_address, device, image, self.dry_run)
+        if bad and self.repair:
+            logger.info(f"Rewriting {len(bad)} mismatching chunks of {device}")
+            if not repair(self.imc_address, device, image, bad, self.dry_run):
+                logger.error(f"Failed to rewrite the mismatching chunks of {device}")
+                sys.exit(1)
+            bad = verify(self.imc_address, device, image, self.dry_run)
+        if bad:
+            logger.error(f"{device} doesn't match the image, chunks: {bad}")
+            sys.exit(1)
+
+    def verify_ssd_image(self) -> None:
+        self.verify_image("/dev/nvme0n1", self.ssd_image)
+
+    def verify_spi_image(self) -> None:
+        self.verify_image("/dev/mtd0", self.spi_image)
+
+    def apply_fixboard_if_needed(self) -> None:
+        if self.fixboard_is_needed():
+            logger.info("Applying fixboard!")
+            self.apply_fixboard()
         else:
-            logger.info("Skipping applying_fixboard")
-        # Step 5: Reboot IMC
-        logger.info("Done!")
-        logger.info(f"Please cold reboot IMC at {self.imc_address}")
+            logger.info("Fixboard not needed!")
 
     def ipu_runtime_access(self) -> None:
+        if self.current_version != "1.2.0.7550" and not self.force_runtime_access:
+            logger.info(f"No runtime access needed on version {self.current_version}")
+            return
         if self.dry_run:
-
-            logger.debug("[DRY RUN] pkill -9 minicom")
-            logger.debug(
-                "[DRY RUN] Wait for 'Press CTRL-A Z for help on special keys.'"
-            )
-            logger.debug("[DRY RUN] Ready to enter command")
+            logger.debug(f"[DRY RUN] Open IMC console {ipu_console_device('imc').path}")
             logger.debug("[DRY RUN] Send '/etc/ipu/ipu_runtime_access'")
-            logger.debug("[DRY RUN] Wait for '.*#'")
+            logger.debug("[DRY RUN] Wait for '.*Enabling network and sshd.*'")
             logger.debug("[DRY RUN] Capturing and printing output")
-            logger.debug("[DRY RUN] Send Ctrl-A and 'x' to exit minicom")
-            logger.debug("[DRY RUN] Expect EOF")
+            logger.debug("[DRY RUN] Close IMC console")
         else:
             logger.debug(
                 f"Checking that ipu runtime access is up by sshing into {self.imc_address}"
             )
-            connected = check_connectivity(self.imc_address)
+            connected = wait_for_ssh(self.imc_address)
             if not connected:
                 logger.debug(
-                    f"Couldn't ssh into {self.imc_address}, enabling runtime access through minicom"
+                    f"Couldn't ssh into {self.imc_address}, enabling runtime access through the console"
                 )
-                run("pkill -9 minicom")
-                logger.debug("Configuring minicom")
-                with configure_minicom():
-                    logger.debug("spawn minicom")
-                    child = pexpect.spawn(minicom_cmd("imc"))
-                    child.maxread = 10000
-                    pexpect_child_wait(
-                        child, ".*Press CTRL-A Z for help on special keys.*", 120
-                    )
+                with open_console(ipu_console_device("imc")) as console:
                     logger.debug("Ready to enter command")
-                    child.sendline("/etc/ipu/ipu_runtime_access")
+                    console.sendline("/etc/ipu/ipu_runtime_access")
                     # Wait for the expected response (adjust the timeout as needed)
-                    pexpect_child_wait(child, ".*Enabling network and sshd.*", 120)
+                    console.expect(".*Enabling network and sshd.*", 120)
 
                     # Capture and logger.debug the output
-                    assert child.before is not None
-                    logger.debug(child.before.decode("utf-8"))
-                    logger.debug(child.after.decode("utf-8"))
-                    # Gracefully close Picocom (equivalent to pressing Ctrl-A and Ctrl-X)
-                    child.sendcontrol("a")
-                    child.sendline("x")
-                    # Ensure Picocom closes properly
-                    child.expect(pexpect.EOF)
+                    logger.debug(console.before.decode("utf-8", errors="replace"))
+                    logger.debug(console.after.decode("utf-8", errors="replace"))
 
     def clean_up_imc(self) -> None:
         logger.info("Cleaning up IMC via SSH")
 
         # Execute the commands over SSH with dry_run handling
         run(
-            f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {self.imc_address} 'umount -l /dev/loop0'",
+            f"ssh {SSH_OPTIONS} {self.imc_address} 'umount -l /dev/loop0'",
             dry_run=self.dry_run,
         )
         run(
-            f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {self.imc_address} 'umount -l /dev/nvme0n1p*'",
+            f"ssh {SSH_OPTIONS} {self.imc_address} 'umount -l /dev/nvme0n1p*'",
             dry_run=self.dry_run,
         )
         run(
-            f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {self.imc_address} 'killall -9 tgtd'",
+            f"ssh {SSH_OPTIONS} {self.imc_address} 'killall -9 tgtd'",
             dry_run=self.dry_run,
         )
 
-        logger.debug("Filling nvme0n1 with zeros")
-        run(
-            f"ssh -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {self.imc_address} 'dd if=/dev/zero of=/dev/nvme0n1 bs=64k status=progress'",
-            dry_run=self.dry_run,
-        )
-        logger.debug("Done filling nvme0n1 with zeros")
+        start = 0
+        if self.wipe_tail_only and self.ssd_image is not None:
+            # everything before that is overwritten by the image anyway
+            start = self.ssd_image.size
+        try:
+            wipe(self.imc_address, "/dev/nvme0n1", start, dry_run=self.dry_run)
+        except RuntimeError as e:
+            logger.error(e)
+            sys.exit(1)
 
-    def get_images(self) -> tuple[str, str]:
+    def get_images(self) -> tuple[ChunkedImage, ChunkedImage]:
         """
-        Download and extract the SSD image and recovery firmware for the given version.
-        Return the paths for both files.
+        Get the SSD image and recovery firmware for the given version from the image store,
+        downloading and extracting them the first time they're needed.
         """
         base_url = f"http://{self.repo_url}/intel-ipu-mev-{self.version_to_flash}"
-        download_dir = "/tmp"  # Or any preferred directory for temp storage
 
         # URLs for the tar.gz files based on self.version
         ssd_tar_url = (
@@ -250,30 +308,45 @@ class IPUFirmware:
         )
         recovery_tar_url = f"{base_url}/intel-ipu-recovery-firmware-and-tools-{self.version_to_flash}.tar.gz"
 
-        # Download both tar.gz files
-        ssd_tar_path = download_file(ssd_tar_url, download_dir)
-        recovery_tar_path = download_file(recovery_tar_url, download_dir)
-
-        # Extract both tar.gz files
-        extracted_ssd_files = extract_tar_gz(ssd_tar_path, download_dir)
-        extracted_recovery_files = extract_tar_gz(recovery_tar_path, download_dir)
-
         # Assume the identifier is 1001 for recovery firmware, but this could be passed as an argument
         identifier = "1001"
 
-        # Find the required .bin files
-        ssd_bin_file = find_image(extracted_ssd_files, "ssd-image-mev.bin")
-        recovery_bin_file = find_image(
-            extracted_recovery_files, "intel-ipu-recovery-firmware", identifier
-        )
-
-        return ssd_bin_file, recovery_bin_file
+        def get(
+            name: str, url: str, name_prefix: str, identifier: str = ""
+        ) -> ChunkedImage:
+            def fetch(download_dir: str) -> str:
+                tar_path = download_file(url, download_dir)
+                return extract_member(tar_path, download_dir, name_prefix, identifier)
+
+            return ImageStore().get(f"ipu-{self.version_to_flash}-{name}", fetch)
+
+        # Both archives are downloaded and searched at the same time
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            ssd_future = executor.submit(get, "ssd", ssd_tar_url, "ssd-image-mev.bin")
+            recovery_future = executor.submit(
+                get,
+                f"recovery-{identifier}",
+                recovery_tar_url,
+                "intel-ipu-recovery-firmware",
+                identifier,
+            )
+            return ssd_future.result(), recovery_future.result()
 
-    def ensure_fixboard_image_on_imc(self) -> str:
+    def get_board_config(self) -> bytes:
         """
-        Download and extract the SSD image and recovery firmware for the given version.
-        Return the paths for both files.
+        The pre-built board_config of this IMC. Only that file is downloaded, straight
+        into memory, and kept in BOARD_CONFIG_CACHE for the next runs.
         """
+        cache_path = os.path.join(
+            BOARD_CONFIG_CACHE, f"{self.imc_address}.bin.board_config"
+        )
+        try:
+            with open(cache_path, "rb") as f:
+                logger.debug(f"Using the board config cached in {cache_path}")
+                return f.read()
+        except FileNotFoundError:
+            pass
+
         # Regex to capture the number after the first `-` and a word
         pattern = r"^[a-zA-Z0-9]+-[a-zA-Z]+(\d+)"
 
@@ -289,74 +362,47 @@ class IPUFirmware:
             )
             exit(1)
 
-        base_url = f"http://{self.repo_url}/fixboard"
-        server_dirs = list_http_directory(base_url)
-        logger.debug(f"server_dirs:{server_dirs}")
-        if any(number in dir for dir in server_dirs):
-            base_url = f"http://{self.repo_url}/fixboard/{number}"
-            with tempfile.TemporaryDirectory() as temp_dir:
-                download_dir = f"{temp_dir}/{self.repo_url}/fixboard/{number}"  # Or any preferred directory for temp storage
-                makedirs(download_dir, exist_ok=True)
-                fixboard_files = list_http_directory(base_url)
-                fixboard_local_file_paths: list[str] = []
-                for file in fixboard_files:
-                    fixboard_local_file_paths.append(
-                        download_file(f"{base_url}/{file}", download_dir)
-                    )
-
-                # Find the required .bin files
-                logger.debug(f"fixboard_local_file_paths: {fixboard_local_file_paths}")
-                for fixboard_file in fixboard_local_file_paths:
-                    if fixboard_file.endswith(".bin.board_config"):
-
-                        full_address = f"root@{self.imc_address}"
-
-                        file_name = fixboard_file.split("/")[-1]
-                        result = run(
-                            f"scp -o 'StrictHostKeyChecking=no' -o 'UserKnownHostsFile=/dev/null' {fixboard_file} {full_address}:/tmp/{file_name}",
-                            dry_run=self.dry_run,
-                        )
-                        if result.returncode:
-                            logger.error(
-                                f"Couldn't transfer file using scp, Error: {result.err}"
-                            )
-                            exit(1)
-                        return f"/tmp/{file_name}"
-
-                logger.error("Couldn't find the board_config file, exitting...")
-                exit(1)
-        else:
+        base_url = f"http://{self.repo_url}/fixboard/{number}"
+        try:
+            fixboard_files = list_http_directory(f"{base_url}/")
+        except OSError as e:
+            logger.debug(f"Couldn't list {base_url}: {e}")
             logger.error(
                 f"server {self.imc_address} with number {number} doesn't have pre built fixboard images yet, please add the necessary files to the repo"
             )
             exit(1)
+        logger.debug(f"fixboard files: {fixboard_files}")
+        names = [f for f in fixboard_files if f.endswith(".bin.board_config")]
+        if not names:
+            logger.error("Couldn't find the board_config file, exitting...")
+            exit(1)
+        board_config = fetch(f"{base_url}/{os.path.basename(names[0])}")
+
+        try:
+            os.makedirs(BOARD_CONFIG_CACHE, exist_ok=True)
+            with open(f"{cache_path}.tmp", "wb") as out:
+                out.write(board_config)
+            os.rename(f"{cache_path}.tmp", cache_path)
+        except OSError as e:
+            logger.debug(f"Couldn't cache the board config: {e}")
+        return board_config
 
     def apply_fixboard(self) -> None:
-        fixboard_bin_board_config_file = self.ensure_fixboard_image_on_imc()
+        board_config = self.get_board_config()
         full_address = f"root@{self.imc_address}"
-        result = ssh_run(
-            "flash_erase /dev/mtd0 0x30000 1",
-            full_address,
-            dry_run=self.dry_run,
-        )
-        if result.returncode:
-            logger.error(f"Couldn't flash_erase, Error: {result.err}")
-            exit(1)
-
-        result = ssh_run(
-            f"nandwrite --start=0x30000 --input-size=0x1000 -p /dev/mtd0 {fixboard_bin_board_config_file}",
-            full_address,
-            dry_run=self.dry_run,
-        )
-        if result.returncode:
-            logger.error(f"Couldn't nandwrite, Error: {result.err}")
+        spi = SpiFlash(full_address, "/dev/mtd0", dry_run=self.dry_run)
+        try:
+            spi.program(board_config[:BOARD_CONFIG_SIZE], BOARD_CONFIG_OFFSET)
+        except RuntimeError as e:
+            logger.error(f"Couldn't write the board config: {e}")
             exit(1)
         logger.info("Rebooting IMC now!")
-        result = ssh_run(
+        ssh_run(
             "reboot",
             full_address,
             dry_run=self.dry_run,
         )
+        self.rebooted = not self.dry_run
 
     def fixboard_is_needed(self) -> bool:
         full_address = f"root@{self.imc_address}"
@@ -408,13 +454,26 @@ class BFFirmware:
         self.version_to_flash = version_to_flash
         self.detected_version = bf_version(bf)
 
-    def firmware_version(self) -> None:
-        bf = find_bf_pci_addresses_or_quit(self.id)
-        print(mst_flint(bf)["FW Version"])
+    def firmware_version(self, all_bfs: bool = False) -> None:
+        bfs = selected_bfs(self.id, all_bfs)
+        for bf, info in zip(bfs, query_fw_info(bfs)):
+            print(f"{bf}: {info['FW Version']}" if all_bfs else info["FW Version"])
+
+    def firmware_up(self) -> bool:
+        """Returns whether the device was reset to run new firmware."""
+        if not self.stage_firmware_up():
+            return False
+        self.reset_device()
+        return True
 
-    def firmware_up(self) -> Result:
+    def stage_firmware_up(self) -> bool:
+        """
+        Burn the new firmware without activating it. Returns whether anything was burnt,
+        in which case the device needs a reset (see reset_device) to run it.
+        """
         bf = find_bf_pci_addresses_or_quit(self.id)
-        target_psid = mst_flint(bf)["PSID"]
+        current = fw_info(bf)
+        target_psid = current["PSID"]
         print(f"Bluefield-{self.detected_version} detected")
 
         assert self.detected_version is not None
@@ -425,38 +484,54 @@ class BFFirmware:
         else:
             version = r.get_latest_version()
             print("Installing latest version: %s" % version)
-        if mst_flint(bf)["FW Version"] == version:
+        if current["FW Version"] == version:
             print(f"currently already on {version}")
-            return Result("", "", 0)
+            return False
 
         d = r.get_distros(version)
         print("Distros: %s" % d)
 
-        for e in d:
-            os_param = r.get_os(version, e)
-            print(os_param)
-
-            if os_param != target_psid:
-                continue
-
-            url = r.get_download_info(version, e, os_param)["files"][0]["url"]
-            print(url)
+        burnt = False
+        # BFs are burnt in parallel, every one downloads to a directory of its own
+        with tempfile.TemporaryDirectory(prefix=f"bf{self.id}-fw-") as tmp:
+            for e in d:
+                os_param = r.get_os(version, e)
+                print(os_param)
+
+                if os_param != target_psid:
+                    continue
+
+                url = r.get_download_info(version, e, os_param)["files"][0]["url"]
+                print(url)
+
+                run(f"wget -q {url} -O {tmp}/fw.zip")
+                ret = run(f"unzip -o {tmp}/fw.zip -d {tmp}", capture_output=True)
+                bin_name = [x for x in ret.out.split() if ".bin" in x]
+                print(f"bin_name: {bin_name}")
+                if len(bin_name) != 1:
+                    print("unexpected number of binaries to download")
+                run(
+                    f"mstflint -y -d {bf} -i {bin_name[0]} burn",
+                    progress=MstflintProgress(f"BF{self.id} firmware burn"),
+                )
+                burnt = True
+        return burnt
 
-            run(f"wget -q {url} -O fw.zip")
-            ret = run("unzip -o fw.zip", capture_output=True)
-            bin_name = [x for x in ret.out.split(" ") if ".bin" in x]
-            print(f"bin_name: {bin_name}")
-            if len(bin_name) != 1:
-                print("unexpected number of binaries to download")
-            run(f"mstflint -y -d {bf} -i {bin_name[0]} burn")
-            run(f"mstfwreset -y -d {bf} r")
-        return Result("", "", 0)
+    def reset_device(self) -> float:
+        return reset_bf(find_bf_pci_addresses_or_quit(self.id))
 
     def firmware_reset(self) -> None:
         bf = find_bf_pci_addresses_or_quit(self.id)
         run(f"mstconfig -y -d {bf} r")
 
 
+def reset_bf(pci: str) -> float:
+    """Firmware reset, activating burnt firmware and mstconfig changes. Returns how long it took."""
+    start = time.monotonic()
+    run(f"mstfwreset -y -d {pci} r")
+    return time.monotonic() - start
+
+
 def cx_fwup() -> None:
     run("chmod +x mlxup")
     r = run("/mlxup -y")
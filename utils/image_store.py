@@ -0,0 +1,164 @@
+"""
+Local store of firmware images. Every image is converted once, when it's first fetched,
+into a chunked format: the image is cut in fixed size chunks that are compressed one by
+one and written back to back, next to an index with the offset, compressed length and
+sha256 of every chunk. Any chunk can be read on its own, so the chunks are
+(de)compressed in parallel on all cores and can be streamed, compared or re-sent
+individually without touching the rest of the image.
+"""
+
+import concurrent.futures
+import dataclasses
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zlib
+from logger import logger
+from typing import Callable, Iterator, Optional
+
+STORE_DIR = "/var/cache/dpu-tools/images"
+
+# Uncompressed size of every chunk (except for the last one)
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Firmware images are mostly erased (0xFF) or zeroed space, fast levels compress them fine
+COMPRESS_LEVEL = 3
+
+
+@dataclasses.dataclass(frozen=True)
+class Chunk:
+    offset: int
+    length: int
+    sha256: str
+
+
+def _compress(data: bytes) -> tuple[bytes, str]:
+    # zlib releases the GIL, so threads are enough to use all cores
+    return zlib.compress(data, COMPRESS_LEVEL), hashlib.sha256(data).hexdigest()
+
+
+class ChunkedImage:
+    def __init__(self, path: str):
+        self.path = path
+        with open(f"{path}.index") as f:
+            index = json.load(f)
+        self.size: int = index["size"]
+        self.chunk_size: int = index["chunk_size"]
+        self.chunks = [Chunk(**c) for c in index["chunks"]]
+
+    @staticmethod
+    def create(src: str, path: str, workers: Optional[int] = None) -> "ChunkedImage":
+        """Convert the raw image src into a chunked image at path."""
+        size = os.path.getsize(src)
+        chunks = []
+
+        def read_chunks() -> Iterator[bytes]:
+            with open(src, "rb") as f:
+                while data := f.read(CHUNK_SIZE):
+                    yield data
+
+        # Both files are written under names of their own and renamed in place, so
+        # nothing else writing the same image can mix its writes with these
+        directory, name = os.path.split(path)
+        fd, tmp = tempfile.mkstemp(prefix=f".{name}.", dir=directory)
+        fd_index, tmp_index = tempfile.mkstemp(prefix=f".{name}.index.", dir=directory)
+        try:
+            with open(fd, "wb") as out:
+                with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                    for compressed, digest in executor.map(_compress, read_chunks()):
+                        chunks.append(Chunk(out.tell(), len(compressed), digest))
+                        out.write(compressed)
+            index = {
+                "size": size,
+                "chunk_size": CHUNK_SIZE,
+                "chunks": [dataclasses.asdict(c) for c in chunks],
+            }
+            with open(fd_index, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_index, f"{path}.index")
+            # The image only shows up once its index is there
+            os.replace(tmp, path)
+        finally:
+            for leftover in (tmp, tmp_index):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        return ChunkedImage(path)
+
+    def chunk_range(self, i: int) -> tuple[int, int]:
+        """Offset and length of chunk i in the uncompressed image"""
+        start = i * self.chunk_size
+        return start, min(self.chunk_size, self.size - start)
+
+    def read_chunk(self, i: int) -> bytes:
+        chunk = self.chunks[i]
+        with open(self.path, "rb") as f:
+            f.seek(chunk.offset)
+            data = zlib.decompress(f.read(chunk.length))
+        if hashlib.sha256(data).hexdigest() != chunk.sha256:
+            raise ValueError(f"Chunk {i} of {self.path} is corrupted")
+        return data
+
+    def iter_chunks(
+        self, indexes: Optional[list[int]] = None, workers: Optional[int] = None
+    ) -> Iterator[bytes]:
+        """
+        Decompressed chunks in order (all of them by default). Chunks are decompressed
+        in parallel, a few ahead of the one being consumed.
+        """
+        indexes = list(range(len(self.chunks))) if indexes is None else indexes
+        workers = workers or os.cpu_count() or 1
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            pending: list[concurrent.futures.Future[bytes]] = []
+            todo = iter(indexes)
+            for i in todo:
+                pending.append(executor.submit(self.read_chunk, i))
+                if len(pending) >= 2 * workers:
+                    break
+            while pending:
+                data = pending.pop(0).result()
+                next_index = next(todo, None)
+                if next_index is not None:
+                    pending.append(executor.submit(self.read_chunk, next_index))
+                yield data
+
+    def extract(self, dest: str) -> None:
+        with open(dest, "wb") as f:
+            for data in self.iter_chunks():
+                f.write(data)
+
+
+class ImageStore:
+    def __init__(self, root: str = STORE_DIR):
+        self.root = root
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, f"{name}.chunked")
+
+    def get(self, name: str, fetch: Callable[[str], str]) -> ChunkedImage:
+        """
+        The image stored under name. If it isn't in the store yet, fetch is called with a
+        scratch directory, should put the raw image in there and return its path.
+        Concurrent gets of the same image wait for the one fetching it.
+        """
+        path = self.path(name)
+        if os.path.exists(path) and os.path.exists(f"{path}.index"):
+            logger.info(f"Using {name} from the image store")
+            return ChunkedImage(path)
+
+        os.makedirs(self.root, exist_ok=True)
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # it may have been added while waiting for the lock
+            if os.path.exists(path) and os.path.exists(f"{path}.index"):
+                logger.info(f"Using {name} from the image store")
+                return ChunkedImage(path)
+            scratch = tempfile.mkdtemp(dir=self.root)
+            try:
+                src = fetch(scratch)
+                logger.info(f"Adding {name} to the image store")
+                return ChunkedImage.create(src, path)
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
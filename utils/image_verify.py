@@ -0,0 +1,141 @@
+"""
+Verification of an image flashed on a remote device against its chunked image (see
+utils/image_store.py). The remote side hashes the flashed range chunk by chunk with a few
+jobs in parallel, and every digest is compared with the one in the image index as soon as
+it comes in, so mismatches show up while the rest is still being hashed.
+"""
+
+import subprocess
+from logger import logger
+from utils.common import SSH_OPTIONS, ssh_write
+from utils.image_store import ChunkedImage
+from utils.spi_flash import SpiFlash
+
+# Number of chunks hashed at the same time on the remote side
+VERIFY_JOBS = 4
+
+
+def _hash_script(device: str, image: ChunkedImage, jobs: int) -> str:
+    last = len(image.chunks) - 1
+    _, last_length = image.chunk_range(last)
+    # every job hashes every jobs-th chunk, the last chunk is cut to the image size
+    job = (
+        f"i=$0; while [ $i -le {last} ]; do "
+        f"echo $i $(dd if={device} bs={image.chunk_size} skip=$i count=1 2>/dev/null"
+        f" | if [ $i -eq {last} ]; then head -c {last_length}; else cat; fi | sha256sum); "
+        f"i=$((i + {jobs})); done"
+    )
+    # $ is escaped so that it's expanded by the job, not by the shell starting it
+    job = job.replace("$", "\\$")
+    return " ".join(f'sh -c "{job}" {n} &' for n in range(jobs)) + " wait"
+
+
+def verify(
+    address: str, device: str, image: ChunkedImage, dry_run: bool = False
+) -> list[int]:
+    """Returns the indexes of the chunks that don't match the image."""
+    command = (
+        f"ssh {SSH_OPTIONS} {address} '{_hash_script(device, image, VERIFY_JOBS)}'"
+    )
+    if dry_run:
+        logger.info(f"[DRY RUN] Command: {command}")
+        return []
+
+    logger.info(f"Verifying {len(image.chunks)} chunks of {device} on {address}")
+    logger.debug(f"Executing: {command}")
+    process = subprocess.Popen(
+        command,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    assert process.stdout is not None
+    seen = set()
+    bad = []
+    for line in process.stdout:
+        fields = line.split()
+        if len(fields) < 2 or not fields[0].isdigit():
+            continue
+        i = int(fields[0])
+        if i >= len(image.chunks):
+            continue
+        seen.add(i)
+        if fields[1] != image.chunks[i].sha256:
+            start, length = image.chunk_range(i)
+            logger.error(f"Chunk {i} ({length} bytes at {start}) doesn't match")
+            bad.append(i)
+    process.wait()
+
+    # chunks that couldn't be read count as mismatches too
+    missing = [i for i in range(len(image.chunks)) if i not in seen]
+    if missing:
+        logger.error(f"No digest for chunks {missing}")
+    bad = sorted(bad + missing)
+    if not bad:
+        logger.info(f"All chunks of {device} match the image")
+    return bad
+
+
+def repair(
+    address: str,
+    device: str,
+    image: ChunkedImage,
+    chunks: list[int],
+    dry_run: bool = False,
+) -> bool:
+    """Rewrite the given chunks of the image, returns whether all of them were written."""
+    if device.startswith("/dev/mtd"):
+        return _repair_mtd(address, device, image, chunks, dry_run)
+    ok = True
+    for i in chunks:
+        start, length = image.chunk_range(i)
+        logger.info(f"Rewriting chunk {i} ({length} bytes at {start})")
+        result = ssh_write(
+            f"dd of={device} bs={image.chunk_size} seek={i} conv=notrunc",
+            address,
+            [image.read_chunk(i)],
+            dry_run=dry_run,
+        )
+        ok = ok and result.returncode == 0
+    return ok
+
+
+def _image_range(image: ChunkedImage, begin: int, end: int) -> bytes:
+    """The bytes [begin, end) of the image, cut short at its end"""
+    data = b""
+    for i in range(begin // image.chunk_size, len(image.chunks)):
+        start, length = image.chunk_range(i)
+        if start >= end:
+            break
+        chunk = image.read_chunk(i)
+        data += chunk[max(0, begin - start) : end - start]
+    return data
+
+
+def _repair_mtd(
+    address: str,
+    device: str,
+    image: ChunkedImage,
+    chunks: list[int],
+    dry_run: bool,
+) -> bool:
+    """
+    Flash can only be written after erasing it, a whole erase block at a time. Every chunk
+    is widened to the erase blocks it touches and programmed through SpiFlash, which
+    erases all of them, padding past the end of the image.
+    """
+    spi = SpiFlash(address, device, dry_run=dry_run)
+    ok = True
+    for i in chunks:
+        start, length = image.chunk_range(i)
+        logger.info(f"Rewriting chunk {i} ({length} bytes at {start})")
+        try:
+            erase_size = 1 if dry_run else spi.info().erase_size
+            begin = start - start % erase_size
+            end = -(-(start + length) // erase_size) * erase_size
+            spi.program(_image_range(image, begin, end), begin)
+        except (RuntimeError, ValueError) as e:
+            logger.error(f"Failed to rewrite chunk {i} of {device}: {e}")
+            ok = False
+    return ok
@@ -0,0 +1,218 @@
+"""
+Read-only access to the files of an ISO9660 image without mounting it. The directory tree
+is walked once to index every path (Rock Ridge names are used when present), after which
+every file is just a byte range of the image. The image is mmapped, so reads are served
+from the page cache, and the kernel is asked to read ahead of sequential reads.
+"""
+
+import dataclasses
+import mmap
+import os
+import struct
+from logger import logger
+from typing import Any, Optional
+
+SECTOR_SIZE = 2048
+# The volume descriptors start after the 16 sectors of the system area
+FIRST_DESCRIPTOR = 16
+DESCRIPTOR_PRIMARY = 1
+DESCRIPTOR_TERMINATOR = 255
+
+FLAG_DIRECTORY = 0x02
+
+# How far ahead of a read the kernel is asked to read the image
+READ_AHEAD = 4 * 1024 * 1024
+
+DIRECTORY_RECORD = struct.Struct("<BBI4xI4x7sBBB4xB")
+
+
+@dataclasses.dataclass(frozen=True)
+class IsoEntry:
+    offset: int
+    size: int
+    is_dir: bool
+
+
+class FileRange:
+    """
+    size bytes of a mmapped file starting at offset, i.e. one file. Closing it unmaps
+    the file if the mapping is its own, mappings shared with an IsoImage are left alone.
+    """
+
+    def __init__(
+        self, mm: Optional[mmap.mmap], offset: int, size: int, owned: bool = False
+    ):
+        self.mm = mm
+        self.offset = offset
+        self.size = size
+        self.owned = owned
+
+    def close(self) -> None:
+        if self.owned and self.mm is not None:
+            self.mm.close()
+        self.mm = None
+
+    def __enter__(self) -> "FileRange":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def read(self, start: int, length: int) -> bytes:
+        if self.mm is None or start >= self.size:
+            return b""
+        length = min(length, self.size - start)
+        begin = self.offset + start
+        # let the kernel fetch what's going to be read next while this is sent
+        ahead = begin - begin % mmap.PAGESIZE
+        ahead_length = min(length + READ_AHEAD, len(self.mm) - ahead)
+        if hasattr(mmap, "MADV_WILLNEED") and ahead_length > 0:
+            self.mm.madvise(mmap.MADV_WILLNEED, ahead, ahead_length)
+        return self.mm[begin : begin + length]
+
+
+def open_local(path: str) -> Optional[FileRange]:
+    """A regular file as a FileRange, or None if it isn't one. It has to be closed."""
+    if not os.path.isfile(path):
+        return None
+    size = os.path.getsize(path)
+    if not size:
+        return FileRange(None, 0, 0)
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return FileRange(mm, 0, size, owned=True)
+
+
+def _iso_name(name: bytes) -> str:
+    # without Rock Ridge, names are upper case and end with a version (";1")
+    text = name.decode(errors="replace").split(";")[0]
+    if text.endswith("."):
+        text = text[:-1]
+    return text.lower()
+
+
+def _rock_ridge_name(system_use: bytes) -> Optional[str]:
+    """The name in the NM entries of the System Use area, if any"""
+    name = b""
+    found = False
+    offset = 0
+    while offset + 4 <= len(system_use):
+        signature = system_use[offset : offset + 2]
+        length = system_use[offset + 2]
+        if length < 4:
+            break
+        if signature == b"NM" and length >= 5:
+            flags = system_use[offset + 4]
+            # CURRENT and PARENT flags are for "." and "..", which aren't indexed
+            if not flags & 0x06:
+                name += system_use[offset + 5 : offset + length]
+                found = True
+        offset += length
+    return name.decode(errors="replace") if found else None
+
+
+class IsoImage:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, "MADV_RANDOM"):
+            # the index is built from scattered directory sectors
+            self.mm.madvise(mmap.MADV_RANDOM)
+        self.entries: dict[str, IsoEntry] = {}
+        # paths in lower case, for images without Rock Ridge names
+        self.folded: dict[str, str] = {}
+        root = self._primary_root()
+        self.entries[""] = root
+        self._index("", root)
+        if hasattr(mmap, "MADV_NORMAL"):
+            self.mm.madvise(mmap.MADV_NORMAL)
+        logger.debug(f"Indexed {len(self.entries)} paths of {path}")
+
+    def close(self) -> None:
+        self.mm.close()
+        self.file.close()
+
+    def _primary_root(self) -> IsoEntry:
+        sector = FIRST_DESCRIPTOR
+        while (sector + 1) * SECTOR_SIZE <= len(self.mm):
+            descriptor = self.mm[sector * SECTOR_SIZE : (sector + 1) * SECTOR_SIZE]
+            if descriptor[1:6] != b"CD001":
+                break
+            if descriptor[0] == DESCRIPTOR_PRIMARY:
+                root = self._record(descriptor, 156)
+                if root is None:
+                    break
+                return root[1]
+            if descriptor[0] == DESCRIPTOR_TERMINATOR:
+                break
+            sector += 1
+        raise ValueError(f"{self.path} isn't an ISO9660 image")
+
+    def _record(self, data: bytes, offset: int) -> Optional[tuple[str, IsoEntry]]:
+        if offset + DIRECTORY_RECORD.size > len(data):
+            return None
+        length, _, extent, size, _, flags, _, _, name_length = (
+            DIRECTORY_RECORD.unpack_from(data, offset)
+        )
+        name = data[offset + 33 : offset + 33 + name_length]
+        # the System Use area follows the name, padded to an even offset
+        system_use = data[
+            offset + 33 + name_length + (1 - name_length % 2) : offset + length
+        ]
+        if name in (b"\0", b"\1"):
+            display = ""
+        else:
+            display = _rock_ridge_name(system_use) or _iso_name(name)
+        entry = IsoEntry(extent * SECTOR_SIZE, size, bool(flags & FLAG_DIRECTORY))
+        return display, entry
+
+    def _index(self, path: str, directory: IsoEntry) -> None:
+        data = self.mm[directory.offset : directory.offset + directory.size]
+        offset = 0
+        while offset < len(data):
+            length = data[offset]
+            if length == 0:
+                # records don't cross sectors, the rest of this one is padding
+                offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+                continue
+            record = self._record(data, offset)
+            offset += length
+            if record is None:
+                break
+            name, entry = record
+            if not name:
+                continue
+            child = f"{path}/{name}" if path else name
+            self.entries[child] = entry
+            self.folded.setdefault(child.lower(), child)
+            if entry.is_dir and entry.offset != directory.offset:
+                self._index(child, entry)
+
+    def lookup(self, path: str) -> Optional[IsoEntry]:
+        path = path.strip("/")
+        if path not in self.entries:
+            path = self.folded.get(path.lower(), path)
+        return self.entries.get(path)
+
+    def exists(self, path: str) -> bool:
+        return self.lookup(path) is not None
+
+    def listdir(self, path: str) -> list[str]:
+        entry = self.lookup(path)
+        if entry is None or not entry.is_dir:
+            raise NotADirectoryError(path)
+        prefix = path.strip("/")
+        prefix = self.folded.get(prefix.lower(), prefix)
+        prefix = f"{prefix}/" if prefix else ""
+        return sorted(
+            p[len(prefix) :]
+            for p in self.entries
+            if p.startswith(prefix) and p and "/" not in p[len(prefix) :]
+        )
+
+    def open(self, path: str) -> Optional[FileRange]:
+        entry = self.lookup(path)
+        if entry is None or entry.is_dir:
+            return None
+        return FileRange(self.mm, entry.offset, entry.size)
@@ -0,0 +1,146 @@
+"""
+Progress of long running tools (dd, mstflint burn) turned into structured events. A parser
+is handed to run() or ssh_write(), it picks the progress out of the output of the tool
+and produces events with the amount done, rate and ETA. Events are logged at most every
+LOG_INTERVAL seconds, whatever the tool prints, and the last one of every parser created
+while a step runs ends up in the step timing report (see utils/steps.py).
+"""
+
+import dataclasses
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from logger import logger
+from typing import Iterator, Optional
+
+# Minimum time between two logged events of the same parser
+LOG_INTERVAL = 5.0
+
+
+@dataclasses.dataclass(frozen=True)
+class ProgressEvent:
+    name: str
+    done: float
+    total: Optional[float]
+    unit: str
+    elapsed: float
+    # per second, since the parser was created (right before the tool started)
+    rate: float
+    eta: Optional[float]
+
+    def __str__(self) -> str:
+        text = f"{self.name}: {_amount(self.done, self.unit)}"
+        if self.total and self.unit != "%":
+            text += (
+                f" of {_amount(self.total, self.unit)} ({self.done / self.total:.0%})"
+            )
+        text += f" in {self.elapsed:.1f}s, {_amount(self.rate, self.unit)}/s"
+        if self.eta is not None:
+            text += f", ETA {self.eta:.0f}s"
+        return text
+
+
+def _amount(value: float, unit: str) -> str:
+    if unit != "B":
+        return f"{value:.0f}{unit}"
+    for prefix in ["", "Ki", "Mi", "Gi"]:
+        if value < 1024:
+            break
+        value /= 1024
+    return f"{value:.1f}{prefix}B"
+
+
+_recording = threading.local()
+
+
+@contextmanager
+def recording() -> Iterator[list["ProgressParser"]]:
+    """Collect the parsers created by the current thread while in the with block"""
+    parsers: list[ProgressParser] = []
+    previous = getattr(_recording, "parsers", None)
+    _recording.parsers = parsers
+    try:
+        yield parsers
+    finally:
+        _recording.parsers = previous
+
+
+class ProgressParser(ABC):
+    unit = "B"
+
+    def __init__(self, name: str, total: Optional[float] = None):
+        self.name = name
+        self.total = total
+        self.events: list[ProgressEvent] = []
+        self.last: Optional[ProgressEvent] = None
+        self.start = time.monotonic()
+        self.logged = 0.0
+        self.lock = threading.Lock()
+        parsers = getattr(_recording, "parsers", None)
+        if parsers is not None:
+            parsers.append(self)
+
+    @abstractmethod
+    def parse(self, line: str) -> Optional[tuple[float, Optional[float]]]:
+        """(amount done, total if the line tells) or None if the line isn't progress"""
+        pass
+
+    def feed(self, line: str) -> bool:
+        """Take a line of output, returns whether it was progress"""
+        parsed = self.parse(line)
+        if parsed is None:
+            return False
+        done, total = parsed
+        now = time.monotonic()
+        with self.lock:
+            total = total or self.total
+            elapsed = now - self.start
+            rate = done / elapsed if elapsed > 0 else 0.0
+            eta = None
+            if total and rate > 0:
+                eta = max(0.0, (total - done) / rate)
+            self.last = ProgressEvent(
+                self.name, done, total, self.unit, elapsed, rate, eta
+            )
+            if now - self.logged >= LOG_INTERVAL:
+                self.logged = now
+                self.events.append(self.last)
+                logger.info(str(self.last))
+        return True
+
+    def finish(self) -> Optional[ProgressEvent]:
+        """Log the final state, returns it or None if no progress was seen"""
+        with self.lock:
+            if self.last is not None and (
+                not self.events or self.events[-1] is not self.last
+            ):
+                self.events.append(self.last)
+                logger.info(str(self.last))
+            return self.last
+
+
+class DdProgress(ProgressParser):
+    """dd with status=progress, and the summary it prints at the end anyway"""
+
+    pattern = re.compile(r"^(\d+) bytes .*copied")
+
+    def parse(self, line: str) -> Optional[tuple[float, Optional[float]]]:
+        match = self.pattern.match(line.strip())
+        if match is None:
+            return None
+        return float(match.group(1)), None
+
+
+class MstflintProgress(ProgressParser):
+    """The percentage shown by mstflint burn"""
+
+    unit = "%"
+    pattern = re.compile(r"(\d+)%")
+
+    def parse(self, line: str) -> Optional[tuple[float, Optional[float]]]:
+        match = self.pattern.search(line)
+        if match is None:
+            return None
+        return float(match.group(1)), 100.0
@@ -1,9 +1,12 @@
 import argparse
+import dataclasses
+import fcntl
+import functools
 import http.server
 import io
+import json
 import os
 import paramiko
-import pexpect
 import requests
 import shutil
 import signal
@@ -11,46 +14,160 @@ import sys
 import threading
 import time
 import typing
+import urllib.parse
 
 from multiprocessing import Process
-from typing import Union
+from typing import Any, Callable, Optional, Union
 
 from utils import common_bf
+from utils.boot_profile import PXEBOOT_MILESTONES, BootProfiler
 from utils.common import run
-from utils.minicom import pexpect_child_wait
+from utils.console import ConsoleDevice, open_console
+from utils.iso9660 import FileRange, IsoImage, open_local
+from utils.reachability import wait_any_reachable
+from utils import tftp
+from utils.uefi_menu import UefiMenu
+
+# Device path of the tmfifo (rshim) interface as shown in the Boot Manager help text, and
+# the name the BF firmware gives to its boot entry
+TMFIFO_DEVICE_PATH = "MAC.001ACAFFFF..,0x1.*IPv4.0.0.0.0."
+TMFIFO_ENTRY = "RSHIM.*IPV4"
+BOOT_MANAGER_ENTRY = r"\bBoot Manager\b"
+
+# Lock files of the servers, in the staging directory of the rshim. Every process of a
+# pxeboot holds the lock on its file (with flock) for as long as it runs and has its pid
+# written in it, so a locked file always names a live process of this rshim.
+SERVICE_LOCKS = ["dhcpd.lock", "tftpd.lock", "http.lock"]
+PXEBOOT_LOCK = "pxeboot.lock"
+
+# How long a killed process gets to release its lock
+LOCK_RELEASE_TIMEOUT = 5
+
+# Everything a pxeboot of a BF needs is kept in a directory of its own, one per rshim, so
+# that several BFs in the same host can be pxebooted at the same time
+STAGING_DIR = "/var/lib/dpu-tools/pxeboot"
+
+# Attempts at pxebooting before giving up
+MAX_RETRIES = 6
+
+# How long the installed OS gets to accept ssh logins once the BF is on the network
+LOGIN_TIMEOUT = 1800
+
+# Files served straight from the ISO, by the path they are requested with. The whole ISO
+# is also available under mnt/ (the installation repo).
+ISO_FILES = {
+    "pxelinux/vmlinuz": "images/pxeboot/vmlinuz",
+    "pxelinux/initrd.img": "images/pxeboot/initrd.img",
+    "pxelinux/ignition.img": "images/ignition.img",
+    "vmlinuz": "images/pxeboot/vmlinuz",
+    "initrd.img": "images/pxeboot/initrd.img",
+    "rootfs.img": "images/pxeboot/rootfs.img",
+}
+ISO_REPO_PREFIX = "mnt/"
+
+# Size of the writes serving a file over http
+HTTP_BLOCK_SIZE = 1024 * 1024
+
+
+class IsoHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+    """GET and HEAD (with byte ranges) of the files given by resolve"""
+
+    def __init__(
+        self, *args: Any, resolve: Callable[[str], Optional[FileRange]], **kwargs: Any
+    ):
+        self.resolve = resolve
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self) -> None:
+        self.send_file(head=False)
+
+    def do_HEAD(self) -> None:
+        self.send_file(head=True)
+
+    def send_file(self, head: bool) -> None:
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        data = self.resolve(path)
+        if data is None:
+            self.send_error(404, "File not found")
+            return
+        with data:
+            self.send_range(data, head)
+
+    def send_range(self, data: FileRange, head: bool) -> None:
+        start, end = 0, data.size - 1
+        requested = self.headers.get("Range", "")
+        if requested.startswith("bytes=") and "," not in requested:
+            first, _, last = requested[len("bytes=") :].partition("-")
+            try:
+                if first:
+                    start = int(first)
+                    end = min(int(last), end) if last else end
+                else:
+                    start = max(0, data.size - int(last))
+            except ValueError:
+                start, end = 0, data.size - 1
+            if start > end:
+                self.send_error(416, "Requested range not satisfiable")
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{data.size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if head:
+            return
+        offset = start
+        while offset <= end:
+            chunk = data.read(offset, min(HTTP_BLOCK_SIZE, end + 1 - offset))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            offset += len(chunk)
+
+
+@dataclasses.dataclass(frozen=True)
+class Stage:
+    name: str
+    run: Callable[[], None]
+    # where to start over when this stage fails, e.g. a failure in the UEFI menu means the
+    # BF has to be rebooted but the staged files and running servers can be kept
+    retry_from: str
 
 
 class Pxeboot:
     def __init__(self, args: argparse.Namespace):
         self.install_entry = "Install OS"
-        self.children: list[Process] = []
+        self.services: dict[str, Process] = {}
+        self.completed: set[str] = set()
+        self.response_ip = ""
         self.args: argparse.Namespace = args
-        self.ip = "172.31.100.1"
+        # every rshim gets its own tmfifo interface, subnet and servers
+        self.rshim = args.bf_id // 2
+        self.net = f"172.31.{100 + self.rshim}"
+        self.ip = f"{self.net}.1"
         self.net_prefix = "24"
-        self.subnet = "172.31.100.0"
-        self.port = "tmfifo_net0"
+        self.subnet = f"{self.net}.0"
+        self.port = f"tmfifo_net{self.rshim}"
+        self.staging_dir = os.path.join(STAGING_DIR, f"rshim{self.rshim}")
+        self.tftp_dir = os.path.join(self.staging_dir, "tftpboot")
+        self.www_dir = os.path.join(self.staging_dir, "www")
+        self.iso: Optional[IsoImage] = None
+        self.profiler: typing.Optional[BootProfiler] = None
+        self.attempt = 0
+        # locks held by this process, by the name of their file
+        self.locks: dict[str, int] = {}
+
+    def staging_path(self, name: str) -> str:
+        return os.path.join(self.staging_dir, name)
 
     def exit(self, code: int) -> typing.NoReturn:
-        for p in self.children:
-            p.terminate()
+        self.finish_profile("ok" if code == 0 else "failed")
+        self.stop_services()
         sys.exit(code)
 
-    def wait_any_ping(self, hn: list[str], timeout: float) -> str:
-        print("Waiting for response from ping")
-        begin = time.time()
-        end = begin
-        while end - begin < timeout:
-            for e in hn:
-                if self.ping(e):
-                    return e
-            time.sleep(5)
-            end = time.time()
-        raise Exception(f"No response after {round(end - begin, 2)}s")
-
-    def ping(self, hn: str) -> bool:
-        ping_cmd = f"timeout 1 ping -4 -c 1 {hn}"
-        return run(ping_cmd).returncode == 0
-
     def write_file(self, fn: str, contents: str) -> None:
         with open(fn, "w") as f:
             f.write(contents)
@@ -64,7 +181,7 @@ class Pxeboot:
             print(f"Couldn't read iso file {self.args.iso}")
             exit(-1)
 
-        common_bf.find_bf_pci_addresses_or_quit(self.args.id)
+        common_bf.find_bf_pci_addresses_or_quit(self.args.bf_id)
 
     def dhcp_config(self, server_ip: str, subnet: str) -> str:
         return f"""option space pxelinux;
@@ -82,8 +199,8 @@ class Pxeboot:
     filename "/BOOTAA64.EFI";
 
     subnet {subnet} netmask 255.255.255.0 {{
-        range 172.31.100.10 172.31.100.20;
-        option broadcast-address 172.31.100.255;
+        range {self.net}.10 {self.net}.20;
+        option broadcast-address {self.net}.255;
         option routers {server_ip};
         option domain-name-servers 10.19.42.41, 10.11.5.19, 10.2.32.1;
         option domain-search "anl.lab.eng.bos.redhat.com";
@@ -117,7 +234,7 @@ class Pxeboot:
     """
 
     def rshim_base(self) -> str:
-        return f"/dev/rshim{self.args.id//2}/"
+        return f"/dev/rshim{self.rshim}/"
 
     def bf_reboot(self) -> None:
         print("Rebooting bf")
@@ -126,7 +243,7 @@ class Pxeboot:
 
     def get_uefiboot_img(self) -> None:
         print("Ensuring efiboot_img is downloaded or copied to the right place")
-        dst = "efiboot.img"
+        dst = self.staging_path("efiboot.img")
         if self.args.efiboot_img.startswith("http://"):
             print(f"Downloading efiboot.img from {self.args.efiboot_img}")
             response = requests.get(self.args.efiboot_img)
@@ -138,114 +255,105 @@ class Pxeboot:
     def os_name(self, is_coreos: bool) -> str:
         return "CoreOS" if is_coreos else "RHEL"
 
-    def prepare_pxe(self) -> None:
+    def configure_network(self) -> None:
         run(f"ip a f {self.port}")
         run(f"ip a a {self.ip}/{self.net_prefix} dev {self.port}")
 
-        iso_mount_path = "/var/ftp/mnt"
-        os.makedirs(iso_mount_path, exist_ok=True)
-        run(f"umount {iso_mount_path}")
-        run(f"mount -t iso9660 -o loop {self.args.iso} {iso_mount_path}")
+    def open_iso(self) -> IsoImage:
+        """The ISO is read in place, its index is only built once"""
+        if self.iso is None:
+            start = time.monotonic()
+            self.iso = IsoImage(self.args.iso)
+            print(
+                f"Indexed {len(self.iso.entries)} files of {self.args.iso} in {time.monotonic() - start:.2f}s"
+            )
+        return self.iso
+
+    def resolve(self, path: str, local_dir: str) -> Optional[FileRange]:
+        """What a request for path serves, from the ISO or the files in local_dir"""
+        parts = [p for p in path.split("/") if p and p != "."]
+        if ".." in parts:
+            return None
+        path = "/".join(parts)
+        if path in ISO_FILES:
+            return self.open_iso().open(ISO_FILES[path])
+        if path.startswith(ISO_REPO_PREFIX):
+            return self.open_iso().open(path[len(ISO_REPO_PREFIX) :])
+        return open_local(os.path.join(local_dir, path))
 
-        time.sleep(10)
-        self.args.is_coreos = os.path.exists("/var/ftp/mnt/coreos")
+    def prepare_pxe(self) -> None:
+        os.makedirs(self.tftp_dir, exist_ok=True)
+        iso = self.open_iso()
+        self.args.is_coreos = iso.exists("coreos")
 
         print(f"{self.os_name(self.args.is_coreos)} detected")
 
         rhel_files = ["BOOTAA64.EFI", "grubaa64.efi", "mmaa64.efi"]
 
-        if not all(map(os.path.exists, rhel_files)):
-            if not os.path.exists("efiboot.img"):
+        if not all(os.path.exists(os.path.join(self.tftp_dir, f)) for f in rhel_files):
+            if not os.path.exists(self.staging_path("efiboot.img")):
                 self.get_uefiboot_img()
             else:
                 print("Reusing missing bootfiles")
 
-            mount_path = "/var/ftp/efibootimg"
+            mount_path = self.staging_path("efibootimg")
             os.makedirs(mount_path, exist_ok=True)
             if mount_path in run("mount").out:
                 print(run(f"umount {mount_path}"))
-            print(run(f"mount efiboot.img {mount_path}"))
+            print(run(f"mount {self.staging_path('efiboot.img')} {mount_path}"))
 
             for file in rhel_files:
-                shutil.copy(f"{mount_path}/EFI/BOOT/{file}", "/var/lib/tftpboot/")
+                shutil.copy(f"{mount_path}/EFI/BOOT/{file}", self.tftp_dir)
 
-        ftp_files = ["images/pxeboot/vmlinuz", "images/pxeboot/initrd.img"]
-
-        if self.args.is_coreos:
-            ftp_files.append("images/ignition.img")
-        ftpboot_pxe_dir_name = "/var/lib/tftpboot/pxelinux"
-        os.makedirs(ftpboot_pxe_dir_name, exist_ok=True)
-        for file in ftp_files:
-            src = os.path.join(iso_mount_path, file)
-            shutil.copy(src, ftpboot_pxe_dir_name)
-
-        fn = "/var/lib/tftpboot/grub.cfg"
+        # the kernel and initrd are served from the ISO (see ISO_FILES)
+        fn = os.path.join(self.tftp_dir, "grub.cfg")
         print(f"writing configuration to {fn}")
         self.write_file(fn, self.grub_config("pxelinux", self.ip, self.args.is_coreos))
 
-        fn = "/etc/dhcp/dhcpd.conf"
+        fn = self.staging_path("dhcpd.conf")
         print(f"writing configuration to {fn}")
         self.write_file(fn, self.dhcp_config(self.ip, self.subnet))
 
-    def minicom_cmd(self) -> str:
-        return f"minicom --baudrate 115200 --device {self.rshim_base()}/console"
+        self.prepare_www()
+
+    def prepare_www(self) -> None:
+        # everything else, the repo included, is served from the ISO (see ISO_FILES)
+        os.makedirs(self.www_dir, exist_ok=True)
+        self.prepare_kickstart(self.ip)
+
+    def console_device(self) -> ConsoleDevice:
+        return ConsoleDevice(f"{self.rshim_base()}console", 115200)
 
     def bf_select_pxe_entry(self) -> None:
         print("selecting pxe entry in bf")
         ESC = "\x1b"
-        KEY_DOWN = "\x1b[B"
-        KEY_ENTER = "\r\n"
-
-        run("pkill -9 minicom")
-        print("spawn minicom")
-        child = pexpect.spawn(self.minicom_cmd())
-        child.maxread = 10000
-        print("waiting for instructions to enter UEFI Menu to interrupt and go to bios")
-        pexpect_child_wait(child, "Press.* enter UEFI Menu.", 120)
-        print("found UEFI prompt, sending 'esc'")
-        child.send(ESC * 10)
-        time.sleep(1)
-        child.close()
-        print("respawning minicom")
-        child = pexpect.spawn(self.minicom_cmd())
-        time.sleep(1)
-        print("pressing down")
-        child.send(KEY_DOWN)
-        time.sleep(1)
-        print("waiting on language option")
-        child.expect(
-            "This is the option.*one adjusts to change.*the language for the.*current system",
-            timeout=3,
-        )
-        print("pressing down again")
-        child.send(KEY_DOWN)
-        print("waiting for Boot manager entry")
-        child.expect("This selection will.*take you to the Boot.*Manager", timeout=3)
-        print("sending enter")
-        child.send(KEY_ENTER)
-        child.expect("Device Path")
-        retry = 30
-        print(f"Trying up to {retry} times to find tmfifo pxe boot interface")
-        while retry:
-            child.send(KEY_DOWN)
-            time.sleep(0.1)
-            try:
-                child.expect("MAC.001ACAFFFF..,0x1.*IPv4.0.0.0.0.", timeout=1)
-                break
-            except Exception:
-                retry -= 1
-        if not retry:
-            e = Exception("Didn't find boot interface")
-            print(e)
-            raise e
-        else:
-            print(f"Found boot interface after {30 - retry} tries, sending enter")
-            child.send(KEY_ENTER)
-            time.sleep(1)
+
+        print("opening console")
+        with open_console(self.console_device()) as child:
+            print(
+                "waiting for instructions to enter UEFI Menu to interrupt and go to bios"
+            )
+            child.expect("Press.* enter UEFI Menu.", 120)
+            print("found UEFI prompt, sending 'esc'")
+            child.send(ESC * 10)
+
+            menu = UefiMenu(child)
+            print("waiting for the front page")
+            menu.wait_for(BOOT_MANAGER_ENTRY, 30)
+            print(f"selecting {menu.select(BOOT_MANAGER_ENTRY)}")
+            menu.enter()
+            menu.wait_for_help("Device Path", 30)
+            print(f"Boot Manager entries: {menu.entries()}")
+
+            print("looking for the tmfifo pxe boot interface")
+            entry = menu.find(TMFIFO_DEVICE_PATH, TMFIFO_ENTRY)
+            print(f"Found boot interface '{entry}', sending enter")
+            menu.enter()
+
             timeout = 30
             print(f"Waiting {timeout} seconds for Station IP address prompt")
             try:
-                child.expect("Station IP address.*", timeout=timeout)
+                child.expect("Station IP address.*", timeout)
             except Exception:
                 e = Exception("Kernel boot failed to begin")
                 print(e)
@@ -253,7 +361,7 @@ class Pxeboot:
 
             print(f"Waiting {timeout} seconds for grub")
             try:
-                child.expect(f".*{self.install_entry}.*", timeout=timeout)
+                child.expect(f".*{self.install_entry}.*", timeout)
             except Exception:
                 e = Exception("Kernel boot failed to begin")
                 print(e)
@@ -262,24 +370,90 @@ class Pxeboot:
             max_tries = 10
             total_time = max_tries * 30
             print(f"Waiting {total_time} sec for EFI stub message")
-            elapsed = pexpect_child_wait(child, "EFI stub: .*", total_time)
+            elapsed = child.expect("EFI stub: .*", total_time)
             print(f"Found EFI stub message after {elapsed}s, kernel is booting")
             time.sleep(1)
-        child.close()
-        print("Closing minicom")
-
-    def run(self, cmd: str) -> Process:
-        p = Process(target=run, args=(cmd,))
-        p.start()
-        return p
+        print("Closed console")
+
+    def dhcpd(self) -> None:
+        self.hold_lock("dhcpd.lock")
+        leases = self.staging_path("dhcpd.leases")
+        # dhcpd replaces this process, keeping the lock held for as long as it runs
+        os.execv(
+            "/usr/sbin/dhcpd",
+            ["/usr/sbin/dhcpd", "-f", "-cf", self.staging_path("dhcpd.conf")]
+            + ["-lf", leases, "-pf", self.staging_path("dhcpd.pid")]
+            + ["-user", "dhcpd", "-group", "dhcpd", self.port],
+        )
 
     def http_server(self) -> None:
-        os.chdir("/www")
-        server_address = ("", 80)
-        handler = http.server.SimpleHTTPRequestHandler
-        httpd = http.server.HTTPServer(server_address, handler)
+        self.hold_lock("http.lock")
+        server_address = (self.ip, 80)
+        handler = functools.partial(
+            IsoHTTPRequestHandler,
+            resolve=functools.partial(self.resolve, local_dir=self.www_dir),
+        )
+        httpd = http.server.ThreadingHTTPServer(server_address, handler)
         httpd.serve_forever()
 
+    def tftp_server(self) -> None:
+        self.hold_lock("tftpd.lock")
+        tftp.serve(self.ip, functools.partial(self.resolve, local_dir=self.tftp_dir))
+
+    def hold_lock(self, name: str) -> None:
+        """
+        Take the lock of a process of this pxeboot, it's held until the process exits.
+        Locks inherited from the parent are dropped, they'd otherwise be held by the
+        child too and name the parent once it's gone.
+        """
+        for fd in self.locks.values():
+            os.close(fd)
+        self.locks.clear()
+        fd = os.open(self.staging_path(name), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode())
+        # dhcpd is exec'ed and has to keep holding it
+        os.set_inheritable(fd, True)
+        self.locks[name] = fd
+
+    def kill_holder(self, name: str) -> None:
+        """
+        Kill the process of a previous run for this BF that holds the lock name. Only a
+        locked file is trusted to name a live process, a stale pid may have been reused.
+        """
+        try:
+            f = open(self.staging_path(name), "r")
+        except FileNotFoundError:
+            return
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                pass
+            try:
+                pid = int(f.read().strip())
+            except ValueError:
+                # taken, but the pid isn't written yet
+                pid = 0
+            if pid == os.getpid():
+                return
+            if pid:
+                print(f"Killing pid {pid} from {f.name}")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            deadline = time.monotonic() + LOCK_RELEASE_TIMEOUT
+            while time.monotonic() < deadline:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return
+                except BlockingIOError:
+                    time.sleep(0.1)
+            print(f"{f.name} is still locked")
+
     def split_nfs_path(self, n: str) -> tuple[str, str]:
         splitted = n.split(":")
         return splitted[0], ":".join(splitted[1:])
@@ -299,48 +473,71 @@ class Pxeboot:
         except paramiko.ssh_exception.SSHException:
             return paramiko.Ed25519Key.from_private_key(io.StringIO(key))
 
-    def wait_and_login(self, ip: str) -> None:
+    def wait_and_login(
+        self, ip: str, timeout: float = LOGIN_TIMEOUT
+    ) -> paramiko.SSHClient:
+        """
+        Log into the BF as soon as it accepts ssh, and return the session. The key is only
+        parsed once, and a full handshake is only attempted once sshd answers on its port.
+        """
         with open(self.args.key, "r") as f:
-            key = f.read().strip()
+            pkey = self.get_private_key(f.read().strip())
 
+        deadline = time.monotonic() + timeout
+        delay = 1.0
         while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Couldn't log into {ip} within {timeout}s")
+            if wait_any_reachable([ip], remaining, banner=True) is None:
+                continue
+            host = paramiko.SSHClient()
+            host.set_missing_host_key_policy(paramiko.AutoAddPolicy())
             try:
-                host = paramiko.SSHClient()
-                host.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                pkey = self.get_private_key(key)
-                host.connect(ip, username="core", pkey=pkey)
-                break
-            except paramiko.ssh_exception.NoValidConnectionsError as e:
+                host.connect(
+                    ip,
+                    username="core",
+                    pkey=pkey,
+                    timeout=10,
+                    banner_timeout=10,
+                    auth_timeout=10,
+                    look_for_keys=False,
+                    allow_agent=False,
+                )
+                print("BF is up (ssh connection established)")
+                return host
+            except (paramiko.SSHException, OSError) as e:
+                # sshd can be up before the user is provisioned
                 print(f"Unable to establish SSH connection: {e}")
-            except Exception as e:
-                print(f"Got exception {e}")
-            time.sleep(10)
-
-        print("BF is up (ssh connection established)")
-        local_date = run("date").out
-        print(f"setting date to {local_date}")
-        host.exec_command(f"sudo date -s '{local_date}'")
-
-    def capture_minicom(
+                host.close()
+            time.sleep(min(delay, max(0, deadline - time.monotonic())))
+            delay = min(delay * 2, 10)
+
+    def remote_command(self, host: paramiko.SSHClient, cmd: str) -> str:
+        _, stdout, stderr = host.exec_command(cmd)
+        out: str = stdout.read().decode("utf-8", errors="replace")
+        if stdout.channel.recv_exit_status():
+            print(f"'{cmd}' failed: {stderr.read().decode('utf-8', errors='replace')}")
+        return out
+
+    def capture_console(
         self,
         stop_event: threading.Event,
         output: list[bytes],
     ) -> None:
-        child = pexpect.spawn(self.minicom_cmd())
-
-        while not stop_event.is_set():
-            try:
-                chunk = child.read_nonblocking(size=1024, timeout=1)
-                output.append(chunk)
-            except pexpect.TIMEOUT:
-                pass
-            except pexpect.EOF:
-                print("Minicom exited unexpectedly while capturing output")
-                break
+        with open_console(self.console_device()) as console:
+            while not stop_event.is_set():
+                try:
+                    chunk = console.read_nonblocking(size=1024, timeout=1)
+                except EOFError:
+                    print("Console closed unexpectedly while capturing output")
+                    break
+                if chunk:
+                    output.append(chunk)
 
     def prepare_kickstart(self, ip: str) -> None:
         ks = "kickstart.ks"
-        dst = os.path.join("/www", ks)
+        dst = os.path.join(self.www_dir, ks)
         if os.path.exists(dst):
             os.remove(dst)
 
@@ -356,60 +553,111 @@ class Pxeboot:
         with open(dst, "w") as file:
             file.write(updated_content)
 
-    def try_pxy_boot(self) -> str:
+    def prepare_inputs(self) -> None:
         self.validate_args()
 
         if ":/" in self.args.iso:
-            self.args.iso = self.mount_nfs_path(self.args.iso, "/mnt/nfs_iso")
+            self.args.iso = self.mount_nfs_path(
+                self.args.iso, self.staging_path("nfs_iso")
+            )
 
         if ":/" in self.args.key:
-            self.args.key = self.mount_nfs_path(self.args.key, "/mnt/nfs_key")
-
-        self.port = "tmfifo_net0"
-        self.prepare_pxe()
-
+            self.args.key = self.mount_nfs_path(
+                self.args.key, self.staging_path("nfs_key")
+            )
+
+    def start_profile(self) -> None:
+        """Follow the boot on the console from the reboot on, see utils/boot_profile.py"""
+        self.finish_profile("failed")
+        self.attempt += 1
+        labels = {
+            "iso": os.path.basename(self.args.iso),
+            "attempt": str(self.attempt),
+        }
+        try:
+            bf = common_bf.find_bf_pci_addresses_or_quit(self.args.bf_id)
+            labels["firmware"] = common_bf.fw_info(bf).get("FW Version", "")
+        except (KeyError, OSError) as e:
+            print(f"Couldn't get the firmware version for the boot timeline: {e}")
+        self.profiler = BootProfiler(
+            f"BF{self.args.bf_id}-pxeboot",
+            self.console_device(),
+            PXEBOOT_MILESTONES,
+            labels,
+        )
+        self.profiler.begin()
+
+    def finish_profile(self, result: str) -> None:
+        if self.profiler is None:
+            return
+        self.profiler.end()
+        self.profiler.timeline.labels["result"] = result
+        self.profiler.save()
+        self.profiler = None
+
+    def reboot_bf(self) -> None:
+        self.start_profile()
         if not self.args.wait_minicom:
             self.bf_reboot()
         else:
-            print("Skipping BF reboot since not using minicom")
+            print("Skipping BF reboot since the pxe entry is selected manually")
 
         # need to wait long enough after reboot before setting
         # ip, otherwise it will be removed again
         time.sleep(5)
         run(f"ip a a {self.ip}/{self.net_prefix} dev {self.port}")
 
-        print("starting dhpcd")
-        run("killall dhcpd")
-        p = self.run(
-            "/usr/sbin/dhcpd -f -cf /etc/dhcp/dhcpd.conf -user dhcpd -group dhcpd"
-        )
-        self.children.append(p)
-
-        os.makedirs("/www", exist_ok=True)
-        src_rootfs = "/var/ftp/mnt/images/pxeboot/rootfs.img"
-        if not os.path.exists("/www/rootfs.img") and os.path.exists(src_rootfs):
-            shutil.copy(src_rootfs, "/www")
-
-        self.prepare_kickstart(self.ip)
-
-        base = "/var/lib/tftpboot/pxelinux"
-        os.makedirs("/www/", exist_ok=True)
-        if not os.path.exists("/www/vmlinuz"):
-            shutil.copy(os.path.join(base, "vmlinuz"), "/www/vmlinuz")
-        if not os.path.exists("/www/initrd.img"):
-            shutil.copy(os.path.join(base, "initrd.img"), "/www/initrd.img")
-        if not os.path.exists("/www/mnt") and os.path.exists("/var/ftp/mnt/images"):
-            run("ln -s /var/ftp/mnt /www/mnt")
+    def start_dhcpd(self) -> Process:
+        self.kill_holder("dhcpd.lock")
+        leases = self.staging_path("dhcpd.leases")
+        if not os.path.exists(leases):
+            self.write_file(leases, "")
+            shutil.chown(leases, "dhcpd", "dhcpd")
+        p = Process(target=self.dhcpd)
+        p.start()
+        return p
 
-        print("starting http server")
+    def start_http(self) -> Process:
+        self.kill_holder("http.lock")
         p = Process(target=self.http_server)
         p.start()
-        self.children.append(p)
+        return p
 
-        print("starting in.tftpd")
-        run("killall in.tftpd")
-        p = self.run("/usr/sbin/in.tftpd -s -L /var/lib/tftpboot")
-        self.children.append(p)
+    def start_tftpd(self) -> Process:
+        self.kill_holder("tftpd.lock")
+        p = Process(target=self.tftp_server)
+        p.start()
+        return p
+
+    def start_services(self) -> None:
+        """Start dhcpd, the http and tftp servers, keeping those that are still running"""
+        # index the ISO before the servers are forked, so they share it rather than each
+        # of them indexing it on its first request
+        self.open_iso()
+        starters = {
+            "dhcpd": self.start_dhcpd,
+            "http server": self.start_http,
+            "tftp server": self.start_tftpd,
+        }
+        for name, start in starters.items():
+            p = self.services.get(name)
+            if p is not None and p.is_alive():
+                print(f"{name} is still running")
+                continue
+            print(f"starting {name}")
+            self.services[name] = start()
+
+    def stop_services(self) -> None:
+        print("Terminating http, tftp, and dhcpd")
+        for p in self.services.values():
+            p.terminate()
+        for p in self.services.values():
+            p.join(5)
+        self.services.clear()
+        for lock in SERVICE_LOCKS:
+            self.kill_holder(lock)
+
+    def select_pxe_entry(self) -> None:
         if self.args.wait_minicom:
             print("Entering indefinite wait")
             while True:
@@ -417,70 +665,129 @@ class Pxeboot:
         else:
             self.bf_select_pxe_entry()
 
+    def wait_for_boot(self) -> None:
         stop_event = threading.Event()
         output: list[bytes] = []
-        minicom_watch = threading.Thread(
-            target=self.capture_minicom, args=(self.args, stop_event, output)
+        console_watch = threading.Thread(
+            target=self.capture_console, args=(stop_event, output)
         )
-        minicom_watch.start()
+        console_watch.start()
 
         ping_exception = None
         try:
-            candidates = [f"172.31.100.{x}" for x in range(10, 21)]
-            response_ip = self.wait_any_ping(candidates, 180)
-            print(f"got response from {response_ip}")
+            candidates = [f"{self.net}.{x}" for x in range(10, 21)]
+            print("Waiting for the BF to come up on the network")
+            # the installer doesn't necessarily run sshd, any answer on the port will do
+            response_ip = wait_any_reachable(candidates, 180, accept_refused=True)
+            if response_ip is None:
+                raise Exception("No response from the BF after 180s")
+            self.response_ip = response_ip
+            print(f"got response from {self.response_ip}")
+            if self.profiler is not None:
+                self.profiler.timeline.ready = self.profiler.elapsed()
         except Exception as e:
             ping_exception = e
-            # keep linter happy
-            response_ip = ""
         stop_event.set()
-        minicom_watch.join()
+        console_watch.join()
         output2 = b"".join(output)
         output_str = output2.decode("utf-8", errors="replace")
         print(output_str)
         if ping_exception is not None:
             raise ping_exception
 
+    def login(self) -> None:
         if self.args.key:
-            self.wait_and_login(response_ip)
+            with self.wait_and_login(self.response_ip) as host:
+                local_date = run("date").out.strip()
+                print(f"setting date to {local_date}")
+                self.remote_command(host, f"sudo date -s '{local_date}'")
+                print(self.remote_command(host, "ip --json a"))
         else:
             # avoid killing services to allow booting
             time.sleep(1000)
 
-        print("Terminating http, ftp, and dhcpd")
-        for ch in self.children:
-            ch.terminate()
-        print(response_ip)
-        return response_ip
+    def stages(self) -> list[Stage]:
+        return [
+            Stage("prepare_inputs", self.prepare_inputs, "prepare_inputs"),
+            Stage("stage_artifacts", self.prepare_pxe, "stage_artifacts"),
+            Stage("configure_network", self.configure_network, "configure_network"),
+            Stage("reboot_bf", self.reboot_bf, "reboot_bf"),
+            Stage("start_services", self.start_services, "reboot_bf"),
+            Stage("select_pxe_entry", self.select_pxe_entry, "reboot_bf"),
+            Stage("wait_for_boot", self.wait_for_boot, "reboot_bf"),
+            Stage("login", self.login, "login"),
+        ]
+
+    def artifacts_fingerprint(self) -> str:
+        st = os.stat(self.args.iso)
+        return f"{os.path.realpath(self.args.iso)}:{st.st_size}:{st.st_mtime_ns}:{self.args.efiboot_img}"
+
+    def load_checkpoint(self) -> None:
+        """
+        Staged artifacts survive across runs, so they don't need to be staged again if
+        the previous run used the same ISO.
+        """
+        try:
+            checkpoint = json.loads(
+                self.read_file(self.staging_path("checkpoint.json"))
+            )
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        if checkpoint.get(
+            "artifacts"
+        ) == self.artifacts_fingerprint() and os.path.exists(
+            os.path.join(self.tftp_dir, "grub.cfg")
+        ):
+            print(f"Reusing the artifacts staged in {self.staging_dir}")
+            self.completed.add("stage_artifacts")
+
+    def save_checkpoint(self) -> None:
+        checkpoint = {"artifacts": self.artifacts_fingerprint()}
+        self.write_file(self.staging_path("checkpoint.json"), json.dumps(checkpoint))
+
+    def run_stages(self) -> None:
+        stages = self.stages()
+        names = [stage.name for stage in stages]
+        resume = 0
+        for retry in range(MAX_RETRIES):
+            current = stages[resume]
+            try:
+                for current in stages[resume:]:
+                    if current.name in self.completed:
+                        print(f"Stage {current.name} is already done")
+                        continue
+                    print(f"Stage {current.name}")
+                    current.run()
+                    self.completed.add(current.name)
+                    if current.name == "prepare_inputs":
+                        self.load_checkpoint()
+                    elif current.name == "stage_artifacts":
+                        self.save_checkpoint()
+                return
+            except Exception as e:
+                print(e)
+                resume = names.index(current.retry_from)
+                self.completed -= set(names[resume:])
+                print(
+                    f"pxe boot failed in stage {current.name}, retrying from"
+                    f" {current.retry_from} (count {retry + 1})"
+                )
+        print("pxe boot reached max retries unsuccessfully")
+        self.exit(-1)
 
     def kill_existing(self) -> None:
-        pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
-
-        own_pid = os.getpid()
-        for pid in filter(lambda x: int(x) != own_pid, pids):
-            try:
-                with open(os.path.join("/proc", pid, "cmdline"), "rb") as f:
-                    # print(f.read().decode("utf-8"))
-                    zb = b"\x00"
-                    cmd = [x.decode("utf-8") for x in f.read().strip(zb).split(zb)]
-                    if cmd[0] == "python3" and os.path.basename(cmd[1]) == "pxeboot":
-                        print(f"Killing pid {pid}")
-                        os.kill(int(pid), signal.SIGKILL)
-            except Exception:
-                pass
+        """
+        Kill a previous pxeboot of the same BF (along with its servers). Pxeboots of other
+        BFs are left alone since they don't share anything with this one.
+        """
+        self.kill_holder(PXEBOOT_LOCK)
+        for lock in SERVICE_LOCKS:
+            self.kill_holder(lock)
 
     def start_pxeboot(self) -> None:
+        os.makedirs(self.staging_dir, exist_ok=True)
         self.kill_existing()
-        for retry in range(6):
-            try:
-                self.try_pxy_boot()
-                exit(0)
-            except Exception as e:
-                print(e)
-                print(f"pxe boot failed, retrying (count {retry + 1})")
-                for p in self.children:
-                    p.terminate()
-                self.children.clear()
-                pass
-        print("pxe boot reached max retries unsuccessfully")
-        exit(-1)
+        self.hold_lock(PXEBOOT_LOCK)
+        self.run_stages()
+        print(self.response_ip)
+        self.exit(0)
@@ -0,0 +1,117 @@
+"""
+Reachability checks done with plain TCP connections instead of one ping process per
+attempt. All hosts are probed at the same time from a single event loop, each with its
+own exponential backoff, and the check returns as soon as one of them is usable:
+its SSH port accepts connections (and, optionally, sends an SSH banner).
+"""
+
+import asyncio
+import time
+from logger import logger
+from typing import Optional
+
+SSH_PORT = 22
+
+# Backoff between attempts on the same host
+INITIAL_DELAY = 0.25
+MAX_DELAY = 5.0
+
+# Deadline for a single connection attempt
+CONNECT_TIMEOUT = 2.0
+
+
+def _host(address: str) -> str:
+    # accept the user@hostname form used for ssh
+    return address.split("@")[-1]
+
+
+async def _probe(
+    host: str, port: int, banner: bool, accept_refused: bool, timeout: float
+) -> bool:
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout
+        )
+    except ConnectionRefusedError:
+        # the host is up, only nothing is listening (yet)
+        return accept_refused
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    try:
+        if not banner:
+            return True
+        try:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        return line.startswith(b"SSH-")
+    finally:
+        writer.close()
+
+
+async def _wait_host(
+    host: str, port: int, banner: bool, accept_refused: bool, deadline: float
+) -> str:
+    delay = INITIAL_DELAY
+    attempt = 1
+    while True:
+        remaining = deadline - time.monotonic()
+        timeout = min(CONNECT_TIMEOUT, max(remaining, 0.1))
+        if await _probe(host, port, banner, accept_refused, timeout):
+            logger.debug(f"{host}:{port} is reachable after {attempt} attempts")
+            return host
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"{host}:{port} isn't reachable")
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, MAX_DELAY)
+        attempt += 1
+
+
+async def _wait_any(
+    hosts: list[str], port: int, banner: bool, accept_refused: bool, timeout: float
+) -> Optional[str]:
+    deadline = time.monotonic() + timeout
+    tasks = {
+        asyncio.ensure_future(
+            _wait_host(_host(h), port, banner, accept_refused, deadline)
+        ): h
+        for h in hosts
+    }
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if not task.cancelled() and task.exception() is None:
+                    return tasks[task]
+        return None
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def wait_any_reachable(
+    hosts: list[str],
+    timeout: float,
+    port: int = SSH_PORT,
+    banner: bool = False,
+    accept_refused: bool = False,
+) -> Optional[str]:
+    """
+    Probe all hosts until one of them accepts a connection on port, or timeout seconds
+    have passed. With banner, the host also needs to have sent an SSH banner. With
+    accept_refused, a refused connection counts too, it shows the host is up even if
+    the service isn't. Returns the first usable host, or None.
+    """
+    logger.debug(f"Waiting up to {timeout}s for any of {hosts} on port {port}")
+    return asyncio.run(_wait_any(hosts, port, banner, accept_refused, timeout))
+
+
+def wait_for_ssh(address: str, timeout: float = 10) -> bool:
+    """Whether sshd on address answers within timeout seconds."""
+    return wait_any_reachable([address], timeout, banner=True) is not None
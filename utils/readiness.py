@@ -0,0 +1,113 @@
+"""
+Waiting for a DPU to come back after a reset. The console is watched for boot milestones
+while the device boots (see utils/boot_profile.py), and it's considered ready once SSH
+answers again (or, for devices without a known address, once the console shows a login
+prompt). The time every milestone and readiness was reached is logged and the timeline
+saved with the other boot timelines.
+"""
+
+import time
+from logger import logger
+from typing import Optional
+from utils.boot_profile import BootProfiler, BootTimeline, Milestone
+from utils.console import ConsoleDevice
+from utils.reachability import wait_any_reachable
+
+# How long the device gets to show it's rebooting (a milestone on the console, or ssh
+# going away) before it's assumed the reset already happened
+DOWN_TIMEOUT = 120
+
+
+IMC_MILESTONES = [
+    Milestone("shutdown", r"reboot: Restarting|Restarting system"),
+    Milestone("bootloader", r"U-Boot"),
+    Milestone("kernel", r"Linux version"),
+    Milestone("userspace", r"systemd\[1\]|Run /sbin/init|init: "),
+    Milestone("login", r"login:"),
+]
+
+BF_MILESTONES = [
+    Milestone("uefi", r"UEFI firmware|BlueField"),
+    Milestone("bootloader", r"GRUB|grub|Booting"),
+    Milestone("kernel", r"Linux version"),
+    Milestone("userspace", r"systemd\[1\]|Run /sbin/init"),
+    Milestone("login", r"login:"),
+]
+
+
+class ReadinessTracker(BootProfiler):
+    """
+    Start it before triggering the reset, so no console output is missed:
+
+        with ReadinessTracker("imc", console_device, milestones, address) as tracker:
+            reset()
+            tracker.wait(600)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        console_device: Optional[ConsoleDevice],
+        milestones: list[Milestone],
+        ssh_address: Optional[str] = None,
+    ):
+        super().__init__(name, console_device, milestones)
+        self.ssh_address = ssh_address
+
+    def __enter__(self) -> "ReadinessTracker":
+        self.begin()
+        return self
+
+    def _wait_for_console(self, deadline: float, final: bool) -> bool:
+        """Wait for the first milestone, or for the last one with final."""
+        last = self.milestones[-1].name
+        with self.progress:
+            while time.monotonic() < deadline:
+                if final and last in self.timeline.milestones:
+                    return True
+                if not final and self.booting():
+                    return True
+                if self.watcher is None or not self.watcher.is_alive():
+                    return False
+                self.progress.wait(min(1, deadline - time.monotonic()))
+        return False
+
+    def _wait_for_down(self, deadline: float) -> None:
+        assert self.ssh_address is not None
+        down_deadline = min(deadline, time.monotonic() + DOWN_TIMEOUT)
+        while time.monotonic() < down_deadline:
+            if wait_any_reachable([self.ssh_address], 1, banner=True) is None:
+                logger.info(f"{self.name} went down after {self.elapsed()}s")
+                return
+            time.sleep(1)
+
+    def wait(self, timeout: float) -> BootTimeline:
+        deadline = time.monotonic() + timeout
+        if self.ssh_address is None:
+            if not self._wait_for_console(deadline, final=True):
+                raise TimeoutError(f"{self.name} didn't reach a login prompt")
+        else:
+            # the old sshd may still answer until the reset actually kicks in
+            if self.watcher is not None:
+                self._wait_for_console(
+                    min(deadline, time.monotonic() + DOWN_TIMEOUT), final=False
+                )
+            if not self.booting():
+                self._wait_for_down(deadline)
+            remaining = deadline - time.monotonic()
+            if (
+                remaining <= 0
+                or wait_any_reachable([self.ssh_address], remaining, banner=True)
+                is None
+            ):
+                raise TimeoutError(f"{self.name} didn't come back within {timeout}s")
+
+        self.timeline.ready = self.elapsed()
+        logger.info(f"{self.name} is ready after {self.timeline.ready}s")
+        if self.booting():
+            first = min(self.timeline.milestones.values())
+            logger.info(
+                f"{self.name} took {round(self.timeline.ready - first, 2)}s from the first boot milestone"
+            )
+        self.save()
+        return self.timeline
@@ -0,0 +1,135 @@
+"""
+Delta programming of a remote MTD (SPI flash) device. The contents of the device are
+hashed on the remote side one erase block at a time and compared with what should be on
+it, and only the blocks that differ are erased and written again. Blocks that should be
+empty are only erased.
+"""
+
+import dataclasses
+import hashlib
+from logger import logger
+from utils.common import ssh_run, ssh_write
+
+ERASED = b"\xff"
+
+
+@dataclasses.dataclass(frozen=True)
+class MtdInfo:
+    size: int
+    erase_size: int
+
+
+class SpiFlash:
+    def __init__(self, address: str, device: str = "/dev/mtd0", dry_run: bool = False):
+        self.address = address
+        self.device = device
+        self.name = device.split("/")[-1]
+        self.dry_run = dry_run
+        self._info: MtdInfo = MtdInfo(0, 0)
+
+    def info(self) -> MtdInfo:
+        if not self._info.erase_size:
+            result = ssh_run(
+                f"cat /sys/class/mtd/{self.name}/size /sys/class/mtd/{self.name}/erasesize",
+                self.address,
+                dry_run=False,
+            )
+            values = result.out.split()
+            if result.returncode or len(values) != 2:
+                raise RuntimeError(
+                    f"Couldn't get the geometry of {self.device}: {result.err}"
+                )
+            self._info = MtdInfo(int(values[0]), int(values[1]))
+            logger.debug(f"{self.device} on {self.address}: {self._info}")
+        return self._info
+
+    def remote_digests(self, first: int, count: int) -> dict[int, str]:
+        """sha256 of the erase blocks [first, first + count) as they are on the device"""
+        erase_size = self.info().erase_size
+        result = ssh_run(
+            f"i={first}; while [ $i -lt {first + count} ]; do "
+            f"echo $i $(dd if={self.device} bs={erase_size} skip=$i count=1 2>/dev/null | sha256sum); "
+            "i=$((i + 1)); done",
+            self.address,
+            dry_run=False,
+        )
+        digests = {}
+        for line in result.out.splitlines():
+            fields = line.split()
+            if len(fields) >= 2 and fields[0].isdigit():
+                digests[int(fields[0])] = fields[1]
+        return digests
+
+    def pad(self, data: bytes, length: int) -> bytes:
+        return data + ERASED * (length - len(data))
+
+    def program(self, data: bytes, offset: int = 0) -> list[int]:
+        """
+        Make the device hold data at offset, data is padded with erased bytes up to the
+        next erase block. Returns the erase blocks that had to be programmed.
+        """
+        if self.dry_run:
+            logger.info(
+                f"[DRY RUN] Program {len(data)} bytes at {offset:#x} of {self.device}, only writing blocks that differ"
+            )
+            return []
+
+        erase_size = self.info().erase_size
+        if offset % erase_size:
+            raise ValueError(
+                f"{offset:#x} isn't aligned to erase blocks of {erase_size}"
+            )
+        first = offset // erase_size
+        count = (len(data) + erase_size - 1) // erase_size
+        data = self.pad(data, count * erase_size)
+
+        current = self.remote_digests(first, count)
+        changed = []
+        for n in range(count):
+            block = data[n * erase_size : (n + 1) * erase_size]
+            if current.get(first + n) != hashlib.sha256(block).hexdigest():
+                changed.append(first + n)
+        logger.info(
+            f"{len(changed)} of {count} erase blocks of {self.device} differ from the image"
+        )
+
+        for start, length in self._runs(changed):
+            self._write(
+                start, data[(start - first) * erase_size :][: length * erase_size]
+            )
+        return changed
+
+    @staticmethod
+    def _runs(blocks: list[int]) -> list[tuple[int, int]]:
+        """Consecutive blocks grouped as (first block, number of blocks)"""
+        runs: list[tuple[int, int]] = []
+        for block in blocks:
+            if runs and runs[-1][0] + runs[-1][1] == block:
+                runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+            else:
+                runs.append((block, 1))
+        return runs
+
+    def _write(self, block: int, data: bytes) -> None:
+        erase_size = self.info().erase_size
+        offset = block * erase_size
+        count = len(data) // erase_size
+        result = ssh_run(
+            f"flash_erase {self.device} {offset} {count}", self.address, dry_run=False
+        )
+        if result.returncode:
+            raise RuntimeError(
+                f"Couldn't erase {self.device} at {offset:#x}: {result.err}"
+            )
+
+        # erased blocks already hold what they should
+        if data.strip(ERASED):
+            result = ssh_write(
+                f"dd of={self.device} bs={erase_size} seek={block} conv=notrunc",
+                self.address,
+                [data],
+            )
+            if result.returncode:
+                raise RuntimeError(
+                    f"Couldn't write {self.device} at {offset:#x}: {result.err}"
+                )
@@ -0,0 +1,178 @@
+"""
+Status of every DPU on the host, collected in one pass. The DPUs are found with a single
+scan, then every field (firmware version, mode, rshim, link) is collected for all of them
+at once by its own collector, all collectors running at the same time. Collectors batch
+what they can (one devlink query for all firmware versions, the modes queried in
+parallel) and read sysfs rather than running tools where possible.
+"""
+
+import concurrent.futures
+import dataclasses
+import glob
+import json
+import os
+import time
+from logger import logger
+from typing import Callable, Optional
+from utils.common import scan_for_dpus
+from utils.common_bf import query_fw_info, query_modes
+from utils.common_ipu import probe_version
+
+
+@dataclasses.dataclass
+class DpuStatus:
+    pci: str
+    kind: str
+    netdevs: list[str]
+    fields: dict[str, Optional[str]] = dataclasses.field(default_factory=dict)
+
+
+# Takes all DPUs, returns the value of its field by PCI address (for those it applies to)
+Collector = Callable[[list[DpuStatus]], dict[str, str]]
+
+
+def inventory() -> list[DpuStatus]:
+    dpus: dict[str, DpuStatus] = {}
+    for netdev, (pci, kind) in sorted(scan_for_dpus().items()):
+        dpus.setdefault(pci, DpuStatus(pci, kind, [])).netdevs.append(netdev)
+    return sorted(dpus.values(), key=lambda d: d.pci)
+
+
+def _full_pci(pci: str) -> str:
+    # lspci leaves out the (usually 0) PCI domain, devlink doesn't
+    return pci if pci.count(":") == 2 else f"0000:{pci}"
+
+
+def bf_firmware(dpus: list[DpuStatus]) -> dict[str, str]:
+    bfs = [d.pci for d in dpus if d.kind == "BF"]
+    if not bfs:
+        return {}
+    infos = query_fw_info([_full_pci(pci) for pci in bfs])
+    return {pci: info.get("FW Version", "") for pci, info in zip(bfs, infos)}
+
+
+def ipu_firmware(imc_address: str) -> Collector:
+    def collect(dpus: list[DpuStatus]) -> dict[str, str]:
+        ipus = [d.pci for d in dpus if d.kind == "IPU"]
+        if not ipus:
+            return {}
+        # there's only the one IMC to ask
+        version = probe_version(imc_address)
+        return {pci: version for pci in ipus} if version else {}
+
+    return collect
+
+
+def combine(*collectors: Collector) -> Collector:
+    """One collector running all of the given ones, for fields of several DPU kinds"""
+
+    def collect(dpus: list[DpuStatus]) -> dict[str, str]:
+        values = {}
+        for collector in collectors:
+            values.update(collector(dpus))
+        return values
+
+    return collect
+
+
+def bf_mode(dpus: list[DpuStatus]) -> dict[str, str]:
+    bfs = [d.pci for d in dpus if d.kind == "BF"]
+    if not bfs:
+        return {}
+    configs = query_modes(bfs)
+    return {pci: config.mode() for pci, config in zip(bfs, configs)}
+
+
+def rshim(dpus: list[DpuStatus]) -> dict[str, str]:
+    """The rshim of every BF, matched by the PCI address its misc file names"""
+    values = {}
+    for misc in sorted(glob.glob("/dev/rshim*/misc")):
+        name = misc.split("/")[2]
+        try:
+            with open(misc) as f:
+                content = f.read()
+        except OSError as e:
+            logger.debug(f"Couldn't read {misc}: {e}")
+            continue
+        for line in content.splitlines():
+            fields = line.split()
+            if len(fields) < 2 or fields[0] != "DEV_NAME":
+                continue
+            # e.g. "pcie-0000:03:00.2" or "usb-1.2"
+            transport, _, device = fields[1].partition("-")
+            bus = device.split(":")[-2] if device.count(":") >= 1 else ""
+            for dpu in dpus:
+                if dpu.kind == "BF" and bus and dpu.pci.split(":")[-2] == bus:
+                    values[dpu.pci] = f"{name} ({transport})"
+    for dpu in dpus:
+        if dpu.kind == "BF":
+            values.setdefault(dpu.pci, "none")
+    return values
+
+
+def _read_sysfs(netdev: str, name: str) -> str:
+    try:
+        with open(os.path.join("/sys/class/net", netdev, name)) as f:
+            return f.read().strip()
+    except OSError:
+        # e.g. speed can't be read while the link is down
+        return ""
+
+
+def link(dpus: list[DpuStatus]) -> dict[str, str]:
+    values = {}
+    for dpu in dpus:
+        states = []
+        for netdev in dpu.netdevs:
+            state = _read_sysfs(netdev, "operstate") or "unknown"
+            speed = _read_sysfs(netdev, "speed")
+            if state == "up" and speed.isdigit():
+                state += f" {int(speed) // 1000}G"
+            states.append(f"{netdev}:{state}")
+        values[dpu.pci] = " ".join(states)
+    return values
+
+
+def collect(
+    dpus: list[DpuStatus], collectors: dict[str, Collector]
+) -> dict[str, float]:
+    """Run all collectors at the same time, returns how long each took"""
+    timings: dict[str, float] = {}
+
+    def run_collector(field: str) -> dict[str, str]:
+        start = time.monotonic()
+        try:
+            return collectors[field](dpus)
+        except Exception as e:
+            logger.debug(f"Couldn't collect {field}: {e}")
+            return {}
+        finally:
+            timings[field] = round(time.monotonic() - start, 3)
+
+    with concurrent.futures.ThreadPoolExecutor(len(collectors)) as executor:
+        results = dict(zip(collectors, executor.map(run_collector, collectors)))
+    for dpu in dpus:
+        for field, values in results.items():
+            dpu.fields[field] = values.get(dpu.pci)
+    # in the order of the collectors rather than the one they finished in
+    return {field: timings[field] for field in collectors}
+
+
+def to_json(dpus: list[DpuStatus], timings: dict[str, float]) -> str:
+    entries = [
+        {"pci": d.pci, "kind": d.kind, "netdevs": d.netdevs, **d.fields} for d in dpus
+    ]
+    return json.dumps({"dpus": entries, "timings": timings}, indent=2)
+
+
+def to_table(dpus: list[DpuStatus], timings: dict[str, float]) -> str:
+    headers = ["PCI-Address", "Kind"] + list(timings)
+    rows = [[d.pci, d.kind] + [d.fields.get(f) or "-" for f in timings] for d in dpus]
+    widths = [max(len(str(c)) for c in column) for column in zip(headers, *rows)]
+    lines = ["  ".join(h.ljust(w) for h, w in zip(headers, widths))]
+    lines.append("  ".join("-" * w for w in widths))
+    for row in rows:
+        lines.append("  ".join(c.ljust(w) for c, w in zip(row, widths)))
+    spent = ", ".join(f"{field} {seconds:.2f}s" for field, seconds in timings.items())
+    lines.append(f"Collected in parallel: {spent}")
+    return "\n".join(lines)
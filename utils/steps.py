@@ -0,0 +1,146 @@
+import concurrent.futures
+import dataclasses
+import time
+from logger import logger
+from typing import Callable, Optional
+from utils.progress import ProgressEvent, recording
+
+
+@dataclasses.dataclass(frozen=True)
+class Step:
+    name: str
+    run: Callable[[], None]
+    deps: tuple[str, ...] = ()
+    # Steps that only produce something others need (e.g. downloading images) are pulled in
+    # automatically whenever a step depending on them runs
+    auto: bool = False
+
+
+@dataclasses.dataclass
+class StepTiming:
+    name: str
+    start: float
+    duration: float
+    # final progress of the transfers (flashes, burns) done by the step
+    progress: list[ProgressEvent] = dataclasses.field(default_factory=list)
+
+
+class StepRunner:
+    """
+    Runs a dependency graph of steps, starting every step as soon as all of its
+    dependencies are done, so independent steps overlap.
+    Steps can be limited to a selection and/or to everything from a given step onwards,
+    dependencies that are left out that way are considered done.
+    """
+
+    def __init__(
+        self,
+        steps: list[Step],
+        selected: Optional[list[str]] = None,
+        resume_from: Optional[str] = None,
+        max_workers: int = 4,
+    ):
+        self.steps = {step.name: step for step in steps}
+        self.order = [step.name for step in steps]
+        for step in steps:
+            for dep in step.deps:
+                if dep not in self.steps:
+                    raise ValueError(f"Step {step.name} depends on unknown step {dep}")
+        self.max_workers = max_workers
+        self.timings: list[StepTiming] = []
+        self.to_run = self._select(selected, resume_from)
+
+    def _select(
+        self, selected: Optional[list[str]], resume_from: Optional[str]
+    ) -> set[str]:
+        names = [n for n in self.order if not self.steps[n].auto]
+        for name in (selected or []) + ([resume_from] if resume_from else []):
+            if name not in self.steps:
+                raise ValueError(f"Unknown step {name}, valid steps: {names}")
+        if selected:
+            names = [n for n in names if n in selected]
+        if resume_from:
+            names = [
+                n for n in names if self.order.index(n) >= self.order.index(resume_from)
+            ]
+
+        to_run = set(names)
+        pending = list(names)
+        while pending:
+            for dep in self.steps[pending.pop()].deps:
+                if self.steps[dep].auto and dep not in to_run:
+                    to_run.add(dep)
+                    pending.append(dep)
+        return to_run
+
+    def skipped(self) -> list[str]:
+        return [n for n in self.order if n not in self.to_run]
+
+    def plan(self) -> list[list[str]]:
+        """The steps grouped in waves, everything in a wave can run at the same time"""
+        done = set(self.skipped())
+        waves = []
+        remaining = [n for n in self.order if n in self.to_run]
+        while remaining:
+            wave = [n for n in remaining if all(d in done for d in self.steps[n].deps)]
+            waves.append(wave)
+            done.update(wave)
+            remaining = [n for n in remaining if n not in wave]
+        return waves
+
+    def run(self) -> None:
+        begin = time.monotonic()
+        done = set(self.skipped())
+        for name in self.skipped():
+            logger.info(f"Skipping {name}")
+        remaining = [n for n in self.order if n in self.to_run]
+        running: dict[
+            concurrent.futures.Future[list[ProgressEvent]], tuple[str, float]
+        ] = {}
+
+        def start_step(step: Step) -> list[ProgressEvent]:
+            logger.info(f"Starting step {step.name}")
+            with recording() as parsers:
+                step.run()
+            return [p.last for p in parsers if p.last is not None]
+
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            while remaining or running:
+                for name in list(remaining):
+                    if all(d in done for d in self.steps[name].deps):
+                        remaining.remove(name)
+                        future = executor.submit(start_step, self.steps[name])
+                        running[future] = (name, time.monotonic())
+
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    name, start = running.pop(future)
+                    timing = StepTiming(name, start - begin, time.monotonic() - start)
+                    self.timings.append(timing)
+                    if future.exception() is not None:
+                        logger.error(f"Step {name} failed")
+                        # let the steps already running finish, but don't start new ones
+                        remaining.clear()
+                        concurrent.futures.wait(running)
+                        self.report(time.monotonic() - begin)
+                        future.result()
+                    timing.progress = future.result()
+                    logger.info(f"Done with step {name}")
+                    done.add(name)
+        self.report(time.monotonic() - begin)
+
+    def report(self, total: float) -> None:
+        logger.info("Step timings:")
+        for t in sorted(self.timings, key=lambda t: t.start):
+            logger.info(
+                f"  {t.name:<20} started at {t.start:7.1f}s, took {t.duration:7.1f}s"
+            )
+            for event in t.progress:
+                logger.info(f"    {event}")
+        busy = sum(t.duration for t in self.timings)
+        saved = max(0.0, busy - total)
+        logger.info(
+            f"  total {total:.1f}s, {busy:.1f}s of work ({saved:.1f}s saved by running steps in parallel)"
+        )
@@ -0,0 +1,182 @@
+"""
+A read-only TFTP server (RFC 1350) with the blksize (RFC 2348) and tsize (RFC 2349)
+options, enough for UEFI PXE and GRUB. Files come from a resolve callback, so they can be
+served straight from an ISO image (see utils/iso9660.py). Every transfer gets a socket
+and a thread of its own.
+"""
+
+import socket
+import struct
+import threading
+from logger import logger
+from typing import Callable, Optional
+from utils.iso9660 import FileRange
+
+TFTP_PORT = 69
+
+OP_RRQ = 1
+OP_WRQ = 2
+OP_DATA = 3
+OP_ACK = 4
+OP_ERROR = 5
+OP_OACK = 6
+
+ERROR_NOT_FOUND = 1
+ERROR_ILLEGAL = 4
+
+DEFAULT_BLKSIZE = 512
+MIN_BLKSIZE = 8
+MAX_BLKSIZE = 65464
+
+# How long to wait for an ACK before sending again, and how often
+TIMEOUT = 1.0
+RETRIES = 5
+
+Resolver = Callable[[str], Optional[FileRange]]
+
+
+def _error(code: int, message: str) -> bytes:
+    return struct.pack("!HH", OP_ERROR, code) + message.encode() + b"\0"
+
+
+def _parse_request(packet: bytes) -> tuple[str, str, dict[str, str]]:
+    fields = packet[2:].split(b"\0")
+    filename = fields[0].decode(errors="replace")
+    mode = fields[1].decode(errors="replace").lower() if len(fields) > 1 else ""
+    options = {}
+    rest = fields[2:]
+    for i in range(0, len(rest) - 1, 2):
+        if rest[i]:
+            key = rest[i].decode(errors="replace").lower()
+            options[key] = rest[i + 1].decode(errors="replace")
+    return filename, mode, options
+
+
+class _Transfer:
+    def __init__(
+        self,
+        server_ip: str,
+        client: tuple[str, int],
+        data: FileRange,
+        options: dict[str, str],
+    ):
+        self.client = client
+        self.data = data
+        self.options = options
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((server_ip, 0))
+        self.sock.settimeout(TIMEOUT)
+
+    def _send(self, packet: bytes, block: int) -> bool:
+        """Send packet until the client acknowledges block, returns whether it did"""
+        for _ in range(RETRIES):
+            self.sock.sendto(packet, self.client)
+            while True:
+                try:
+                    reply, sender = self.sock.recvfrom(MAX_BLKSIZE + 4)
+                except socket.timeout:
+                    break
+                if sender != self.client or len(reply) < 4:
+                    continue
+                opcode, number = struct.unpack("!HH", reply[:4])
+                if opcode == OP_ERROR:
+                    return False
+                if opcode == OP_ACK and number == block:
+                    return True
+        return False
+
+    def run(self) -> None:
+        try:
+            self._run()
+        except OSError as e:
+            logger.debug(f"TFTP transfer to {self.client} failed: {e}")
+        finally:
+            self.sock.close()
+            self.data.close()
+
+    def _run(self) -> None:
+        blksize = DEFAULT_BLKSIZE
+        accepted = {}
+        if "blksize" in self.options:
+            try:
+                blksize = max(
+                    MIN_BLKSIZE, min(MAX_BLKSIZE, int(self.options["blksize"]))
+                )
+                accepted["blksize"] = str(blksize)
+            except ValueError:
+                pass
+        if "tsize" in self.options:
+            accepted["tsize"] = str(self.data.size)
+        if accepted:
+            oack = struct.pack("!H", OP_OACK) + b"".join(
+                k.encode() + b"\0" + v.encode() + b"\0" for k, v in accepted.items()
+            )
+            if not self._send(oack, 0):
+                # clients often only ask for tsize and then abort, that's fine
+                return
+
+        block = 1
+        offset = 0
+        while True:
+            chunk = self.data.read(offset, blksize)
+            packet = struct.pack("!HH", OP_DATA, block % 65536) + chunk
+            if not self._send(packet, block % 65536):
+                logger.debug(f"TFTP client {self.client} stopped acknowledging")
+                return
+            offset += len(chunk)
+            # a short block, possibly empty, ends the transfer
+            if len(chunk) < blksize:
+                return
+            block += 1
+
+
+def _handle(
+    sock: socket.socket,
+    address: str,
+    resolve: Resolver,
+    packet: bytes,
+    client: tuple[str, int],
+) -> None:
+    opcode = struct.unpack("!H", packet[:2])[0]
+    if opcode != OP_RRQ:
+        sock.sendto(_error(ERROR_ILLEGAL, "Only reads are supported"), client)
+        return
+    filename, _, options = _parse_request(packet)
+    data = resolve(filename)
+    if data is None:
+        logger.debug(f"TFTP {client} asked for missing {filename}")
+        sock.sendto(_error(ERROR_NOT_FOUND, "File not found"), client)
+        return
+    logger.debug(f"TFTP {client} reads {filename} ({data.size} bytes)")
+    try:
+        transfer = _Transfer(address, client, data, options)
+    except OSError:
+        data.close()
+        raise
+    threading.Thread(target=transfer.run, daemon=True).start()
+
+
+def serve(
+    address: str, resolve: Resolver, stop: Optional[threading.Event] = None
+) -> None:
+    """Serve read requests on address until stop is set (forever without it)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((address, TFTP_PORT))
+    sock.settimeout(1.0)
+    logger.debug(f"TFTP server listening on {address}:{TFTP_PORT}")
+    try:
+        while stop is None or not stop.is_set():
+            try:
+                packet, client = sock.recvfrom(MAX_BLKSIZE + 4)
+            except socket.timeout:
+                continue
+            if len(packet) < 4:
+                continue
+            try:
+                _handle(sock, address, resolve, packet, client)
+            except (ValueError, OSError) as e:
+                # one bad request mustn't take the server down
+                logger.debug(f"TFTP request from {client} failed: {e}")
+    finally:
+        sock.close()
@@ -0,0 +1,177 @@
+import re
+import time
+from collections import Counter
+from logger import logger
+from typing import Callable, Optional
+from utils.console import ConsoleBase
+from utils.vt100 import VERTICAL_LINES, Screen
+
+KEY_UP = "\x1b[A"
+KEY_DOWN = "\x1b[B"
+KEY_ENTER = "\r\n"
+
+# The setup browser redraws in bursts, it's done once it has been quiet for this long
+SETTLE_TIME = 0.2
+
+
+class UefiMenu:
+    """
+    Drives the UEFI setup browser through a screen model of the console, so the current
+    selection and the full list of menu entries can be read instead of pattern matching the
+    raw byte stream after every key press.
+    """
+
+    def __init__(self, console: ConsoleBase):
+        self.console = console
+        self.screen = Screen()
+        # take over whatever the console read past its last expect()
+        self.screen.feed(console.buffer)
+        console.buffer = b""
+
+    def settle(self, timeout: float = 5) -> None:
+        """Wait for the screen to stop changing."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            data = self.console.read_nonblocking(4096, SETTLE_TIME)
+            if not data:
+                return
+            self.screen.feed(data)
+
+    def _wait(self, check: Callable[[], bool], what: str, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.settle(deadline - time.monotonic())
+            if check():
+                return
+            self.screen.feed(self.console.read_nonblocking(4096, SETTLE_TIME))
+        raise TimeoutError(f"No {what} after {timeout}s")
+
+    def wait_for(self, pattern: str, timeout: float) -> None:
+        """Wait until a menu with an entry matching pattern is on the screen."""
+        self._wait(
+            lambda: any(re.search(pattern, e) for e in self.entries()),
+            f"menu entry matching '{pattern}'",
+            timeout,
+        )
+
+    def wait_for_help(self, pattern: str, timeout: float) -> None:
+        """Wait until the help pane shows text matching pattern."""
+        self._wait(
+            lambda: bool(re.search(pattern, self.help_text())),
+            f"help text matching '{pattern}'",
+            timeout,
+        )
+
+    def _split(self) -> int:
+        divider = self.screen.divider_column()
+        return divider if divider is not None else self.screen.cols
+
+    def _text_rows(self) -> dict[int, int]:
+        """Background of every row of the menu pane that has text on it"""
+        split = self._split()
+        backgrounds = {}
+        for row in range(self.screen.rows):
+            background = self.screen.text_background(row, 0, split)
+            if background is not None:
+                backgrounds[row] = background
+        return backgrounds
+
+    def selection(self) -> Optional[tuple[int, str]]:
+        """
+        Row and text of the highlighted menu entry. That's the row drawn on a different
+        background than the rows around it, titles and such on a background of their own
+        aren't surrounded by other entries.
+        """
+        backgrounds = self._text_rows()
+        if not backgrounds:
+            return None
+        common = Counter(backgrounds.values()).most_common(1)[0][0]
+        candidates = [row for row, bg in backgrounds.items() if bg != common]
+        for row in candidates:
+            if backgrounds.get(row - 1) == common or backgrounds.get(row + 1) == common:
+                return row, self._entry_text(row)
+        return None
+
+    def _entry_text(self, row: int) -> str:
+        return self.screen.line(row, 0, self._split()).strip(" |│║>")
+
+    def _entry_rows(self) -> list[int]:
+        """Rows of the block of menu entries the highlighted one belongs to"""
+        selection = self.selection()
+        if selection is None:
+            return []
+        backgrounds = self._text_rows()
+
+        def is_entry(row: int) -> bool:
+            return row in backgrounds
+
+        first = last = selection[0]
+        while is_entry(first - 1):
+            first -= 1
+        while is_entry(last + 1):
+            last += 1
+        return list(range(first, last + 1))
+
+    def entries(self) -> list[str]:
+        return [self._entry_text(row) for row in self._entry_rows()]
+
+    def help_text(self) -> str:
+        """
+        The help pane next to the menu. Wrapped lines are joined back together so a device
+        path split over several lines can still be matched.
+        """
+        split = self._split()
+        if split >= self.screen.cols:
+            return ""
+        return "".join(
+            self.screen.line(row, split + 1).strip(" |│║")
+            for row in range(self.screen.rows)
+            if self.screen.cells[row][split].char in VERTICAL_LINES
+        )
+
+    def _move(self, steps: int) -> None:
+        if steps:
+            self.console.send((KEY_DOWN if steps > 0 else KEY_UP) * abs(steps))
+            self.settle()
+
+    def select(self, pattern: str) -> str:
+        """Move the highlight straight to the entry matching pattern."""
+        rows = self._entry_rows()
+        entries = self.entries()
+        selection = self.selection()
+        logger.debug(f"Menu entries: {entries}, selected: {selection}")
+        target = next((i for i, e in enumerate(entries) if re.search(pattern, e)), None)
+        if selection is None or target is None:
+            raise Exception(f"No menu entry matching '{pattern}' in {entries}")
+        self._move(target - rows.index(selection[0]))
+
+        selection = self.selection()
+        if selection is None or not re.search(pattern, selection[1]):
+            raise Exception(f"Failed to select '{pattern}', selected: {selection}")
+        return selection[1]
+
+    def find(self, help_pattern: str, entry_pattern: str = "") -> str:
+        """
+        Move the highlight to the entry whose help text matches help_pattern (e.g. a device
+        path). Entries matching entry_pattern are tried first, after that every entry is
+        visited once, waiting only for the screen to settle after each key press.
+        """
+        if re.search(help_pattern, self.help_text()):
+            return self._selected_text()
+        if entry_pattern and any(re.search(entry_pattern, e) for e in self.entries()):
+            self.select(entry_pattern)
+            if re.search(help_pattern, self.help_text()):
+                return self._selected_text()
+
+        for _ in range(len(self.entries())):
+            self._move(1)
+            if re.search(help_pattern, self.help_text()):
+                return self._selected_text()
+        raise Exception(f"No menu entry with help text matching '{help_pattern}'")
+
+    def _selected_text(self) -> str:
+        selection = self.selection()
+        return selection[1] if selection else ""
+
+    def enter(self) -> None:
+        self.console.send(KEY_ENTER)
@@ -0,0 +1,215 @@
+import codecs
+import dataclasses
+from collections import Counter
+from typing import Optional
+
+
+@dataclasses.dataclass(frozen=True)
+class Style:
+    fg: int = 7
+    bg: int = 0
+    bold: bool = False
+    reverse: bool = False
+
+    def background(self) -> int:
+        return self.fg if self.reverse else self.bg
+
+
+DEFAULT_STYLE = Style()
+
+# Characters drawn by the UEFI setup browser as vertical separators
+VERTICAL_LINES = "|│║"
+
+CP437_FALLBACK = "vt100-cp437"
+
+
+def _cp437_fallback(error: UnicodeError) -> tuple[str, int]:
+    """
+    Decode what isn't UTF-8 as CP437. EDK2 in PC-ANSI mode draws its boxes with CP437
+    bytes (e.g. 0xB3 and 0xBA for the vertical lines), which this turns into the same
+    box drawing characters its UTF-8 mode sends.
+    """
+    if not isinstance(error, UnicodeDecodeError):
+        raise error
+    return error.object[error.start : error.end].decode("cp437"), error.end
+
+
+codecs.register_error(CP437_FALLBACK, _cp437_fallback)
+
+
+@dataclasses.dataclass
+class Cell:
+    char: str = " "
+    style: Style = DEFAULT_STYLE
+
+
+class Screen:
+    """
+    A minimal VT100/ANSI terminal emulator. It only understands what firmware setup UIs
+    use (cursor addressing, erasing and colors) and keeps a model of what's on the screen,
+    so menus can be read back as text together with which part of them is highlighted.
+    """
+
+    def __init__(self, rows: int = 50, cols: int = 200):
+        self.rows = rows
+        self.cols = cols
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors=CP437_FALLBACK)
+        self.reset()
+
+    def reset(self) -> None:
+        self.cells = [[Cell() for _ in range(self.cols)] for _ in range(self.rows)]
+        self.row = 0
+        self.col = 0
+        self.style = DEFAULT_STYLE
+        self.state = "ground"
+        self.params = ""
+
+    def feed(self, data: bytes) -> None:
+        for c in self.decoder.decode(data):
+            self._feed_char(c)
+
+    def _feed_char(self, c: str) -> None:
+        if self.state == "escape":
+            if c == "[":
+                self.state = "csi"
+                self.params = ""
+            elif c in "()":
+                # character set designation, the next char is the set
+                self.state = "charset"
+            else:
+                if c == "c":
+                    self.reset()
+                self.state = "ground"
+        elif self.state == "charset":
+            self.state = "ground"
+        elif self.state == "csi":
+            if c.isdigit() or c in ";?":
+                self.params += c
+            else:
+                self._csi(c)
+                self.state = "ground"
+        elif c == "\x1b":
+            self.state = "escape"
+        elif c == "\r":
+            self.col = 0
+        elif c == "\n":
+            self._linefeed()
+        elif c == "\b":
+            self.col = max(0, self.col - 1)
+        elif c == "\t":
+            self.col = min(self.cols - 1, (self.col // 8 + 1) * 8)
+        elif c >= " ":
+            self._put(c)
+
+    def _put(self, c: str) -> None:
+        if self.col >= self.cols:
+            self.col = 0
+            self._linefeed()
+        self.cells[self.row][self.col] = Cell(c, self.style)
+        self.col += 1
+
+    def _linefeed(self) -> None:
+        if self.row == self.rows - 1:
+            self.cells.pop(0)
+            self.cells.append([Cell() for _ in range(self.cols)])
+        else:
+            self.row += 1
+
+    def _param_list(self, default: int) -> list[int]:
+        values = [int(p) if p else default for p in self.params.lstrip("?").split(";")]
+        return values or [default]
+
+    def _csi(self, command: str) -> None:
+        params = self._param_list(1)
+        n = params[0]
+        if command in "Hf":
+            row = params[0]
+            col = params[1] if len(params) > 1 else 1
+            self.row = min(max(row, 1), self.rows) - 1
+            self.col = min(max(col, 1), self.cols) - 1
+        elif command == "A":
+            self.row = max(0, self.row - n)
+        elif command == "B":
+            self.row = min(self.rows - 1, self.row + n)
+        elif command == "C":
+            self.col = min(self.cols - 1, self.col + n)
+        elif command == "D":
+            self.col = max(0, self.col - n)
+        elif command == "J":
+            self._erase_display(self._param_list(0)[0])
+        elif command == "K":
+            self._erase_line(self._param_list(0)[0])
+        elif command == "m":
+            self._sgr(self._param_list(0))
+
+    def _erase_display(self, mode: int) -> None:
+        if mode == 0:
+            self._erase_line(0)
+            rows = range(self.row + 1, self.rows)
+        elif mode == 1:
+            self._erase_line(1)
+            rows = range(0, self.row)
+        else:
+            rows = range(0, self.rows)
+        for row in rows:
+            self.cells[row] = [Cell(" ", self.style) for _ in range(self.cols)]
+
+    def _erase_line(self, mode: int) -> None:
+        if mode == 0:
+            cols = range(self.col, self.cols)
+        elif mode == 1:
+            cols = range(0, self.col + 1)
+        else:
+            cols = range(0, self.cols)
+        for col in cols:
+            self.cells[self.row][col] = Cell(" ", self.style)
+
+    def _sgr(self, params: list[int]) -> None:
+        style = self.style
+        for p in params:
+            if p == 0:
+                style = DEFAULT_STYLE
+            elif p == 1:
+                style = dataclasses.replace(style, bold=True)
+            elif p == 22:
+                style = dataclasses.replace(style, bold=False)
+            elif p == 7:
+                style = dataclasses.replace(style, reverse=True)
+            elif p == 27:
+                style = dataclasses.replace(style, reverse=False)
+            elif 30 <= p <= 37:
+                style = dataclasses.replace(style, fg=p - 30)
+            elif 40 <= p <= 47:
+                style = dataclasses.replace(style, bg=p - 40)
+        self.style = style
+
+    def line(self, row: int, start: int = 0, end: Optional[int] = None) -> str:
+        return "".join(c.char for c in self.cells[row][start:end]).rstrip()
+
+    def text(self) -> str:
+        return "\n".join(self.line(row) for row in range(self.rows))
+
+    def text_background(
+        self, row: int, start: int = 0, end: Optional[int] = None
+    ) -> Optional[int]:
+        """Background of the first piece of text (ignoring frame lines) in the given range"""
+        for cell in self.cells[row][start:end]:
+            if cell.char not in VERTICAL_LINES + " ":
+                return cell.style.background()
+        return None
+
+    def divider_column(self) -> Optional[int]:
+        """Column of the vertical line between a menu and its help text, if any"""
+        counts: Counter[int] = Counter()
+        for r in self.cells:
+            for col, cell in enumerate(r):
+                if cell.char in VERTICAL_LINES and 0 < col < self.cols - 1:
+                    counts[col] += 1
+        inner = [(col, n) for col, n in counts.items() if n > 2]
+        if not inner:
+            return None
+        # the outer frame has lines on both sides, the divider is the one in between
+        inner.sort()
+        if len(inner) >= 3:
+            return inner[1][0]
+        return inner[0][0]